@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import NamedTuple
+from config.configs import settings
+
+#? Vault ciphertext is opaque and never queried, so it can live outside Postgres. Blobs are addressed by the sha256
+#? of their bytes: writes are idempotent, a crashed upload leaves at most an orphan, never a half written blob.
+#? Every backend does its IO synchronously and the async methods push it onto a thread. The sync methods are there
+#? for the alembic data migration and the scripts.
+
+class StoredBlob(NamedTuple):
+    hash: str
+    size: int
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+class BlobStore:
+
+    def put_bytes(self, data: bytes) -> StoredBlob:
+        raise NotImplementedError
+
+    def read_bytes(self, blob_hash: str) -> bytes:
+        raise NotImplementedError
+
+    def delete_blob(self, blob_hash: str):
+        raise NotImplementedError
+
+    def iter_hashes(self):
+        """Yields (hash, mtime) for every stored blob, used by the garbage collector"""
+        raise NotImplementedError
+
+    def modified(self, blob_hash: str) -> float | None:
+        """mtime of one blob, None when it isn't there. The garbage collector checks it again right before a delete"""
+        raise NotImplementedError
+
+    def local_path(self, blob_hash: str) -> Path | None:
+        """Filesystem path when the backend has one, lets reads use sendfile or mmap"""
+        return None
+
+    async def put(self, data: bytes) -> StoredBlob:
+        return await asyncio.to_thread(self.put_bytes, data)
+
+    async def put_stream(self, chunks, limit: int) -> StoredBlob:
+        data = bytearray()
+        async for chunk in chunks:
+            data += chunk
+            if len(data) > limit:
+                raise BlobTooLarge()
+        return await self.put(bytes(data))
+
+    async def get(self, blob_hash: str) -> bytes:
+        return await asyncio.to_thread(self.read_bytes, blob_hash)
+
+    async def delete(self, blob_hash: str):
+        await asyncio.to_thread(self.delete_blob, blob_hash)
+
+
+class FileBlobStore(BlobStore):
+    """<root>/ab/cd/abcd...: two levels of fan out keep directories small"""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.tmp = self.root / "tmp"
+        self.tmp.mkdir(parents=True, exist_ok=True)
+
+    def local_path(self, blob_hash: str) -> Path:
+        return self.root / blob_hash[:2] / blob_hash[2:4] / blob_hash
+
+    def touch(self, path: Path) -> bool:
+        """Same content is already there: its mtime starts over, so the garbage collector's grace period covers the
+        row about to point at it. False when the blob is gone"""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def commit(self, tmp_path: str, blob_hash: str):
+        final = self.local_path(blob_hash)
+        if self.touch(final):
+            os.unlink(tmp_path)
+            return
+        final.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, final)
+
+    def put_bytes(self, data: bytes) -> StoredBlob:
+        blob_hash = hashlib.sha256(data).hexdigest()
+        if self.touch(self.local_path(blob_hash)):
+            return StoredBlob(blob_hash, len(data))
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.commit(tmp_path, blob_hash)
+        return StoredBlob(blob_hash, len(data))
+
+    async def put_stream(self, chunks, limit: int) -> StoredBlob:
+        """Hashes and writes while the body arrives, the whole blob is never held in memory"""
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > limit:
+                        raise BlobTooLarge()
+                    digest.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+                await asyncio.to_thread(os.fsync, f.fileno())
+            blob_hash = digest.hexdigest()
+            await asyncio.to_thread(self.commit, tmp_path, blob_hash)
+            return StoredBlob(blob_hash, size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def read_bytes(self, blob_hash: str) -> bytes:
+        return self.local_path(blob_hash).read_bytes()
+
+    def delete_blob(self, blob_hash: str):
+        try:
+            self.local_path(blob_hash).unlink()
+        except FileNotFoundError:
+            pass
+
+    def iter_hashes(self):
+        for path in self.root.glob("??/??/*"):
+            yield path.name, path.stat().st_mtime
+
+    def modified(self, blob_hash: str) -> float | None:
+        try:
+            return self.local_path(blob_hash).stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+
+class S3BlobStore(BlobStore):
+    """Any S3 compatible API, MinIO works as the local stand in (S3_ENDPOINT_URL=http://localhost:9000)"""
+
+    def __init__(self, bucket: str, endpoint_url: str | None, access_key: str | None, secret_key: str | None, region: str | None, prefix: str = "vaults/"):
+        import boto3 #? Optional dependency, only needed with BLOB_BACKEND=s3
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region)
+
+    def key(self, blob_hash: str) -> str:
+        return self.prefix + blob_hash
+
+    def put_bytes(self, data: bytes) -> StoredBlob:
+        blob_hash = hashlib.sha256(data).hexdigest()
+        self.client.put_object(Bucket=self.bucket, Key=self.key(blob_hash), Body=data)
+        return StoredBlob(blob_hash, len(data))
+
+    def read_bytes(self, blob_hash: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=self.key(blob_hash))["Body"].read()
+
+    def delete_blob(self, blob_hash: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(blob_hash))
+
+    def iter_hashes(self):
+        pages = self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix)
+        for page in pages:
+            for obj in page.get("Contents", []):
+                yield obj["Key"][len(self.prefix):], obj["LastModified"].timestamp()
+
+    def modified(self, blob_hash: str) -> float | None:
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(blob_hash))["LastModified"].timestamp()
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return None
+            raise
+
+
+def make_blob_store(backend: str) -> BlobStore | None:
+    """None means ciphertext stays inline in vaults.encrypted_data"""
+
+    if backend == "database":
+        return None
+    if backend == "file":
+        return FileBlobStore(settings.blob_dir)
+    if backend == "s3":
+        return S3BlobStore(settings.s3_bucket, settings.s3_endpoint_url, settings.s3_access_key, settings.s3_secret_key, settings.s3_region)
+    raise ValueError(f"Unknown BLOB_BACKEND {backend}")
+
+
+blob_store = make_blob_store(settings.blob_backend)
@@ -0,0 +1,361 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import time
+import zlib
+from datetime import datetime
+from pydantic import ValidationError
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from DB.blobstore import blob_store
+from DB.export import FRAME_HEADER
+from DB.shards import shard_router
+from schemas.schemas import UserSend
+from utils.hashing import key_hasher, HashingBusy, HASH_PREFIX
+from config.configs import settings
+
+#? Bulk account import. Records are validated and prepared in Python, then every batch is one transaction per shard: COPY
+#? into a temp staging table, and a single statement inserts the users with ON CONFLICT DO NOTHING and their vaults for
+#? the users that really got inserted. Rows that were not inserted come back in the report with a reason.
+#?
+#? A record is (username, salt_b64, hashed_key_a, encrypted_data, nonce_b64), encrypted_data base64 and optional.
+#? A chunked vault comes as manifest (ordered chunk hashes) and chunks [{hash, nonce_b64, data}] instead of encrypted_data.
+#? Records from DB/export.py fit as they are: their argon2 hashes are stored unchanged, and version and created_at kept.
+#?
+#! key_a must be argon2 hashed before it is stored, and at a few hashes per core per second that is the real limit.
+#! hashing="defer" stores the raw key_a instead and the first good login replaces it with the hash (KeyHasher.verify),
+#! which makes the import run at COPY speed but keeps a password equivalent in the table until then.
+
+HASHING_MODES = ("hash", "defer")
+HASH_BUSY_WAIT = 60 #? Seconds a row keeps retrying while logins fill the hashing queue, the import stops after that
+
+STAGING_COLUMNS = ["row_no", "username", "salt_b64", "hashed_key_a", "created_at", "encrypted_data", "blob_hash", "blob_size", "nonce_b64", "version", "manifest"]
+CHUNK_COLUMNS = ["username", "chunk_hash", "encrypted_data", "nonce_b64"]
+
+CREATE_STAGING = text("""
+CREATE TEMP TABLE import_staging (
+    row_no bigint, username text, salt_b64 text, hashed_key_a text, created_at timestamptz,
+    encrypted_data bytea, blob_hash text, blob_size bigint, nonce_b64 text, version bigint, manifest text[]
+) ON COMMIT DROP
+""")
+
+CREATE_CHUNK_STAGING = text("""
+CREATE TEMP TABLE import_chunks (username text, chunk_hash text, encrypted_data bytea, nonce_b64 text) ON COMMIT DROP
+""")
+
+MERGE = text("""
+WITH new_users AS (
+    INSERT INTO users (username, salt_b64, hashed_key_a, created_at)
+    SELECT username, salt_b64, hashed_key_a, coalesce(created_at, now()) FROM import_staging ORDER BY row_no
+    ON CONFLICT (username) DO NOTHING
+    RETURNING id, username
+), new_vaults AS (
+    INSERT INTO vaults (user_id, encrypted_data, blob_hash, blob_size, nonce_b64, version, manifest)
+    SELECT u.id, s.encrypted_data, s.blob_hash, s.blob_size, s.nonce_b64, s.version, s.manifest
+    FROM new_users u JOIN import_staging s ON s.username = u.username
+    WHERE s.nonce_b64 IS NOT NULL
+), new_chunks AS (
+    INSERT INTO vault_chunks (user_id, chunk_hash, encrypted_data, nonce_b64)
+    SELECT u.id, c.chunk_hash, c.encrypted_data, c.nonce_b64
+    FROM new_users u JOIN import_chunks c ON c.username = u.username
+)
+SELECT username FROM new_users
+""")
+
+
+class RowError(Exception):
+    pass
+
+
+def parse_record(record: dict) -> dict:
+    """Checks one input record and turns it into staging columns, raises RowError with the reason"""
+
+    if not record:
+        raise RowError("not a JSON object")
+
+    try:
+        user = UserSend(username=record.get("username"), salt_b64=record.get("salt_b64"), hashed_key_a=record.get("hashed_key_a"))
+    except ValidationError as err:
+        raise RowError(f"invalid {', '.join(str(e['loc'][0]) for e in err.errors())}")
+
+    manifest, chunks = parse_chunks(record)
+
+    data = record.get("encrypted_data")
+    if isinstance(data, str):
+        try:
+            data = base64.b64decode(data, validate=True)
+        except binascii.Error:
+            raise RowError("encrypted_data is not base64")
+    if manifest is not None:
+        data = b"" #? A chunked vault row holds no ciphertext of its own, as commit_manifest stores it (EMPTY_CIPHERTEXT)
+    elif data is not None and not record.get("nonce_b64"):
+        raise RowError("encrypted_data without nonce_b64")
+    if data is not None and len(data) > settings.max_vault_bytes:
+        raise RowError("encrypted_data is over MAX_VAULT_BYTES")
+
+    created_at = record.get("created_at")
+    try:
+        created_at = datetime.fromisoformat(created_at) if created_at else None
+    except (TypeError, ValueError):
+        raise RowError("invalid created_at")
+
+    try:
+        version = int(record.get("version") or 1)
+    except (TypeError, ValueError):
+        raise RowError("invalid version")
+
+    return {
+        "username": user.username,
+        "salt_b64": user.salt_b64,
+        "hashed_key_a": user.hashed_key_a,
+        "created_at": created_at,
+        "encrypted_data": data,
+        "nonce_b64": (record.get("nonce_b64") or "") if data is not None else None,
+        "version": version,
+        "manifest": manifest,
+        "chunks": chunks,
+    }
+
+
+def parse_chunks(record: dict) -> tuple[list[str] | None, list[tuple[str, bytes, str]]]:
+    """(manifest, [(hash, data, nonce_b64)]) of a chunked vault record, (None, []) for any other.
+    Only the chunks the manifest points to are kept, each checked against its hash"""
+
+    manifest = record.get("manifest")
+    if not manifest:
+        return None, []
+    if not isinstance(manifest, list) or not all(isinstance(h, str) and len(h) == 64 for h in manifest):
+        raise RowError("invalid manifest")
+
+    chunks, total = {}, 0
+    for c in record.get("chunks") or []:
+        if not isinstance(c, dict) or not c.get("nonce_b64") or c.get("hash") not in manifest:
+            continue
+        data = c.get("data")
+        if isinstance(data, str):
+            try:
+                data = base64.b64decode(data, validate=True)
+            except binascii.Error:
+                raise RowError(f"chunk {c['hash']} is not base64")
+        if not isinstance(data, bytes) or hashlib.sha256(data).hexdigest() != c["hash"]:
+            raise RowError(f"chunk {c['hash']} does not match its content")
+        if len(data) > settings.max_chunk_bytes:
+            raise RowError(f"chunk {c['hash']} is over MAX_CHUNK_BYTES")
+        total += len(data)
+        chunks[c["hash"]] = (c["hash"], data, c["nonce_b64"])
+
+    if total > settings.max_vault_bytes:
+        raise RowError("chunks are over MAX_VAULT_BYTES")
+    if any(h not in chunks for h in manifest):
+        raise RowError("manifest points to a chunk the record doesn't carry")
+    return manifest, list(chunks.values())
+
+
+async def hash_keys(rows: list[dict], hashing: str):
+    """argon2 hashes the raw keys in place, through the hashing pool and never more than it accepts at once"""
+
+    if hashing == "defer":
+        return
+
+    slots = asyncio.Semaphore(max(1, key_hasher.max_pending // 2)) #? Leaves room in the queue for logins on the same pool
+
+    async def one(row):
+        async with slots:
+            #! The queue is shared, logins and registrations can fill it whatever the import holds back. They go first,
+            #! the import backs off and tries again
+            delay, waited = 0.05, 0.0
+            while True:
+                try:
+                    row["hashed_key_a"] = await key_hasher.hash(row["hashed_key_a"])
+                    return
+                except HashingBusy:
+                    if waited >= HASH_BUSY_WAIT:
+                        raise
+                    await asyncio.sleep(delay)
+                    waited += delay
+                    delay = min(delay * 2, 1.0)
+
+    #? A failed row cancels the rest of the batch, nothing of it is merged
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for r in rows:
+                if not r["hashed_key_a"].startswith(HASH_PREFIX):
+                    tg.create_task(one(r))
+    except ExceptionGroup as group:
+        raise group.exceptions[0]
+
+
+async def store_ciphertext(rows: list[dict]):
+    """With a blob backend the ciphertext goes to the store and the row only keeps its hash, as on POST /vaults"""
+
+    for row in rows:
+        data = row.pop("encrypted_data")
+        if data and blob_store is not None:
+            blob = await blob_store.put(data)
+            row.update(encrypted_data=None, blob_hash=blob.hash, blob_size=blob.size)
+        else:
+            row.update(encrypted_data=data, blob_hash=None, blob_size=None)
+
+
+async def copy_batch(db: AsyncSession, rows: list[dict]) -> set[str]:
+    """One transaction: staging COPY and merge. Returns the usernames that were inserted"""
+
+    await db.execute(CREATE_STAGING)
+    await db.execute(CREATE_CHUNK_STAGING)
+    conn = await db.connection()
+    raw = (await conn.get_raw_connection()).driver_connection #? asyncpg, COPY is not reachable through SQLAlchemy
+
+    await raw.copy_records_to_table("import_staging", columns=STAGING_COLUMNS, records=[tuple(r[c] for c in STAGING_COLUMNS) for r in rows])
+    chunks = [(r["username"], *c) for r in rows for c in r["chunks"]]
+    if chunks:
+        await raw.copy_records_to_table("import_chunks", columns=CHUNK_COLUMNS, records=chunks)
+    inserted = set((await db.execute(MERGE)).scalars())
+    await db.commit()
+    return inserted
+
+
+class ImportStats:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.counts = {"inserted": 0, "exists": 0, "duplicate": 0, "invalid": 0, "unavailable": 0}
+
+    def report(self) -> dict:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        total = sum(self.counts.values())
+        return {**self.counts, "seconds": round(elapsed, 2), "records_per_minute": round(total / elapsed * 60)}
+
+
+async def import_records(records, hashing: str = "hash", batch: int = 5000, stats: ImportStats | None = None):
+    """Imports an async iterable of record dicts. Yields a report entry for every row that was not inserted,
+    {"row", "username", "status": exists | duplicate | invalid | unavailable, "detail"}, rows are numbered from 1 in input order.
+    unavailable rows belong to a bucket that is being moved between shards, importing them again later works"""
+
+    stats = stats or ImportStats()
+    pending, seen = [], set()
+
+    async def flush():
+        await hash_keys(pending, hashing)
+        await store_ciphertext(pending)
+
+        #? The map is checked right before the copy, hashing a batch can take longer than a move needs to start
+        await shard_router.ensure_loaded()
+        by_shard, copied = {}, []
+        for r in pending:
+            if not shard_router.writable(r["username"]):
+                stats.counts["unavailable"] += 1
+                yield {"row": r["row_no"], "username": r["username"], "status": "unavailable", "detail": "the user's bucket is being moved to another shard"}
+                continue
+            by_shard.setdefault(shard_router.shard_for(r["username"]), []).append(r)
+            copied.append(r)
+
+        inserted = set()
+        for shard, rows in by_shard.items():
+            async with shard.session() as db:
+                inserted |= await copy_batch(db, rows)
+
+        stats.counts["inserted"] += len(inserted)
+        for r in copied:
+            if r["username"] not in inserted:
+                stats.counts["exists"] += 1
+                yield {"row": r["row_no"], "username": r["username"], "status": "exists", "detail": "username is already taken"}
+        pending.clear()
+        seen.clear()
+
+    row_no = 0
+    async for record in records:
+        row_no += 1
+        try:
+            row = parse_record(record)
+        except RowError as err:
+            stats.counts["invalid"] += 1
+            yield {"row": row_no, "username": record.get("username"), "status": "invalid", "detail": str(err)}
+            continue
+
+        if row["username"] in seen:
+            #? Within a batch the first row wins, later batches find it taken and report "exists"
+            stats.counts["duplicate"] += 1
+            yield {"row": row_no, "username": row["username"], "status": "duplicate", "detail": "username repeats in the input"}
+            continue
+
+        seen.add(row["username"])
+        row["row_no"] = row_no
+        pending.append(row)
+        if len(pending) >= batch:
+            async for entry in flush():
+                yield entry
+
+    if pending:
+        async for entry in flush():
+            yield entry
+
+
+async def read_ndjson(chunks):
+    """Records from an async stream of bytes, one JSON object per line. A line that is not JSON yields {} and is reported invalid"""
+
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse_line(line)
+    if buffer.strip():
+        yield parse_line(buffer)
+
+
+def parse_line(line: bytes) -> dict:
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return {}
+    return record if isinstance(record, dict) else {}
+
+
+async def read_frames(chunks):
+    """Records from the length prefixed binary export format, the ciphertext as bytes"""
+
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= FRAME_HEADER.size:
+            (header_len,) = FRAME_HEADER.unpack_from(buffer)
+            if len(buffer) < FRAME_HEADER.size + header_len:
+                break
+            header = json.loads(buffer[FRAME_HEADER.size:FRAME_HEADER.size + header_len])
+            sizes = [header.get("encrypted_data_size") or 0, *(c["size"] for c in header.get("chunks", []))]
+            end = FRAME_HEADER.size + header_len + sum(sizes)
+            if len(buffer) < end:
+                break
+
+            pos = FRAME_HEADER.size + header_len
+            if header.get("encrypted_data_size") is not None:
+                header["encrypted_data"] = bytes(buffer[pos:pos + sizes[0]])
+            pos += sizes[0]
+            for c, size in zip(header.get("chunks", []), sizes[1:]):
+                c["data"] = bytes(buffer[pos:pos + size])
+                pos += size
+            del buffer[:end]
+            yield header
+
+    if buffer:
+        raise ValueError("input ends in the middle of a record")
+
+
+async def gunzip(chunks):
+    """Decompresses a gzip stream of any number of members, as DB/export.py writes them"""
+
+    z = zlib.decompressobj(47) #? 32 + 15, gzip or zlib header detected
+    async for chunk in chunks:
+        while chunk:
+            yield z.decompress(chunk)
+            chunk = z.unused_data #? The next member starts here
+            if z.eof:
+                z = zlib.decompressobj(47)
+            else:
+                chunk = b""
+
+
+READERS = {"ndjson": read_ndjson, "binary": read_frames}
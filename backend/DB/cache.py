@@ -0,0 +1,8 @@
+import redis.asyncio as redis
+from config.configs import settings
+
+#? Shared redis connection, None when REDIS_URL isn't set so every caller has to work without it
+redis_client = redis.from_url(settings.redis_url, socket_timeout=0.25, socket_connect_timeout=0.25) if settings.redis_url else None
+
+def get_redis():
+    return redis_client
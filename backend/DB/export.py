@@ -0,0 +1,211 @@
+import heapq
+import json
+import struct
+import time
+import zlib
+from base64 import b64encode
+from collections import deque
+from contextlib import AsyncExitStack
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+from DB.blobstore import blob_store
+from DB.shards import shard_router
+from Models.models import User, Vault, VaultChunk
+
+#? Bulk export of every user with their vault, for backups and moving tenants. One record per user in id order, so the
+#? last id written is a checkpoint: exporting again with after=<that id> continues where a broken run stopped.
+#?
+#? ndjson: one JSON object per line, binary fields base64 encoded.
+#? binary: per record a 4 byte big endian header length, the JSON header, then the raw ciphertext followed by each
+#? chunk's bytes. The header carries their sizes instead of the data, so nothing is base64 inflated.
+
+FORMATS = {"ndjson": "application/x-ndjson", "binary": "application/octet-stream"}
+FRAME_HEADER = struct.Struct(">I")
+
+
+def record_header(row, chunks: list) -> dict:
+    return {
+        "id": row.id,
+        "username": row.username,
+        "salt_b64": row.salt_b64,
+        "hashed_key_a": row.hashed_key_a, #? Server side argon2 hash, an import must store it as is and not hash it again
+        "created_at": row.created_at.isoformat(),
+        "nonce_b64": row.nonce_b64,
+        "version": row.version,
+        "manifest": row.manifest,
+        "chunks": [{"hash": c.chunk_hash, "nonce_b64": c.nonce_b64} for c in chunks],
+    }
+
+
+def encode_ndjson(row, ciphertext: bytes | None, chunks: list) -> bytes:
+    record = record_header(row, chunks)
+    record["encrypted_data"] = b64encode(ciphertext).decode("ascii") if ciphertext is not None else None
+    for out, c in zip(record["chunks"], chunks):
+        out["data"] = b64encode(c.encrypted_data).decode("ascii")
+    return json.dumps(record).encode("utf-8") + b"\n"
+
+
+def encode_binary(row, ciphertext: bytes | None, chunks: list) -> bytes:
+    record = record_header(row, chunks)
+    record["encrypted_data_size"] = len(ciphertext) if ciphertext is not None else None
+    for out, c in zip(record["chunks"], chunks):
+        out["size"] = len(c.encrypted_data)
+
+    header = json.dumps(record).encode("utf-8")
+    return b"".join([FRAME_HEADER.pack(len(header)), header, ciphertext or b"", *(c.encrypted_data for c in chunks)])
+
+
+ENCODERS = {"ndjson": encode_ndjson, "binary": encode_binary}
+
+
+async def chunks_for(db: AsyncSession, rows) -> dict[int, list]:
+    """Chunks of the chunked vaults in one batch, in manifest order. Chunks no manifest points to are left out"""
+
+    manifests = {r.id: r.manifest for r in rows if r.manifest}
+    if not manifests:
+        return {}
+
+    stmt = Select(VaultChunk.user_id, VaultChunk.chunk_hash, VaultChunk.encrypted_data, VaultChunk.nonce_b64).where(VaultChunk.user_id.in_(manifests))
+    found = {}
+    for c in (await db.execute(stmt)).all():
+        found[(c.user_id, c.chunk_hash)] = c
+
+    return {user_id: [found[(user_id, h)] for h in manifest if (user_id, h) in found] for user_id, manifest in manifests.items()}
+
+
+class ShardCursor:
+    """Rows of one shard's export query, fetched a partition at a time"""
+
+    def __init__(self, index: int, db: AsyncSession, result):
+        self.index = index
+        self.db = db
+        self.partitions = result.partitions()
+        self.rows = deque()
+
+    async def peek(self):
+        if not self.rows:
+            try:
+                self.rows.extend(await anext(self.partitions))
+            except StopAsyncIteration:
+                pass
+        return self.rows[0] if self.rows else None
+
+
+async def merged_rows(cursors: list[ShardCursor], batch: int):
+    """Batches of (cursor, row) in user id order over every shard. A user that a move left on two shards only comes
+    from the shard the map assigns it to"""
+
+    heads = []
+    for c in cursors:
+        row = await c.peek()
+        if row is not None:
+            heads.append((row.id, c.index, c))
+    heapq.heapify(heads)
+
+    picked = []
+    while heads:
+        _, _, c = heads[0]
+        row = c.rows.popleft()
+        if shard_router.shard_for(row.username).index == c.index:
+            picked.append((c, row))
+
+        nxt = await c.peek()
+        if nxt is None:
+            heapq.heappop(heads)
+        else:
+            heapq.heapreplace(heads, (nxt.id, c.index, c))
+
+        if len(picked) == batch:
+            yield picked
+            picked = []
+    if picked:
+        yield picked
+
+
+async def export_batches(fmt: str, after: int | None = None, batch: int = 500):
+    """Yields (last user id, record count, encoded records) per batch. Memory stays at one batch of rows per shard, whatever the table size"""
+
+    encode = ENCODERS[fmt]
+    await shard_router.ensure_loaded()
+
+    stmt = (
+        Select(User.id, User.username, User.salt_b64, User.hashed_key_a, User.created_at,
+               Vault.encrypted_data, Vault.blob_hash, Vault.nonce_b64, Vault.version, Vault.manifest)
+        .outerjoin(Vault, Vault.user_id == User.id)
+        .order_by(User.id)
+        .execution_options(yield_per=batch)
+    )
+    if after is not None:
+        stmt = stmt.where(User.id > after)
+
+    async with AsyncExitStack() as stack:
+        cursors = []
+        for shard in shard_router.shards:
+            #! Own session, ideally a replica: the export is one long transaction, on the primary it holds back vacuum
+            db = await stack.enter_async_context(shard.read_session())
+            #? One snapshot per shard for the whole run, the chunk reads see the same manifests as the cursor
+            await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+            cursors.append(ShardCursor(shard.index, db, await db.stream(stmt)))
+
+        #? Ids are unique across shards (DB/shards.py), so the merged order is the same keyset a resumed export continues
+        async for picked in merged_rows(cursors, batch):
+            chunks = {}
+            for c in {c for c, _ in picked}:
+                chunks.update(await chunks_for(c.db, [r for owner, r in picked if owner is c]))
+
+            out = []
+            for _, r in picked:
+                ciphertext = r.encrypted_data
+                if r.blob_hash is not None:
+                    ciphertext = await blob_store.get(r.blob_hash)
+                out.append(encode(r, ciphertext, chunks.get(r.id, [])))
+            yield picked[-1][1].id, len(picked), b"".join(out)
+
+
+class GzipMembers:
+    """gzip output as a series of complete members, one per finish(). Concatenated members are a valid gzip file, so
+    the output can be cut after any finished member and a resumed export appended to it"""
+
+    def __init__(self, level: int = 6):
+        self.level = level
+        self.z = None
+
+    def compress(self, data: bytes) -> bytes:
+        if self.z is None:
+            self.z = zlib.compressobj(self.level, zlib.DEFLATED, 31) #? wbits 31 writes the gzip header and trailer
+        return self.z.compress(data)
+
+    def finish(self) -> bytes:
+        if self.z is None:
+            return b""
+        tail, self.z = self.z.flush(), None
+        return tail
+
+
+class Throughput:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.records = 0
+        self.raw_bytes = 0
+        self.bytes = 0
+
+    def add(self, records: int, raw_bytes: int, written: int):
+        self.records += records
+        self.raw_bytes += raw_bytes
+        self.bytes += written
+
+    def report(self) -> str:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return (f"{self.records} records, {self.raw_bytes / 2**20:.1f} MiB ({self.bytes / 2**20:.1f} MiB written) in {elapsed:.1f}s, "
+                f"{self.records / elapsed:.0f} records/s, {self.raw_bytes / 2**20 / elapsed:.1f} MiB/s")
+
+
+async def export_stream(fmt: str, after: int | None, batch: int, gzip: bool, progress: Throughput):
+    """Yields (last user id, output bytes) per batch, each batch a complete gzip member when compressing"""
+
+    z = GzipMembers() if gzip else None
+    async for last_id, count, data in export_batches(fmt, after, batch):
+        out = z.compress(data) + z.finish() if z else data
+        progress.add(count, len(data), len(out))
+        yield last_id, out
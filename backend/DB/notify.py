@@ -0,0 +1,90 @@
+import asyncio
+import asyncpg
+from sqlalchemy.engine import make_url
+from DB.sessions import SHARD_URLS
+from utils.logger import logger
+
+VAULT_CHANNEL = "vault_changes" #! Must match the trigger in the 0ce69cc29484 migration
+#? Every shard's primary, a vault write notifies on the shard that holds the user
+LISTEN_DSNS = [make_url(url).set(drivername="postgresql").render_as_string(hide_password=False) for url, _ in SHARD_URLS]
+
+
+class VaultEvents:
+    """One LISTEN connection per shard and worker, fanned out to a queue per connected device"""
+
+    def __init__(self, dsns: list[str] = LISTEN_DSNS, channel: str = VAULT_CHANNEL, queue_size: int = 16):
+        self.dsns = dsns
+        self.channel = channel
+        self.queue_size = queue_size
+        self.subscribers: dict[int, set[asyncio.Queue]] = {}
+        self.conns = {}
+        self.lock = asyncio.Lock()
+        self.reconnecting = None
+
+    async def start(self):
+        async with self.lock:
+            for dsn in self.dsns:
+                conn = self.conns.get(dsn)
+                if conn is not None and not conn.is_closed():
+                    continue
+
+                conn = await asyncpg.connect(dsn)
+                await conn.add_listener(self.channel, self.on_notify)
+                conn.add_termination_listener(self.on_terminate)
+                self.conns[dsn] = conn
+                logger.info("Listening on %s at %s", self.channel, make_url(dsn).host)
+
+    async def stop(self):
+        async with self.lock:
+            for conn in self.conns.values():
+                if not conn.is_closed():
+                    await conn.close()
+            self.conns = {}
+
+    def on_notify(self, conn, pid, channel, payload: str):
+        try:
+            user_id, vault_id, version = (int(x) for x in payload.split(":"))
+        except ValueError:
+            logger.warning("Bad payload on %s: %s", channel, payload)
+            return
+
+        for q in self.subscribers.get(user_id, ()):
+            if q.full(): #? Only the newest version matters to a device, drop the oldest one
+                q.get_nowait()
+            q.put_nowait((vault_id, version))
+
+    def on_terminate(self, conn):
+        self.conns = {dsn: c for dsn, c in self.conns.items() if c is not conn}
+        if self.subscribers and self.reconnecting is None:
+            self.reconnecting = asyncio.get_running_loop().create_task(self.reconnect())
+
+    async def reconnect(self):
+        delay = 0.5
+        try:
+            while self.subscribers:
+                try:
+                    await self.start()
+                    return
+                except Exception as err:
+                    logger.error("Reconnecting the vault listener failed, %s", err)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30)
+        finally:
+            self.reconnecting = None
+
+    async def subscribe(self, user_id: int) -> asyncio.Queue:
+        await self.start()
+        q = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, user_id: int, q: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(q)
+        if not queues:
+            del self.subscribers[user_id]
+
+
+vault_events = VaultEvents()
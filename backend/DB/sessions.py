@@ -1,16 +1,162 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import psycopg2
+import time
+import asyncio
+import logging
+import itertools
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from config.configs import settings
+from utils.metrics import install_sql_hooks, observe_pool_wait, observe_replica_fallback, register_gauges
 
-DATABASE_URL = settings.database_url
+DATABASE_URL = settings.database_url #? Sync url, still used by alembic
+REPLICA_URLS = [url.strip() for url in settings.replica_urls.split(",") if url.strip()]
 
-engine = create_engine(url=DATABASE_URL, echo=True)
-sessionmaker = sessionmaker(bind=engine, autoflush=False, expire_on_commit=True)
+def async_url(url: str) -> str:
+    return make_url(url).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
 
-def get_db():
-    db = sessionmaker()
-    try:
+ASYNC_DATABASE_URL = async_url(DATABASE_URL)
+
+class TimedPool(AsyncAdaptedQueuePool):
+    """Queue pool that reports how long each checkout waited for a free connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            observe_pool_wait(time.perf_counter() - start)
+
+
+def make_engine(url: str):
+    eng = create_async_engine(
+        url=async_url(url),
+        echo=False, #! echo adds its own handler writing to stdout on the event loop, db_echo raises the logger level instead
+        poolclass=TimedPool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
+    )
+    install_sql_hooks(eng.sync_engine)
+    return eng
+
+
+if settings.db_echo:
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
+
+def parse_shard_urls(value: str) -> list[tuple[str, list[str]]]:
+    """"primary_a|replica_a,primary_b" -> [(primary_a, [replica_a]), (primary_b, [])]"""
+    shards = []
+    for entry in value.split(","):
+        urls = [url.strip() for url in entry.split("|") if url.strip()]
+        if urls:
+            shards.append((urls[0], urls[1:]))
+    return shards
+
+#? Shard 0 is DATABASE_URL with its REPLICA_URLS, the only one unless SHARD_URLS adds more. Users are spread over them
+#? by DB/shards.py. Sync urls, alembic migrates each of them
+SHARD_URLS = [(DATABASE_URL, REPLICA_URLS), *parse_shard_urls(settings.shard_urls)]
+
+
+class Shard:
+    """Primary engine and read replicas of one of the databases the users are spread over"""
+
+    def __init__(self, index: int, url: str, replica_urls: list[str]):
+        self.index = index
+        #! expire_on_commit must stay False, an expired attribute would need lazy IO which async sessions can't do
+        self.engine = make_engine(url)
+        self.session = async_sessionmaker(bind=self.engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+        #? Read replicas take the lag tolerant reads. Without replicas every read goes to the primary
+        self.replica_engines = [make_engine(url) for url in replica_urls]
+        self.replica_sessions = [async_sessionmaker(bind=eng, class_=AsyncSession, autoflush=False, expire_on_commit=False) for eng in self.replica_engines]
+        self._read_sessions = itertools.cycle(self.replica_sessions or [self.session])
+
+    @property
+    def engines(self) -> list:
+        return [self.engine, *self.replica_engines]
+
+    def read_session(self) -> AsyncSession:
+        """Session on the next replica, round robin. Anything read here can be behind the primary"""
+        return next(self._read_sessions)()
+
+
+shards = [Shard(i, url, replicas) for i, (url, replicas) in enumerate(SHARD_URLS)]
+has_replicas = any(shard.replica_sessions for shard in shards)
+
+#? Shard 0 under the names everything used before sharding. It holds the shard map, and every user until buckets are
+#? moved off it
+engine = shards[0].engine
+async_session = shards[0].session
+replica_engines = shards[0].replica_engines
+
+async def get_db():
+    async with async_session() as db:
         yield db
-    finally:
-        db.close()
+
+def read_session() -> AsyncSession:
+    return shards[0].read_session()
+
+async def get_replica_db():
+    async with read_session() as db:
+        yield db
+
+#? Without replicas the read dependency is get_db itself, so FastAPI hands a route and get_current_user the same session
+get_read_db = get_replica_db if shards[0].replica_sessions else get_db
+
+def shard_of(db: AsyncSession) -> Shard:
+    return next(shard for shard in shards if db.bind in shard.engines)
+
+def on_primary(db: AsyncSession) -> bool:
+    return any(db.bind is shard.engine for shard in shards)
+
+async def read_primary(stmt, reason: str, shard: Shard = shards[0]):
+    """Runs a read again on the primary, for a replica answer that is missing or older than what the client has seen"""
+
+    observe_replica_fallback(reason)
+    async with shard.session() as db:
+        return (await db.execute(stmt)).one_or_none()
+
+async def read_fresh(db: AsyncSession, stmt, min_version: int = 0):
+    """One row from a read session. Falls back to the shard's primary when the replica has no row, or has one older than min_version"""
+
+    row = (await db.execute(stmt)).one_or_none()
+    if on_primary(db):
+        return row
+    if row is None:
+        return await read_primary(stmt, "missing", shard_of(db))
+    if min_version and row.version < min_version:
+        return await read_primary(stmt, "stale", shard_of(db))
+    return row
+
+async def read_all_shards(stmt) -> list[list]:
+    """The rows of stmt from every shard, read concurrently, one list per shard"""
+
+    async def read(shard: Shard):
+        async with shard.read_session() as db:
+            return (await db.execute(stmt)).all()
+
+    return await asyncio.gather(*(read(shard) for shard in shards))
+
+def engine_pool_status(eng) -> dict:
+    pool = eng.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": settings.db_max_overflow,
+        "saturation": round(pool.checkedout() / (pool.size() + settings.db_max_overflow), 4),
+    }
+
+def pool_status() -> dict:
+    return engine_pool_status(engine)
+
+register_gauges("occultus_db_pool", "Connection pool", pool_status)
+for i, eng in enumerate(replica_engines):
+    register_gauges(f"occultus_db_replica{i}_pool", f"Connection pool of replica {i}", lambda eng=eng: engine_pool_status(eng))
+for shard in shards[1:]:
+    register_gauges(f"occultus_db_shard{shard.index}_pool", f"Connection pool of shard {shard.index}", lambda eng=shard.engine: engine_pool_status(eng))
+    for i, eng in enumerate(shard.replica_engines):
+        register_gauges(f"occultus_db_shard{shard.index}_replica{i}_pool", f"Connection pool of shard {shard.index} replica {i}", lambda eng=eng: engine_pool_status(eng))
@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import time
+from sqlalchemy import Select, literal_column
+from DB.sessions import shards, Shard, async_session
+from Models.models import ShardBucket
+from utils.logger import logger
+from utils.metrics import register_gauges
+from config.configs import settings
+
+#? Users are spread over the shards in buckets: a stable hash of the username picks one of BUCKETS buckets, and the
+#? shard map (the shard_buckets table on shard 0) says which shard holds each bucket. The username is the JWT sub, so
+#? a request finds its shard from the token alone. scripts.rebalance moves whole buckets between shards.
+#?
+#? Ids stay unique across shards: every shard's sequences step by ID_STRIDE from their own offset (migration
+#? 9f3b2d7c41e8), and a moved user keeps its id. Caches keyed by user id need no shard in the key.
+
+BUCKETS = 1024 #! Fixed for good, a different count would put nearly every user in another bucket
+ID_STRIDE = 64 #! Most shards there can be, must match the 9f3b2d7c41e8 migration
+MAP_LEASE = 3 #? Sync intervals a loaded map is trusted for writes
+
+#! Same hash as bucket_of, in SQL. The ix_users_bucket expression index is on exactly this expression
+BUCKET_SQL = "(('x' || substr(md5(username), 1, 7))::bit(28)::int % 1024)"
+bucket_column = literal_column(BUCKET_SQL)
+
+
+def bucket_of(username: str) -> int:
+    return int(hashlib.md5(username.encode("utf-8"), usedforsecurity=False).hexdigest()[:7], 16) % BUCKETS
+
+
+class ShardUnavailable(Exception):
+    pass
+
+
+class ShardRouter:
+    """The shard map of this worker, reloaded from shard 0 every sync interval.
+
+    Writes to a bucket that is being moved are refused, and so is every write once the map is older than MAP_LEASE
+    sync intervals: a worker that can't reload the map can't be sure a move hasn't started. scripts.rebalance waits
+    out that lease after each change to the map, so by then no worker still writes by the old one. Reads keep going by
+    the last map loaded."""
+
+    def __init__(self, shards: list[Shard]):
+        self.shards = shards
+        self.assigned: dict[int, int] = {}
+        self.moving: dict[int, int] = {}
+        self.loaded_at = None
+        self.sync_seconds = settings.shard_map_sync_seconds
+        self.task = None
+        self.counters = {"syncs": 0, "sync_errors": 0, "refused_writes": 0}
+
+        if len(shards) > ID_STRIDE:
+            raise ValueError(f"At most {ID_STRIDE} shards, ids are spaced {ID_STRIDE} apart")
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.shards) > 1
+
+    @property
+    def lease(self) -> float:
+        return self.sync_seconds * MAP_LEASE
+
+    def shard_for(self, username: str) -> Shard:
+        if not self.sharded:
+            return self.shards[0]
+        if self.loaded_at is None:
+            raise ShardUnavailable("the shard map hasn't loaded yet")
+        return self.shards[self.assigned.get(bucket_of(username), 0)]
+
+    def writable(self, username: str) -> bool:
+        if not self.sharded:
+            return True
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.lease:
+            return False
+        return bucket_of(username) not in self.moving
+
+    def check_writable(self, username: str):
+        if not self.writable(username):
+            self.counters["refused_writes"] += 1
+            bucket = bucket_of(username)
+            if bucket in self.moving:
+                raise ShardUnavailable(f"bucket {bucket} is moving to shard {self.moving[bucket]}")
+            raise ShardUnavailable("the shard map is out of date")
+
+    async def sync(self):
+        started = time.monotonic() #? The lease runs from before the read, a change committed during it is caught next time
+
+        async with async_session() as db:
+            rows = (await db.execute(Select(ShardBucket.bucket, ShardBucket.shard, ShardBucket.moving_to))).all()
+
+        unknown = {r.shard for r in rows} | {r.moving_to for r in rows if r.moving_to is not None}
+        unknown = {i for i in unknown if not 0 <= i < len(self.shards)}
+        if unknown:
+            #! The map names shards this worker has no url for. Keeping the old map lets its lease run out, writes stop
+            raise ValueError(f"Shard map uses shards {sorted(unknown)}, SHARD_URLS only has {len(self.shards)}")
+
+        self.assigned = {r.bucket: r.shard for r in rows if r.shard != 0}
+        self.moving = {r.bucket: r.moving_to for r in rows if r.moving_to is not None}
+        self.loaded_at = started
+        self.counters["syncs"] += 1
+
+    async def ensure_loaded(self):
+        """For scripts, which don't run the sync loop"""
+        if self.sharded and (self.loaded_at is None or time.monotonic() - self.loaded_at > self.sync_seconds):
+            await self.sync()
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync()
+            except Exception as err:
+                self.counters["sync_errors"] += 1
+                logger.error("Shard map sync failed, %s", err)
+
+    async def start(self, interval: float):
+        if not self.sharded or self.task is not None:
+            return
+        self.sync_seconds = interval
+        try:
+            await self.sync() #? Before the first request, the map decides where every user is
+        except Exception as err:
+            self.counters["sync_errors"] += 1
+            logger.error("Could not load the shard map, requests get 503 until it loads, %s", err)
+        self.task = asyncio.create_task(self.run(interval))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> dict:
+        age = time.monotonic() - self.loaded_at if self.loaded_at is not None else -1
+        return {**self.counters, "shards": len(self.shards), "moved_buckets": len(self.assigned), "moving_buckets": len(self.moving), "map_age_seconds": round(age, 1)}
+
+
+shard_router = ShardRouter(shards)
+
+register_gauges("occultus_shard_map", "Bucket to shard map", shard_router.stats)
@@ -1,4 +1,5 @@
-from sqlalchemy import BigInteger, TIMESTAMP, Text, text, ForeignKey, LargeBinary
+from sqlalchemy import BigInteger, Integer, TIMESTAMP, Text, text, ForeignKey, LargeBinary, String, UniqueConstraint
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship
 from datetime import datetime as dt
 
@@ -23,8 +24,32 @@ class Vault(Base):
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), unique=True, nullable=False)
-    encrypted_data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    encrypted_data: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True) #? NULL when the ciphertext lives in the blob store
+    blob_hash: Mapped[str | None] = mapped_column(String(64), nullable=True) #! sha256 hex of the ciphertext in the blob store
+    blob_size: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
     nonce_b64: Mapped[str] = mapped_column(nullable=False)
     version: Mapped[int] = mapped_column(BigInteger, nullable=False, default=1)
+    manifest: Mapped[list[str] | None] = mapped_column(ARRAY(String), nullable=True) #? Ordered chunk hashes, only set for chunked vaults
+
+    user: Mapped["User"] = relationship("User", back_populates="vault")
+
+class VaultChunk(Base):
+
+    __tablename__ = "vault_chunks"
+    __table_args__ = (UniqueConstraint("user_id", "chunk_hash"),)
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    chunk_hash: Mapped[str] = mapped_column(String(64), nullable=False) #! sha256 hex of encrypted_data
+    encrypted_data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    nonce_b64: Mapped[str] = mapped_column(nullable=False)
+
+class ShardBucket(Base):
+    #? Only read on shard 0. A bucket without a row lives on shard 0
+
+    __tablename__ = "shard_buckets"
 
-    user: Mapped["User"] = relationship("User", back_populates="vault")
\ No newline at end of file
+    bucket: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    shard: Mapped[int] = mapped_column(Integer, nullable=False)
+    moving_to: Mapped[int | None] = mapped_column(Integer, nullable=True) #! Set while scripts.rebalance moves the bucket, its writes are refused
+    updated_at: Mapped[dt] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
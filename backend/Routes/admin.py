@@ -0,0 +1,73 @@
+import secrets
+import zlib
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request
+from fastapi.responses import StreamingResponse
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_503_SERVICE_UNAVAILABLE
+from DB.export import export_stream, Throughput, FORMATS
+from DB.bulk_import import import_records, ImportStats, READERS, gunzip
+from utils.hashing import HashingBusy
+from config.configs import settings
+from utils.logger import logger
+from utils.serialization import JSONResponseClass
+
+router = APIRouter(prefix="/admin")
+
+
+async def require_admin(x_admin_token: str | None = Header(default=None)):
+    #! 404 and not 401, the admin routes don't exist as far as anyone without the token can tell
+    if not settings.admin_token or x_admin_token is None or not secrets.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Not Found")
+
+
+@router.get('/export', dependencies=[Depends(require_admin)])
+async def export_users(format: str = Query(default="ndjson", pattern="^(ndjson|binary)$"), after: int | None = Query(default=None, ge=0), gzip: bool = False):
+    """Every user with their vault, streamed in id order. Keep the id of the last complete record, after=<id> resumes from there.
+    With gzip=true every batch is its own gzip member, so a cut off download is readable up to its last complete member"""
+
+    progress = Throughput()
+
+    async def body():
+        last_id = after
+        try:
+            async for last_id, out in export_stream(format, after, settings.export_batch, gzip, progress):
+                yield out
+        finally:
+            logger.info("Export after=%s stopped at user %s: %s", after, last_id, progress.report())
+
+    media_type = "application/gzip" if gzip else FORMATS[format]
+    return StreamingResponse(body(), media_type=media_type)
+
+
+MAX_REPORT_ROWS = 10000
+
+
+@router.post('/import', dependencies=[Depends(require_admin)])
+async def import_users(request: Request, format: str = Query(default="ndjson", pattern="^(ndjson|binary)$"), hashing: str = Query(default="hash", pattern="^(hash|defer)$"), batch: int = Query(default=None, ge=1, le=100000)):
+    """Bulk account import, the body is a stream of records (see DB/bulk_import.py), gzip with Content-Encoding: gzip.
+    Answers once everything is merged with the counts and every row that was not inserted, up to MAX_REPORT_ROWS"""
+
+    chunks = request.stream()
+    if request.headers.get("content-encoding", "").lower() == "gzip":
+        chunks = gunzip(chunks)
+
+    stats = ImportStats()
+    rows = []
+    try:
+        async for entry in import_records(READERS[format](chunks), hashing, batch or settings.import_batch, stats):
+            if len(rows) < MAX_REPORT_ROWS:
+                rows.append(entry)
+    #? Batches merged before the import stopped stay, the report says how far it got
+    except (ValueError, zlib.error) as err:
+        logger.warning("Import stopped on unreadable input, %s", err)
+        return JSONResponseClass({"summary": stats.report(), "error": f"Unreadable input: {err}", "rows": rows}, status_code=HTTP_400_BAD_REQUEST)
+    except HashingBusy:
+        logger.warning("Import stopped, the hashing queue stayed full: %s", stats.report())
+        return JSONResponseClass({"summary": stats.report(), "error": "Hashing is busy, import the remaining rows again later", "rows": rows},
+                                 status_code=HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "60"})
+    except Exception as err:
+        logger.error("Import stopped, %s: %s", err, stats.report())
+        return JSONResponseClass({"summary": stats.report(), "error": "Server error, import the remaining rows again", "rows": rows}, status_code=HTTP_500_INTERNAL_SERVER_ERROR)
+
+    summary = stats.report()
+    logger.info("Import with hashing=%s: %s", hashing, summary)
+    return JSONResponseClass({"summary": summary, "rows": rows, "truncated": sum(summary[k] for k in ("exists", "duplicate", "invalid")) > len(rows)})
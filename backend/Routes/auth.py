@@ -1,5 +1,5 @@
 from fastapi import APIRouter, HTTPException, Depends, Response
-from starlette.status import HTTP_403_FORBIDDEN, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_401_UNAUTHORIZED
+from starlette.status import HTTP_403_FORBIDDEN, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_401_UNAUTHORIZED, HTTP_503_SERVICE_UNAVAILABLE
 from jose import jwt
 from jose.exceptions import JWTError
 from fastapi.security import OAuth2PasswordBearer
@@ -7,30 +7,36 @@ from pydantic import BaseModel
 from dotenv import load_dotenv
 import os
 load_dotenv()
-from schemas.schemas import Token, UserBase, UserLogin
+from schemas.schemas import Token, UserBase, UserLogin, CurrentUser
 import secrets, base64
 from argon2.low_level import hash_secret_raw, Type
-from DB.sessions import get_db
-from sqlalchemy.orm import Session
-from sqlalchemy import Select
+from DB.sessions import Shard, has_replicas, read_fresh, shard_of
+from DB.shards import shard_router, ShardUnavailable, bucket_of
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import Select, update
 from Models.models import User
 from utils.logger import logger
+from utils.cache import user_cache
+from utils.hashing import key_hasher, HashingBusy
 import secrets, base64
 from typing import Union, Any
 from datetime import datetime, timedelta, timezone
-from fastapi_limiter import FastAPILimiter
-from fastapi_limiter.depends import RateLimiter
+from utils.ratelimit import RouteLimit
+from utils.serialization import JSONResponseClass, FAST_JSON
+from utils.tokens import verified_tokens, refresh_families, TokenStoreUnavailable
+from config.configs import settings
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("EXPIRE_MINUTES")) #! converting it into int just in case if it is stored as string
-REFRESH_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
+REFRESH_TOKEN_EXPIRE_MINUTES = settings.refresh_token_minutes
 
 router = APIRouter()
 oauth2 = OAuth2PasswordBearer(tokenUrl="token")
 
 class TokenData(BaseModel):
     username: str | None = None
+    family: str | None = None
 
 #!---------------Must be put in frontend later on ------------------------------
 # def make_hashed_password(entered_password: str, salt_b64: str) -> str:
@@ -56,12 +62,15 @@ class TokenData(BaseModel):
 
 #!--------------------------------------------------------------------------------------
 
-@router.post('/auth/salt') #? Returns the salt in  base64 format
-def check_salt(u: UserBase, db: Session = Depends(get_db)):
+@router.post('/auth/salt', dependencies=[Depends(RouteLimit(settings.rate_limit_salt))]) #? Returns the salt in  base64 format
+async def check_salt(u: UserBase):
+    shard = user_shard(u.username)
 
     try: 
-        stmt = Select(User).where(User.username == u.username)
-        res = db.execute(stmt).scalar_one_or_none()
+        #! A replica miss goes to the primary, a user registered a moment ago must get the real salt and not a random one
+        stmt = Select(User.salt_b64).where(User.username == u.username)
+        async with shard.read_session() as db:
+            res = await read_fresh(db, stmt)
 
         if res:
             return{"salt" : res.salt_b64}
@@ -72,7 +81,7 @@ def check_salt(u: UserBase, db: Session = Depends(get_db)):
 
 
     except Exception as err:
-        logger.error(f"There is error in check_salt function, {err}")
+        logger.error("There is error in check_salt function, %s", err)
         raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail='Error in the server')
 
 def create_access_token(data: dict, expires_delta: int = None):
@@ -101,69 +110,162 @@ def create_refresh_token(data: dict, expires_delta: int = None):
     return encoded_jwt
 
 
+async def issue_tokens(username: str) -> dict:
+    """Access and refresh token pair for a new login. Both carry the family id, revoking the family ends the session"""
+
+    family = secrets.token_urlsafe(16)
+    jti = secrets.token_urlsafe(16)
+    await refresh_families.start_family(family, jti)
+
+    return {
+        "access_token": create_access_token(data={"sub": username, "fam": family}),
+        "refresh_token": create_refresh_token(data={"sub": username, "fam": family, "jti": jti}),
+        "token_type": "bearer"
+    }
+
+
 def verify_token(token: str, credential_exception):
-    try:
+    #? Same token on every request until it expires, the signature only needs checking once
+    payload = verified_tokens.get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            raise credential_exception
 
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        payload_name = payload.get("sub")
+        if payload.get("type") != "access": #! A refresh token is not a bearer token
+            raise credential_exception
+        verified_tokens.set(token, payload)
 
-        if not payload_name:
-            raise  HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='No token exists with this id')
+    payload_name = payload.get("sub")
 
-        token_data = TokenData(username=payload_name)
-        return token_data
+    if not payload_name:
+        raise  HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='No token exists with this id')
 
+    token_data = TokenData(username=payload_name, family=payload.get("fam"))
+    return token_data
 
-    except JWTError:
-        raise credential_exception
 
+SHARD_RETRY_AFTER = "5"
+
+def user_shard(username: str, write: bool = False) -> Shard:
+    """The shard holding the user. With write=True it refuses while the user's bucket is being moved to another shard"""
 
-def get_current_user(token: str = Depends(oauth2), db: Session = Depends(get_db)):
+    try:
+        if write:
+            shard_router.check_writable(username)
+        return shard_router.shard_for(username)
+    except ShardUnavailable as err:
+        raise shard_busy(err)
+
+def shard_busy(err: ShardUnavailable) -> HTTPException:
+    logger.warning("Shard unavailable, %s", err)
+    return HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="The account is being moved, try again in a moment", headers={"Retry-After": SHARD_RETRY_AFTER})
+
+def writable_on(db: AsyncSession, username: str) -> bool:
+    """Whether a write to the user on db's shard may commit now, checked again right before the commit: a slow upload
+    or the hashing queue can outlast the lease checked when the request started, and the user's bucket may have started
+    moving or moved to another shard since. scripts.rebalance only waits out the commit itself (WRITE_GRACE)"""
+    return shard_router.writable(username) and shard_router.shard_for(username) is shard_of(db)
+
+async def commit_user_write(db: AsyncSession, username: str):
+    """Commits the user's write, or rolls it back with 503 when writable_on says no"""
+
+    if not writable_on(db, username):
+        shard_router.counters["refused_writes"] += 1
+        await db.rollback()
+        raise shard_busy(ShardUnavailable(f"bucket {bucket_of(username)} is moving or moved"))
+    await db.commit()
+
+def token_username(token: str) -> str:
+    credential_exception = HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Invalid credential detail', headers={"WWW-Authenticate": "Bearer"})
+    return verify_token(token=token, credential_exception=credential_exception).username
+
+#? Sessions on the shard of the user in the bearer token. The sub names the user, so no lookup is needed to find it
+async def get_user_db(token: str = Depends(oauth2)):
+    async with user_shard(token_username(token)).session() as db:
+        yield db
+
+async def get_user_replica_db(token: str = Depends(oauth2)):
+    async with user_shard(token_username(token)).read_session() as db:
+        yield db
+
+#? As with get_read_db: without replicas a route and get_current_user share one session
+get_user_read_db = get_user_replica_db if has_replicas else get_user_db
+
+async def get_user_write_db(token: str = Depends(oauth2), db: AsyncSession = Depends(get_user_db)) -> AsyncSession:
+    user_shard(token_username(token), write=True)
+    return db
+
+
+async def get_current_user(token: str = Depends(oauth2), db: AsyncSession = Depends(get_user_read_db)) -> CurrentUser:
     credential_exception = HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Invalid credential detail', headers={"WWW-Authenticate": "Bearer"})
 
     t = verify_token(token=token, credential_exception=credential_exception)
     if not t:
         raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Invalid token')
 
-    stmt = Select(User).where(User.username == t.username)
-    res = db.execute(stmt).scalar_one_or_none()
+    if t.family and await refresh_families.is_revoked(t.family):
+        raise credential_exception
+
+    cached = await user_cache.get(t.username)
+    if cached is not None:
+        return CurrentUser(**cached)
+
+    stmt = Select(User.id, User.username).where(User.username == t.username)
+    res = await read_fresh(db, stmt)
 
     if not res:
         raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Not authorized to access the resource')
 
-    return res
+    await user_cache.set(res.username, {"id": res.id, "username": res.username})
+    return CurrentUser(id=res.id, username=res.username)
 
 
-@router.post('/login', response_model=Token)
-def func_login(u: UserLogin, db: Session = Depends(get_db)): #! This userlogin model will be received from frontend since all the hashing of key_a will be done on client side. UserLogin needs mail, hashed key
+@router.post('/login', response_model=Token, dependencies=[Depends(RouteLimit(settings.rate_limit_login))])
+async def func_login(u: UserLogin): #! This userlogin model will be received from frontend since all the hashing of key_a will be done on client side. UserLogin needs mail, hashed key
+    async with user_shard(u.username).session() as db:
+        return await login_user(u, db)
+
+async def login_user(u: UserLogin, db: AsyncSession, status_code: int | None = None):
+    """status_code always answers with a JSON response of that status, a replayed registration is a login answering 201"""
     try:
-        stmt = Select(User).where(User.username == u.username)
-        res = db.execute(stmt).scalar_one_or_none()
-        
-        if res:
-            if secrets.compare_digest(res.hashed_key_a, u.hashed_key_a): #? res.hashed_key_a == u.hashed_key_a: Hacker can judge the latency to see where it find the mismatch. cmpare_digest takes same time whether the password is same or not
-
-                access_token = create_access_token(data={"sub": res.username})
-                refresh_token = create_refresh_token(data={"sub": res.username})
-
-                return {
-                    "access_token": access_token,
-                    "refresh_token": refresh_token,
-                    "token_type": "bearer"
-                }
-            else:
-                raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Wrong username or password')
-        else:
+        stmt = Select(User.id, User.username, User.hashed_key_a).where(User.username == u.username)
+        res = (await db.execute(stmt)).one_or_none()
+
+        #? argon2 verify runs in the hashing pool, unknown users are checked against a dummy hash so timing doesn't leak them
+        matched, new_hash = await key_hasher.verify(res.hashed_key_a if res else None, u.hashed_key_a)
+
+        if not matched:
             raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Wrong username or password')
+
+        if new_hash is not None and writable_on(db, res.username):
+            #? Legacy raw key or old argon2 parameters, swap in the new hash transparently. Left for the next login while the user is being moved
+            await db.execute(update(User).where(User.id == res.id, User.hashed_key_a == res.hashed_key_a).values(hashed_key_a=new_hash), execution_options={"synchronize_session": False})
+            await db.commit()
+            await user_cache.invalidate(res.username)
+
+        tokens = await issue_tokens(res.username)
+        if status_code is not None:
+            return JSONResponseClass(tokens, status_code=status_code)
+        return JSONResponseClass(tokens) if FAST_JSON else tokens
     except HTTPException as he:
         raise he
+    except HashingBusy:
+        logger.warning("Login rejected, hashing queue is full")
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail='Too many logins right now, try again', headers={"Retry-After": "1"})
+    except TokenStoreUnavailable:
+        logger.error("Login rejected, the refresh token store is unreachable")
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail='Error in logging in, try again', headers={"Retry-After": "5"})
     except Exception as err:
-        logger.error(f"Error in func_login,{err}")
+        await db.rollback()
+        logger.error("Error in func_login,%s", err)
         raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail='Error in logging in')
 
 
 @router.post("/refresh")
-def refresh_access_tokens(refresh_token: str):
+async def refresh_access_tokens(refresh_token: str):
+    """Rotates the refresh token: the response carries a new one and the one sent here stops working"""
     try:
 
         payload = jwt.decode(token=refresh_token, key=SECRET_KEY, algorithms=[ALGORITHM])
@@ -171,12 +273,50 @@ def refresh_access_tokens(refresh_token: str):
         if payload.get("type") != "refresh":
             raise HTTPException(HTTP_401_UNAUTHORIZED, "Invalid token type")
 
-        username = payload.get("sub")
-        new_access_token = create_access_token(data={"sub": username})
-        
-        return {"access_token": new_access_token, "token_type": "bearer"}
+        username, family, jti = payload.get("sub"), payload.get("fam"), payload.get("jti")
+        if not (username and family and jti):
+            raise HTTPException(HTTP_401_UNAUTHORIZED, "Refresh token is no longer supported, log in again") #? Issued before rotation existed
+
+        if await refresh_families.is_revoked(family):
+            raise HTTPException(HTTP_401_UNAUTHORIZED, "Session was revoked, log in again")
+
+        new_jti = secrets.token_urlsafe(16)
+        result = await refresh_families.rotate(family, jti, new_jti)
+
+        if result == "raced":
+            #? Another tab rotated this token a moment ago, it already holds the new pair
+            raise HTTPException(HTTP_401_UNAUTHORIZED, "Refresh token was just rotated")
+        if result != "ok":
+            raise HTTPException(HTTP_401_UNAUTHORIZED, "Session was revoked, log in again")
+
+        return {
+            "access_token": create_access_token(data={"sub": username, "fam": family}),
+            "refresh_token": create_refresh_token(data={"sub": username, "fam": family, "jti": new_jti}),
+            "token_type": "bearer"
+        }
 
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail="Refresh token expired")
     except JWTError:
         raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+    except TokenStoreUnavailable:
+        logger.error("Refresh rejected, the refresh token store is unreachable")
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Can't refresh right now, try again", headers={"Retry-After": "5"})
+
+
+@router.post("/logout", status_code=204)
+async def logout(token: str = Depends(oauth2)):
+    """Revokes the whole session: its refresh token and every access token issued in it"""
+
+    credential_exception = HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Invalid credential detail', headers={"WWW-Authenticate": "Bearer"})
+    t = verify_token(token=token, credential_exception=credential_exception)
+
+    try:
+        if t.family:
+            await refresh_families.revoke(t.family)
+    except TokenStoreUnavailable:
+        logger.error("Logout failed, the refresh token store is unreachable")
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Can't log out right now, try again", headers={"Retry-After": "5"})
+
+    verified_tokens.pop(token)
+    return Response(status_code=204)
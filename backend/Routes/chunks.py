@@ -0,0 +1,144 @@
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from fastapi.exceptions import RequestValidationError
+from pydantic import Field, TypeAdapter, ValidationError
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_304_NOT_MODIFIED, HTTP_428_PRECONDITION_REQUIRED
+from DB.sessions import read_fresh
+from Models.models import Vault, VaultChunk
+from schemas.schemas import CurrentUser, ChunkHashes, ChunkUpload, ChunkClient, ManifestSync, ManifestClient, VaultAck
+from Routes.auth import get_current_user, get_user_db, get_user_read_db, get_user_write_db, commit_user_write
+from Routes.vaults import swap_vault, written_versions, make_etag, etag_matches, if_match_version, min_vault_version, vault_limit, read_bounded, json_body_limit, EMPTY_CIPHERTEXT
+from config.configs import settings
+from utils.logger import logger
+from utils.metrics import observe_vault_bytes
+from utils.serialization import JSONResponseClass, FAST_JSON
+from sqlalchemy import Select, Delete, func, all_, literal, String
+from sqlalchemy.dialects.postgresql import insert, ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Annotated, List
+import base64, binascii, hashlib
+
+router = APIRouter()
+
+#? Chunked vaults: the client splits its vault into independently encrypted chunks addressed by sha256 of the ciphertext.
+#? The ordered list of hashes (the manifest) lives on the vault row and is versioned exactly like the whole-blob vault,
+#? so a single edit only uploads the chunks that changed plus a new manifest.
+
+CHUNK_UPLOADS = TypeAdapter(Annotated[List[ChunkUpload], Field(max_length=10000)])
+
+CHUNK_BODY_DOCS = {"requestBody": {"required": True, "content": {"application/json": {"schema": CHUNK_UPLOADS.json_schema()}}}}
+
+
+@router.get('/vaults/manifest', response_model=ManifestClient, dependencies=[Depends(vault_limit)])
+async def get_manifest(request: Request, response: Response, u: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_user_read_db)):
+    stmt = Select(Vault.id, Vault.manifest, Vault.version).where(Vault.user_id == u.id)
+    res = await read_fresh(db, stmt, await min_vault_version(request, u.id))
+
+    if res is None or res.manifest is None:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="No chunked vault is there for the user")
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, res.id, res.version):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": make_etag(res.id, res.version)})
+
+    if FAST_JSON:
+        return JSONResponseClass({"id": res.id, "chunks": res.manifest, "version": res.version}, headers={"ETag": make_etag(res.id, res.version)})
+
+    response.headers["ETag"] = make_etag(res.id, res.version)
+    return ManifestClient(id=res.id, chunks=res.manifest, version=res.version)
+
+
+@router.post('/vaults/chunks/missing', response_model=ChunkHashes, dependencies=[Depends(vault_limit)]) #? Which of these chunks does the server not have yet
+async def missing_chunks(h: ChunkHashes, u: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_user_db)):
+    stmt = Select(VaultChunk.chunk_hash).where(VaultChunk.user_id == u.id, VaultChunk.chunk_hash.in_(h.hashes))
+    present = set((await db.execute(stmt)).scalars().all())
+
+    return ChunkHashes(hashes=[x for x in dict.fromkeys(h.hashes) if x not in present])
+
+
+@router.post('/vaults/chunks', response_model=ChunkHashes, openapi_extra=CHUNK_BODY_DOCS, dependencies=[Depends(vault_limit)])
+async def upload_chunks(request: Request, u: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_user_write_db)):
+    #? Read by hand like POST /vaults, so an oversized upload stops with 413 before it is all in memory
+    body = await read_bounded(request, json_body_limit(settings.max_chunk_upload_bytes), f"Chunks are larger than {settings.max_chunk_upload_bytes} bytes")
+    try:
+        chunks = CHUNK_UPLOADS.validate_json(body)
+    except ValidationError as err:
+        raise RequestValidationError([{**e, "loc": ("body", *e["loc"])} for e in err.errors()])
+    del body
+
+    rows = []
+    for c in chunks:
+        try:
+            data = base64.b64decode(c.encrypted_data, validate=True)
+        except binascii.Error:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"Chunk {c.hash} is not valid base64")
+        if len(data) > settings.max_chunk_bytes:
+            raise HTTPException(status_code=413, detail=f"Chunk {c.hash} is larger than {settings.max_chunk_bytes} bytes")
+        if hashlib.sha256(data).hexdigest() != c.hash:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"Chunk {c.hash} does not match its content")
+        rows.append({"user_id": u.id, "chunk_hash": c.hash, "encrypted_data": data, "nonce_b64": c.nonce_b64})
+        observe_vault_bytes(len(data))
+
+    if not rows:
+        return ChunkHashes(hashes=[])
+
+    try:
+        #? Content addressed, so a chunk the server already has is simply skipped
+        stmt = insert(VaultChunk).values(rows).on_conflict_do_nothing(index_elements=[VaultChunk.user_id, VaultChunk.chunk_hash])
+        await db.execute(stmt)
+        await commit_user_write(db, u.username)
+
+        return ChunkHashes(hashes=[r["chunk_hash"] for r in rows])
+
+    except HTTPException:
+        raise
+    except Exception as err:
+        await db.rollback()
+        logger.error("Error in upload_chunks,%s", err)
+        raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail="Server error, can\'t store the chunks")
+
+
+@router.post('/vaults/chunks/fetch', response_model=List[ChunkClient], dependencies=[Depends(vault_limit)])
+async def fetch_chunks(h: ChunkHashes, u: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_user_db)):
+    stmt = Select(VaultChunk.chunk_hash, VaultChunk.encrypted_data, VaultChunk.nonce_b64).where(VaultChunk.user_id == u.id, VaultChunk.chunk_hash.in_(h.hashes))
+    res = (await db.execute(stmt)).all()
+    observe_vault_bytes(sum(len(r.encrypted_data) for r in res))
+
+    if FAST_JSON:
+        return JSONResponseClass([{"hash": r.chunk_hash, "encrypted_data": base64.b64encode(r.encrypted_data).decode("utf-8"), "nonce_b64": r.nonce_b64} for r in res])
+    return [ChunkClient(hash=r.chunk_hash, encrypted_data=base64.b64encode(r.encrypted_data).decode("utf-8"), nonce_b64=r.nonce_b64) for r in res]
+
+
+@router.put('/vaults/manifest', response_model=VaultAck, dependencies=[Depends(vault_limit)])
+async def commit_manifest(m: ManifestSync, request: Request, response: Response, u: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_user_write_db)):
+    vault_id, version = if_match_version(request) or (None, m.version)
+    if version is None:
+        raise HTTPException(status_code=HTTP_428_PRECONDITION_REQUIRED, detail="Send the vault version in the body or in If-Match")
+
+    #! One transaction: the swap locks the vault row, so the chunk check and the collection of dropped chunks can't
+    #! interleave with another device's commit. A device whose chunks our collection deleted gets 409 on its swap, it
+    #! refetches the manifest and uploads what is missing
+    try:
+        res = await swap_vault(db, u, EMPTY_CIPHERTEXT, "", version, manifest=m.chunks, vault_id=vault_id)
+
+        wanted = set(m.chunks)
+        stmt = Select(func.count()).select_from(VaultChunk).where(VaultChunk.user_id == u.id, VaultChunk.chunk_hash.in_(wanted))
+        if (await db.execute(stmt)).scalar_one() != len(wanted):
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Upload every chunk of the manifest before committing it")
+
+        #? Chunks dropped by this manifest are garbage now
+        stmt = Delete(VaultChunk).where(VaultChunk.user_id == u.id, VaultChunk.chunk_hash != all_(literal(m.chunks, ARRAY(String))))
+        await db.execute(stmt, execution_options={"synchronize_session": False})
+        await commit_user_write(db, u.username)
+
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as err:
+        await db.rollback()
+        logger.error("Error in commit_manifest,%s", err)
+        raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail="Server error, can\'t store the manifest")
+
+    await written_versions.set(u.id, res.version)
+
+    response.headers["ETag"] = make_etag(res.id, res.version)
+    return VaultAck(id=res.id, nonce_b64="", version=res.version)
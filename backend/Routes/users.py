@@ -1,61 +1,143 @@
-from fastapi import APIRouter, HTTPException, Depends, Response
-from DB.sessions import get_db
+from fastapi import APIRouter, HTTPException, Depends, Response, Request, Query
+from fastapi.responses import StreamingResponse
+from DB.sessions import read_all_shards
 from sqlalchemy import Select
-from sqlalchemy.orm import Session
-from schemas.schemas import UserSend, UserResponse, VaultCreate, VaultResponse, Token
+from sqlalchemy.ext.asyncio import AsyncSession
+from schemas.schemas import UserSend, UserLogin, UserResponse, VaultCreate, VaultResponse, Token
 import logging
 from Models.models import User, Vault
 from typing import List
-from starlette.status import HTTP_404_NOT_FOUND, HTTP_409_CONFLICT
-from Routes.auth import create_access_token, create_refresh_token
+from starlette.status import HTTP_201_CREATED, HTTP_404_NOT_FOUND, HTTP_409_CONFLICT, HTTP_503_SERVICE_UNAVAILABLE
+from Routes.auth import issue_tokens, user_shard, commit_user_write, login_user
+from utils.tokens import refresh_families, TokenStoreUnavailable
 from sqlalchemy.exc import IntegrityError
 from utils.logger import logger
+from utils.cache import user_cache
+from utils.hashing import key_hasher, HashingBusy
+from utils.idempotency import run_idempotent, fingerprint
+from utils.ratelimit import RouteLimit
+from utils.serialization import JSONResponseClass, FAST_JSON
+from config.configs import settings
+import json
+import heapq
 
 router = APIRouter()
 
 
-#todo
-@router.get('/users', response_model=List[UserResponse])
-def get_all_users(db: Session = Depends(get_db)):
+NDJSON = "application/x-ndjson"
+STREAM_BATCH = 1000
+
+async def users_page(after: int | None, limit: int) -> list:
+    """One page in id order over every shard. Ids are unique across shards, so the pages merge into one keyset order"""
+
+    stmt = Select(User.id, User.username, User.created_at).order_by(User.id).limit(limit)
+    if after is not None:
+        stmt = stmt.where(User.id > after)
+
+    rows, last = [], None
+    for r in heapq.merge(*await read_all_shards(stmt), key=lambda r: r.id):
+        if r.id != last: #? A user being moved is on two shards until the move finishes
+            rows.append(r)
+            last = r.id
+    return rows[:limit]
+
+async def stream_users(after: int | None):
+    """NDJSON rows a page at a time, memory stays at one batch whatever the table size"""
 
     try:
-        stmt = Select(User)
-        res = db.execute(stmt).scalars().all()
+        while True:
+            rows = await users_page(after, STREAM_BATCH)
+            if rows:
+                yield "".join(json.dumps({"id": r.id, "username": r.username, "created_at": r.created_at.isoformat()}) + "\n" for r in rows).encode("utf-8")
+            if len(rows) < STREAM_BATCH:
+                return
+            after = rows[-1].id
+
+    except Exception as err:
+        logger.error("The error is at stream_users\n%s", err)
+        raise
+
+
+@router.get('/users', response_model=List[UserResponse], responses={200: {"content": {NDJSON: {}}}})
+async def get_all_users(request: Request, response: Response, limit: int = Query(default=100, ge=1, le=1000), after: int | None = Query(default=None, ge=0), stream: bool = False):
+    """Keyset pagination on id. Pass the X-Next-Cursor header back as after for the next page, or ask for NDJSON to stream everything"""
 
+    if stream or NDJSON in request.headers.get("accept", ""):
+        return StreamingResponse(stream_users(after), media_type=NDJSON)
+
+    try:
+        res = await users_page(after, limit)
+
+        if len(res) == limit:
+            response.headers["X-Next-Cursor"] = str(res[-1].id)
+
+        if FAST_JSON:
+            headers = {"X-Next-Cursor": response.headers["X-Next-Cursor"]} if len(res) == limit else None
+            return JSONResponseClass([{"username": r.username, "id": r.id, "created_at": r.created_at} for r in res], headers=headers)
         return res
 
     except Exception as err:
-        logger.error(f"The error is at get_all_users\n{err}")
+        logger.error("The error is at get_all_users\n%s", err)
         raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="Can\'t process the request")
 
 #todo find the id with username
-@router.post('/auth/register', response_model=Token)
-def create_user(res: Response, user: UserSend, db: Session = Depends(get_db)):
+@router.post('/auth/register', response_model=Token, status_code=201, dependencies=[Depends(RouteLimit(settings.rate_limit_register))])
+async def create_user(request: Request, user: UserSend):
+    #? The whole body is in the fingerprint, a replay needs the same credentials as the original request
+    return await run_idempotent(request, "register", fingerprint(user.model_dump()), lambda: register_user(user), lambda: replay_register(user))
+
+async def replay_register(user: UserSend) -> Response:
+    """A retried registration that already succeeded logs in: the key is checked against the stored hash and a new
+    session is started, the first response's tokens are never stored"""
+    async with user_shard(user.username).session() as db:
+        return await login_user(UserLogin(username=user.username, hashed_key_a=user.hashed_key_a), db, status_code=HTTP_201_CREATED)
+
+async def register_user(user: UserSend) -> Response:
+    #! A username is unique per shard, and it only ever maps to one shard. A bucket being moved can't take new users
+    async with user_shard(user.username, write=True).session() as db:
+        return await insert_user(user, db)
+
+async def insert_user(user: UserSend, db: AsyncSession) -> Response:
     try:
         user_dict = user.model_dump()
-        
+        user_dict["hashed_key_a"] = await key_hasher.hash(user.hashed_key_a)
+
+        #? A token store outage fails the request before the account exists. The family itself is only started once
+        #? the insert committed, a duplicate username or any other failure leaves nothing behind in the store
+        await refresh_families.check()
+
         new_user = User(**user_dict)
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
-        res.status_code = 201
+        await commit_user_write(db, new_user.username) #? The hashing queue may have outlasted the shard map lease
+        await db.refresh(new_user)
+        await user_cache.invalidate(new_user.username) #? Drops anything cached for a previous account with this name
+
+        try:
+            tokens = await issue_tokens(new_user.username)
+        except TokenStoreUnavailable:
+            #? The store went away after the check, the account exists and a retry would only get 409
+            logger.error("Registered %s without a session, the refresh token store is unreachable", new_user.id)
+            raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="The account was created, log in in a moment", headers={"Retry-After": "5"})
+        return JSONResponseClass(tokens, status_code=HTTP_201_CREATED)
+
 
-        access_token = create_access_token(data={"sub": new_user.username})
-        refresh_token = create_refresh_token(data={"sub": new_user.username})
+    except HTTPException:
+        raise
 
-        return {
-            "access_token": access_token,
-            "refresh_token": refresh_token,
-            "token_type": "bearer"
-        }
+    except HashingBusy:
+        logger.warning("Registration rejected, hashing queue is full")
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Too many registrations right now, try again", headers={"Retry-After": "1"})
 
+    except TokenStoreUnavailable:
+        logger.error("Registration rejected, the refresh token store is unreachable")
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Can't register right now, try again", headers={"Retry-After": "5"})
 
     except IntegrityError:
-        db.rollback()
+        await db.rollback()
         logger.error("The user already exists")
         raise HTTPException(status_code=HTTP_409_CONFLICT, detail="User with this email already exists")
     
     except Exception as err:
-        db.rollback()
-        logger.error(f"Error at create_user\n{err}")
+        await db.rollback()
+        logger.error("Error at create_user\n%s", err)
         raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Can\'t process the request\n{err}")
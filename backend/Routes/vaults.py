@@ -1,97 +1,458 @@
-from fastapi import APIRouter, HTTPException, Depends, Response
-from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_404_NOT_FOUND, HTTP_409_CONFLICT
-from DB.sessions import get_db
-from Models.models import Vault, User
-from schemas.schemas import VaultResponse, VaultSync, VaultClient
-from Routes.auth import get_current_user
+from fastapi import APIRouter, HTTPException, Depends, Response, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse, FileResponse
+from pydantic import ValidationError
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_204_NO_CONTENT, HTTP_401_UNAUTHORIZED, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_404_NOT_FOUND, HTTP_409_CONFLICT, HTTP_304_NOT_MODIFIED, HTTP_428_PRECONDITION_REQUIRED, HTTP_503_SERVICE_UNAVAILABLE
+from DB.sessions import read_fresh, has_replicas
+from DB.shards import shard_router
+from DB.notify import vault_events
+from DB.blobstore import blob_store, StoredBlob, BlobTooLarge
+from config.configs import settings
+from Models.models import Vault, VaultChunk
+from schemas.schemas import CurrentUser, VaultResponse, VaultSync, VaultClient, VaultAck
+from Routes.auth import get_current_user, get_user_db, get_user_read_db, get_user_write_db, commit_user_write
 from utils.logger import logger
-from sqlalchemy import Select, Delete
-from sqlalchemy.orm import Session
+from utils.metrics import observe_vault_bytes, register_gauges
+from utils.cache import TTLCache, SizedTTLCache, SingleFlight, VersionFloors
+from utils.idempotency import run_idempotent, fingerprint
+from sqlalchemy import Select, Delete, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import NoResultFound
-import base64
-from fastapi_limiter import FastAPILimiter
-from fastapi_limiter.depends import RateLimiter
+import base64, hashlib, json, asyncio, sys
+from typing import NamedTuple
+from utils.ratelimit import RouteLimit
+from utils.serialization import JSONResponseClass
 
 router = APIRouter()
+vault_limit = RouteLimit(settings.rate_limit_vaults)
 
+#? Binary transport: raw ciphertext in the body, the rest of the vault row in headers. Skips base64 + JSON both ways
+OCTET_STREAM = "application/octet-stream"
+NONCE_HEADER = "X-Vault-Nonce"
+VERSION_HEADER = "X-Vault-Version"
+ID_HEADER = "X-Vault-Id"
+MIN_VERSION_HEADER = "X-Vault-Min-Version"
 
-@router.get('/vaults', response_model=VaultClient)
-def get_vaults(u: User = Depends(get_current_user), db: Session = Depends(get_db)):
+VAULT_BODY_DOCS = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": VaultSync.model_json_schema()},
+            OCTET_STREAM: {"schema": {"type": "string", "format": "binary"}},
+        },
+    }
+}
+
+
+def wants_binary(request: Request) -> bool:
+    return OCTET_STREAM in request.headers.get("accept", "")
+
+def sends_binary(request: Request) -> bool:
+    return request.headers.get("content-type", "").startswith(OCTET_STREAM)
+
+def vault_headers(vault_id: int, nonce_b64: str, version: int) -> dict:
+    return {ID_HEADER: str(vault_id), NONCE_HEADER: nonce_b64, VERSION_HEADER: str(version), "ETag": make_etag(vault_id, version)}
+
+
+#? ETag is "<vault id>-<version>". The id is there because a deleted and recreated vault starts again at version 1
+def make_etag(vault_id: int, version: int) -> str:
+    return f'"{vault_id}-{version}"'
+
+def parse_etags(value: str) -> list[str]:
+    tags = []
+    for tag in value.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tags.append(tag.strip('"'))
+    return tags
+
+def etag_matches(value: str, vault_id: int, version: int) -> bool:
+    tags = parse_etags(value)
+    return "*" in tags or f"{vault_id}-{version}" in tags
+
+def if_match_version(request: Request) -> tuple[int | None, int] | None:
+    """(vault_id, version) from If-Match. Accepts the ETag we sent or a bare version number, which has no vault id"""
+
+    value = request.headers.get("if-match")
+    if value is None:
+        return None
+
+    tags = parse_etags(value)
+    vault_id, dash, version = tags[0].rpartition("-") if len(tags) == 1 else ("", "", "")
+    if not version.isdigit() or (dash and not vault_id.isdigit()):
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="If-Match must hold a single vault ETag or version")
+    return (int(vault_id) if vault_id else None), int(version)
+
+
+#? Read-your-writes on replicas. A read must see at least the newest version the client knows of: the version last
+#? written for the user by any worker (kept in redis), X-Vault-Min-Version, or the one in If-None-Match. A replica row
+#? older than that floor is read again on the primary.
+written_versions = VersionFloors(settings.user_cache_size, settings.read_your_writes_ttl)
+VAULT_DELETED = sys.maxsize #? Floor after a delete, any row a replica still has is stale
+
+register_gauges("occultus_version_floors", "Read-your-writes vault version floors", written_versions.stats)
+
+async def min_vault_version(request: Request, user_id: int) -> int:
+    #? Without replicas every read is on the primary and the floor is never looked at
+    #! A floor redis can't tell is treated as a delete, the read goes to the primary
+    floor = await written_versions.get(user_id, unknown=VAULT_DELETED) if has_replicas else 0
+
+    value = request.headers.get(MIN_VERSION_HEADER, "")
+    if value.isdigit():
+        floor = max(floor, int(value))
+
+    for tag in parse_etags(request.headers.get("if-none-match", "")):
+        version = tag.rpartition("-")[2]
+        if version.isdigit():
+            floor = max(floor, int(version))
+    return floor
+
+
+STREAM_CHUNK = 48 * 1024 #! Multiple of 3 so every slice base64 encodes without padding
+
+def json_body_limit(max_bytes: int) -> int:
+    #? base64 grows the blob by 4/3, the rest of the JSON document is small
+    return (max_bytes + 2) // 3 * 4 + 4096
+
+async def read_bounded(request: Request, limit: int, detail: str | None = None) -> bytes:
+    """Reads the body chunk by chunk and stops with 413 as soon as it grows past limit"""
+
+    detail = detail or f"Vault is larger than {settings.max_vault_bytes} bytes"
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > limit:
+        raise HTTPException(status_code=413, detail=detail)
+
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise HTTPException(status_code=413, detail=detail)
+
+    return bytes(body)
+
+def iter_binary(data: bytes):
+    view = memoryview(data)
+    for i in range(0, len(view), STREAM_CHUNK):
+        yield view[i:i + STREAM_CHUNK]
+
+def iter_vault_json(vault_id: int, data: bytes, nonce_b64: str, version: int):
+    """Same document as VaultClient, base64 encoded slice by slice without a str copy of the whole blob"""
+
+    yield f'{{"id":{vault_id},"encrypted_data":"'.encode("utf-8")
+    view = memoryview(data)
+    for i in range(0, len(view), STREAM_CHUNK):
+        yield base64.b64encode(view[i:i + STREAM_CHUNK])
+    yield f'","nonce_b64":{json.dumps(nonce_b64)},"version":{version}}}'.encode("utf-8")
+
+
+async def read_vault_body(request: Request, body: bytes | None = None) -> tuple[bytes | StoredBlob, str, int | None, int]:
+    """Returns (ciphertext, nonce_b64, vault_id, version) for either a JSON or an octet-stream upload. If-Match wins over the body version,
+    vault_id is only known from an If-Match ETag.
+    Binary uploads with a blob store go straight to it while they stream in, the ciphertext is then a StoredBlob.
+    body is a JSON body the caller already read"""
+
+    expected = if_match_version(request)
+
+    if sends_binary(request):
+        nonce_b64 = request.headers.get(NONCE_HEADER)
+        version = request.headers.get(VERSION_HEADER)
+
+        if not nonce_b64 or (version is not None and not version.isdigit()):
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=f"{NONCE_HEADER} header is required and {VERSION_HEADER} must be a number")
+
+        if blob_store is None:
+            encrypted_data = await read_bounded(request, settings.max_vault_bytes)
+        else:
+            length = request.headers.get("content-length")
+            if length is not None and length.isdigit() and int(length) > settings.max_vault_bytes:
+                raise HTTPException(status_code=413, detail=f"Vault is larger than {settings.max_vault_bytes} bytes")
+            try:
+                encrypted_data = await blob_store.put_stream(request.stream(), settings.max_vault_bytes)
+            except BlobTooLarge:
+                raise HTTPException(status_code=413, detail=f"Vault is larger than {settings.max_vault_bytes} bytes")
+
+        version = int(version) if version is not None else None
+    else:
+        try:
+            if body is None:
+                body = await read_bounded(request, json_body_limit(settings.max_vault_bytes))
+            v = VaultSync.model_validate_json(body)
+        except ValidationError as err:
+            raise RequestValidationError([{**e, "loc": ("body", *e["loc"])} for e in err.errors()])
+
+        encrypted_data, nonce_b64, version = base64.b64decode(v.encrypted_data), v.nonce_b64, v.version
+        del v #? Drop the base64 copy before the database write
+
+        if len(encrypted_data) > settings.max_vault_bytes:
+            raise HTTPException(status_code=413, detail=f"Vault is larger than {settings.max_vault_bytes} bytes")
+
+    vault_id = None
+    if expected is not None:
+        vault_id, version = expected
+    if version is None:
+        raise HTTPException(status_code=HTTP_428_PRECONDITION_REQUIRED, detail="Send the vault version in the body or in If-Match")
+
+    return encrypted_data, nonce_b64, vault_id, version
+
+
+EMPTY_CIPHERTEXT = {"encrypted_data": b"", "blob_hash": None, "blob_size": None}
+
+async def ciphertext_columns(payload: bytes | StoredBlob) -> dict:
+    """Vault columns for a ciphertext: inline bytea, or a reference into the blob store"""
+
+    if isinstance(payload, StoredBlob):
+        return {"encrypted_data": None, "blob_hash": payload.hash, "blob_size": payload.size}
+    if blob_store is None:
+        return {"encrypted_data": payload, "blob_hash": None, "blob_size": None}
+
+    blob = await blob_store.put(payload)
+    return {"encrypted_data": None, "blob_hash": blob.hash, "blob_size": blob.size}
+
+
+async def swap_vault(db: AsyncSession, u: CurrentUser, ciphertext: dict, nonce_b64: str, version: int, manifest: list[str] | None = None, vault_id: int | None = None):
+    """Compare-and-swap write in a single statement, returns (id, version) of the stored row. Raises 409 when nothing matched.
+    ciphertext comes from ciphertext_columns. Chunked vaults pass their manifest with EMPTY_CIPHERTEXT, whole-blob writes clear it.
+    vault_id from an If-Match ETag must be the current row too, a vault deleted and recreated starts over at the same versions.
+    Doesn't commit, the vault row stays locked until the caller does"""
+
+    if version == 1 and vault_id is None:
+        #? First write inserts version 1. A vault already at version 1 gets bumped by the conflict branch, anything else matches nothing
+        stmt = insert(Vault).values(user_id=u.id, **ciphertext, nonce_b64=nonce_b64, version=1, manifest=manifest)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Vault.user_id],
+            set_={**{k: stmt.excluded[k] for k in ciphertext}, "nonce_b64": stmt.excluded.nonce_b64, "manifest": stmt.excluded.manifest, "version": Vault.version + 1},
+            where=Vault.version == 1,
+        )
+    else:
+        stmt = (
+            update(Vault)
+            .where(Vault.user_id == u.id, Vault.version == version)
+            .values(**ciphertext, nonce_b64=nonce_b64, manifest=manifest, version=Vault.version + 1)
+        )
+        if vault_id is not None:
+            #? An ETag names an existing vault, so version 1 with an id is an update as well and never inserts
+            stmt = stmt.where(Vault.id == vault_id)
+
+    res = (await db.execute(stmt.returning(Vault.id, Vault.version))).one_or_none()
+
+    if res is None:
+        await db.rollback()
+        raise HTTPException(status_code=HTTP_409_CONFLICT, detail="Some other changes have happened, please try again")
+    return res
+
+async def save_vault(db: AsyncSession, u: CurrentUser, ciphertext: dict, nonce_b64: str, version: int, manifest: list[str] | None = None, vault_id: int | None = None):
+    """swap_vault and commit"""
+
+    res = await swap_vault(db, u, ciphertext, nonce_b64, version, manifest, vault_id)
+    if manifest is None:
+        #? A whole-blob write drops any manifest, and with it every chunk, in the same transaction as commit_manifest does
+        await db.execute(Delete(VaultChunk).where(VaultChunk.user_id == u.id), execution_options={"synchronize_session": False})
+    await commit_user_write(db, u.username)
+    await written_versions.set(u.id, res.version)
+    return res
+
+
+#? Coalesced vault reads. A device unlock storm asks for the same (vault, version) many times at once: one load from
+#? the database or blob store serves every concurrent request, and the encoded body (raw bytes or the JSON document)
+#? is kept for a few seconds. Keys carry the vault id as well, a vault deleted and recreated starts over at version 1.
+class VaultBody(NamedTuple):
+    id: int
+    nonce_b64: str
+    version: int
+    body: bytes
+
+vault_bodies = SizedTTLCache(settings.vault_cache_entries, settings.vault_cache_ttl, settings.vault_cache_bytes, sizeof=lambda b: len(b.body))
+vault_flights = SingleFlight()
+vault_cache_counters = {"hits": 0, "misses": 0}
+
+async def load_vault(u: CurrentUser, min_version: int) -> VaultBody | None:
+    """Raw ciphertext of the current vault, read on its own session since the caller that started it may go away"""
+
+    async with shard_router.shard_for(u.username).read_session() as db:
+        stmt = Select(Vault.id, Vault.encrypted_data, Vault.blob_hash, Vault.nonce_b64, Vault.version).where(Vault.user_id == u.id)
+        res = await read_fresh(db, stmt, min_version)
+
+    if res is None:
+        return None
+    data = res.encrypted_data if res.blob_hash is None else await blob_store.get(res.blob_hash)
+    return VaultBody(res.id, res.nonce_b64, res.version, bytes(data))
+
+async def build_vault(fmt: str, u: CurrentUser, vault_id: int, version: int) -> VaultBody | None:
+    if fmt == "raw":
+        body = await load_vault(u, version)
+    else:
+        raw = await vault_body("raw", u, vault_id, version)
+        if raw is None:
+            return None
+        document = await asyncio.to_thread(lambda: b"".join(iter_vault_json(raw.id, raw.body, raw.nonce_b64, raw.version)))
+        body = raw._replace(body=document)
+
+    #? The row can be newer than asked for, it's cached under what it really is
+    if body is not None:
+        vault_bodies.set((fmt, u.id, body.id, body.version), body)
+    return body
+
+async def vault_body(fmt: str, u: CurrentUser, vault_id: int, version: int) -> VaultBody | None:
+    """fmt is raw or json. At least the given version, None once the vault is gone"""
+
+    key = (fmt, u.id, vault_id, version)
+    body = vault_bodies.get(key)
+    if body is not None:
+        vault_cache_counters["hits"] += 1
+        return body
+
+    vault_cache_counters["misses"] += 1
+    return await vault_flights.do(key, lambda: build_vault(fmt, u, vault_id, version))
+
+def vault_cache_stats() -> dict:
+    return {**vault_cache_counters, **vault_flights.counters, "in_flight": len(vault_flights), "entries": len(vault_bodies), "bytes": vault_bodies.bytes}
+
+register_gauges("occultus_vault_cache", "Coalesced vault reads", vault_cache_stats)
+
+
+@router.get('/vaults', response_model=VaultClient, responses={200: {"content": {OCTET_STREAM: {}}}}, dependencies=[Depends(vault_limit)])
+async def get_vaults(request: Request, u: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_user_read_db)):
     try:
-        stmt = Select(Vault).where(Vault.user_id == u.id)
-        res = db.execute(stmt).scalar_one_or_none()
+        #? Small columns only, the blob stays in TOAST unless the client is actually stale and isn't served from memory
+        stmt = Select(Vault.id, Vault.blob_hash, Vault.blob_size, Vault.nonce_b64, Vault.version, Vault.manifest.is_not(None).label("chunked")).where(Vault.user_id == u.id)
+        current = await read_fresh(db, stmt, await min_vault_version(request, u.id))
+        await db.close() #? Hands the connection back before the body is loaded or streamed
+
+        if current is None:
+            raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="No vault is there for the user")
+        if current.chunked:
+            #! Its row holds no ciphertext, served as a whole blob it would look like an empty vault that fails to decrypt
+            raise HTTPException(status_code=HTTP_409_CONFLICT, detail="The vault is stored in chunks, read it through GET /vaults/manifest", headers={"Link": '</vaults/manifest>; rel="alternate"'})
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, current.id, current.version):
+            return Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": make_etag(current.id, current.version)})
+
+        binary = wants_binary(request)
+        if binary and current.blob_hash is not None:
+            if blob_store is None:
+                raise RuntimeError(f"Vault {current.id} is in the blob store but BLOB_BACKEND is database")
+            path = blob_store.local_path(current.blob_hash)
+            if path is not None: #? sendfile where the server supports it, the page cache already shares the bytes
+                observe_vault_bytes(current.blob_size)
+                return FileResponse(path, media_type=OCTET_STREAM, headers=vault_headers(current.id, current.nonce_b64, current.version))
 
-        if not res:
+        res = await vault_body("raw" if binary else "json", u, current.id, current.version)
+        if res is None:
             raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="No vault is there for the user")
+        observe_vault_bytes(len(res.body))
 
-        res.encrypted_data = base64.b64encode(res.encrypted_data).decode("utf-8")
+        #? Every response streams slices of the one shared buffer
+        if binary:
+            headers = {**vault_headers(res.id, res.nonce_b64, res.version), "Content-Length": str(len(res.body))}
+            return StreamingResponse(iter_binary(res.body), media_type=OCTET_STREAM, headers=headers)
 
-        return res
+        headers = {"ETag": make_etag(res.id, res.version), "Content-Length": str(len(res.body))}
+        return StreamingResponse(iter_binary(res.body), media_type="application/json", headers=headers)
         
     except HTTPException as he:
-        logger.error(f"The user hasn\'t saved any password")
+        logger.error("The user hasn\'t saved any password")
         raise he
     except Exception as err:
-        logger.error(f"Error at get_all_vaults,{err}")
+        logger.error("Error at get_all_vaults,%s", err)
         raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail="Error in retrieving the vault")
 
 
-@router.post('/vaults', response_model=VaultClient)
-def send_new_secrets(v: VaultSync, db: Session = Depends(get_db), u: User = Depends(get_current_user)):
+@router.post('/vaults', response_model=VaultAck, openapi_extra=VAULT_BODY_DOCS, dependencies=[Depends(vault_limit)])
+async def send_new_secrets(request: Request, db: AsyncSession = Depends(get_user_write_db), u: CurrentUser = Depends(get_current_user)):
+    headers = [request.headers.get(h) for h in ("content-type", "content-length", "if-match", NONCE_HEADER, VERSION_HEADER)]
+    if sends_binary(request):
+        #? The body isn't read for the fingerprint, a replay answers before any of the upload is processed. The nonce
+        #? header is new for every encryption, so different content comes with a different one
+        return await run_idempotent(request, f"vault:{u.id}", fingerprint(*headers), lambda: write_vault(request, db, u))
+
+    #? A JSON body carries the nonce and version itself, it is read first and its digest is part of the fingerprint
+    body = await read_bounded(request, json_body_limit(settings.max_vault_bytes))
+    fp = fingerprint(*headers, hashlib.sha256(body).hexdigest())
+    return await run_idempotent(request, f"vault:{u.id}", fp, lambda: write_vault(request, db, u, body))
+
+async def write_vault(request: Request, db: AsyncSession, u: CurrentUser, body: bytes | None = None) -> Response:
     try:
-        stmt = Select(Vault).where(Vault.user_id == u.id)
-        res = db.execute(stmt).scalar_one_or_none()
+        payload, nonce_b64, vault_id, version = await read_vault_body(request, body)
+        observe_vault_bytes(payload.size if isinstance(payload, StoredBlob) else len(payload))
+        res = await save_vault(db, u, await ciphertext_columns(payload), nonce_b64, version, vault_id=vault_id)
 
-        if res is None:
-            if v.version == 1:
-                v_dict = v.model_dump()
-                
-                v_dict.update({"user_id": u.id})
-                v_dict["encrypted_data"] = base64.b64decode(v.encrypted_data)
-                
-                new_secret = Vault(**v_dict)
-                db.add(new_secret)
-                db.commit()
-                db.refresh(new_secret)
-                new_secret.encrypted_data = base64.b64encode(new_secret.encrypted_data).decode("utf-8")
-                return new_secret
-            else:
-                raise HTTPException(status_code=HTTP_409_CONFLICT, detail="Some other changes have happened, please try again")
-        else:
-            if res.version != v.version:
-                raise HTTPException(status_code=HTTP_409_CONFLICT, detail="Some other changes have happened, please try again")
-            else:
-                res.version = v.version + 1
-                res.encrypted_data = base64.b64decode(v.encrypted_data)
-                res.nonce_b64 = v.nonce_b64
-                db.commit()
-                res.encrypted_data = base64.b64encode(res.encrypted_data).decode("utf-8")
-                return res
+        if sends_binary(request) or wants_binary(request):
+            return Response(status_code=HTTP_204_NO_CONTENT, headers=vault_headers(res.id, nonce_b64, res.version))
 
-    except HTTPException as he:
-        db.rollback()
+        ack = VaultAck(id=res.id, nonce_b64=nonce_b64, version=res.version)
+        return JSONResponseClass(ack.model_dump(), headers={"ETag": make_etag(res.id, res.version)})
+
+    except (HTTPException, RequestValidationError) as he:
+        await db.rollback()
         raise he
     except Exception as err:
-        db.rollback()
-        logger.error(f"Error in send_new_secrets")
+        await db.rollback()
+        logger.error("Error in send_new_secrets")
         raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail="Server error, can\'t process the request")
 
+SSE_KEEPALIVE = 15
+
+def sse_event(vault_id: int | None, version: int) -> str:
+    return f"id: {version}\nevent: vault\ndata: {json.dumps({'id': vault_id, 'version': version, 'etag': make_etag(vault_id, version) if vault_id else None})}\n\n"
+
+async def vault_event_stream(request: Request, user_id: int, q: asyncio.Queue, current):
+    try:
+        yield "retry: 5000\n\n"
+        #? Current state first, so a device that missed events while offline syncs right away
+        yield sse_event(current.id if current else None, current.version if current else 0)
+
+        while not await request.is_disconnected():
+            try:
+                vault_id, version = await asyncio.wait_for(q.get(), timeout=SSE_KEEPALIVE)
+                yield sse_event(vault_id, version)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+    finally:
+        vault_events.unsubscribe(user_id, q)
+
+
+@router.get('/vaults/events') #? Server-Sent Events, one message per committed vault version. Version 0 means deleted
+async def vault_changes(request: Request, u: CurrentUser = Depends(get_current_user), db: AsyncSession = Depends(get_user_db)):
+    try:
+        q = await vault_events.subscribe(u.id)
+    except Exception as err:
+        logger.error("Error at vault_changes,%s", err)
+        raise HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Change notifications are unavailable, poll GET /vaults")
+
+    #! Subscribed before reading, a write landing in between shows up twice rather than never
+    current = (await db.execute(Select(Vault.id, Vault.version).where(Vault.user_id == u.id))).one_or_none()
+    await db.close()
+
+    return StreamingResponse(
+        vault_event_stream(request, u.id, q, current),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.delete('/delete')
-def delete_blob(response: Response, db: Session = Depends(get_db), u: User = Depends(get_current_user)):
+async def delete_blob(response: Response, db: AsyncSession = Depends(get_user_write_db), u: CurrentUser = Depends(get_current_user)):
 
     try:
         stmt = Delete(Vault).where(u.id == Vault.user_id)
-        res = db.execute(stmt)
+        res = await db.execute(stmt)
+        await db.execute(Delete(VaultChunk).where(VaultChunk.user_id == u.id), execution_options={"synchronize_session": False})
         
         if res.rowcount == 0:
-            db.rollback()
+            await db.rollback()
             raise HTTPException(status_code=404, detail="Error at delete blob 1")
 
-        db.commit()
+        await commit_user_write(db, u.username)
+        await written_versions.set(u.id, VAULT_DELETED)
         return Response(status_code=204)
 
+    except HTTPException:
+        raise
     except Exception as err:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=HTTP_500_INTERNAL_SERVER_ERROR, detail="Error at delete blob 2")
 
 
@@ -1,6 +1,6 @@
 from logging.config import fileConfig
 from Models.models import Base
-from DB.sessions import DATABASE_URL
+from DB.sessions import SHARD_URLS
 from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 
@@ -27,6 +27,14 @@ target_metadata = Base.metadata
 # ... etc.
 
 
+def target_shards() -> list[int]:
+    """Every shard in turn, each with its own alembic_version. `alembic -x shard=N upgrade head` migrates just one.
+    Migrations read the shard they run on from config.attributes["shard"]"""
+
+    shard = context.get_x_argument(as_dictionary=True).get("shard")
+    return [int(shard)] if shard is not None else list(range(len(SHARD_URLS)))
+
+
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
 
@@ -39,16 +47,17 @@ def run_migrations_offline() -> None:
     script output.
 
     """
-    url = DATABASE_URL  
-    context.configure(
-        url=url,
-        target_metadata=target_metadata,
-        literal_binds=True,
-        dialect_opts={"paramstyle": "named"},
-    )
+    for shard in target_shards():
+        config.attributes["shard"] = shard
+        context.configure(
+            url=SHARD_URLS[shard][0],
+            target_metadata=target_metadata,
+            literal_binds=True,
+            dialect_opts={"paramstyle": "named"},
+        )
 
-    with context.begin_transaction():
-        context.run_migrations()
+        with context.begin_transaction():
+            context.run_migrations()
 
 
 def run_migrations_online() -> None:
@@ -59,21 +68,23 @@ def run_migrations_online() -> None:
 
     """
 
-    configuration = config.get_section(config.config_ini_section, {})
-    configuration["sqlalchemy.url"] = DATABASE_URL
+    for shard in target_shards():
+        config.attributes["shard"] = shard
+        configuration = config.get_section(config.config_ini_section, {})
+        configuration["sqlalchemy.url"] = SHARD_URLS[shard][0]
 
-    connectable = engine_from_config(
-        configuration,
-        prefix="sqlalchemy.",
-        poolclass=pool.NullPool,
-    )
-    with connectable.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata
+        connectable = engine_from_config(
+            configuration,
+            prefix="sqlalchemy.",
+            poolclass=pool.NullPool,
         )
+        with connectable.connect() as connection:
+            context.configure(
+                connection=connection, target_metadata=target_metadata
+            )
 
-        with context.begin_transaction():
-            context.run_migrations()
+            with context.begin_transaction():
+                context.run_migrations()
 
 
 if context.is_offline_mode():
@@ -0,0 +1,46 @@
+"""Notify on vault changes
+
+Revision ID: 0ce69cc29484
+Revises: 563605344a6d
+Create Date: 2026-10-18 11:02:17.519830
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0ce69cc29484'
+down_revision: Union[str, Sequence[str], None] = '563605344a6d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    #? Payload is "<user_id>:<vault id>:<version>", version 0 means the vault was deleted. Sent on commit only
+    op.execute("""
+    CREATE OR REPLACE FUNCTION notify_vault_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('vault_changes', OLD.user_id || ':' || OLD.id || ':0');
+            RETURN OLD;
+        END IF;
+        PERFORM pg_notify('vault_changes', NEW.user_id || ':' || NEW.id || ':' || NEW.version);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+    CREATE TRIGGER vault_change_notify
+    AFTER INSERT OR UPDATE OR DELETE ON vaults
+    FOR EACH ROW EXECUTE FUNCTION notify_vault_change();
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TRIGGER IF EXISTS vault_change_notify ON vaults")
+    op.execute("DROP FUNCTION IF EXISTS notify_vault_change()")
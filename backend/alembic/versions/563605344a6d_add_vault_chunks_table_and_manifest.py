@@ -0,0 +1,40 @@
+"""Add vault_chunks table and manifest column
+
+Revision ID: 563605344a6d
+Revises: 6a18a4f69b74
+Create Date: 2026-10-18 10:12:41.204512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '563605344a6d'
+down_revision: Union[str, Sequence[str], None] = '6a18a4f69b74'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("vaults", sa.Column("manifest", postgresql.ARRAY(sa.String()), nullable=True))
+    op.create_table('vault_chunks',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('chunk_hash', sa.String(length=64), nullable=False),
+    sa.Column('encrypted_data', sa.LargeBinary(), nullable=False),
+    sa.Column('nonce_b64', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'chunk_hash')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('vault_chunks')
+    op.drop_column("vaults", "manifest")
@@ -0,0 +1,42 @@
+"""Move vault ciphertext to the blob store
+
+Revision ID: 6ae6433d12d9
+Revises: 0ce69cc29484
+Create Date: 2026-10-18 13:40:52.118204
+
+Schema only: two nullable columns and a dropped NOT NULL, none of which rewrites
+the table, so the ACCESS EXCLUSIVE lock is held only for the catalog change.
+Existing ciphertexts stay inline and are still served from there. Moving them
+into the blob store is scripts.migrate_blobs, one short transaction per batch
+while the app keeps running.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6ae6433d12d9'
+down_revision: Union[str, Sequence[str], None] = '0ce69cc29484'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("vaults", sa.Column("blob_hash", sa.String(length=64), nullable=True))
+    op.add_column("vaults", sa.Column("blob_size", sa.BigInteger(), nullable=True))
+    op.alter_column("vaults", "encrypted_data", existing_type=sa.LargeBinary(), nullable=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    in_store = op.get_bind().execute(sa.text("SELECT EXISTS (SELECT 1 FROM vaults WHERE blob_hash IS NOT NULL)")).scalar()
+    if in_store:
+        raise RuntimeError("Vaults are still in the blob store, run python -m scripts.migrate_blobs --to-database first")
+
+    op.execute("UPDATE vaults SET encrypted_data = ''::bytea WHERE encrypted_data IS NULL")
+    op.alter_column("vaults", "encrypted_data", existing_type=sa.LargeBinary(), nullable=False)
+    op.drop_column("vaults", "blob_size")
+    op.drop_column("vaults", "blob_hash")
@@ -0,0 +1,84 @@
+"""Shard map and per shard id sequences
+
+Revision ID: 9f3b2d7c41e8
+Revises: 6ae6433d12d9
+Create Date: 2026-10-18 16:40:12.318274
+
+"""
+from typing import Sequence, Union
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9f3b2d7c41e8'
+down_revision: Union[str, Sequence[str], None] = '6ae6433d12d9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ID_STRIDE = 64 #! DB/shards.py ID_STRIDE
+BUCKET_SQL = "(('x' || substr(md5(username), 1, 7))::bit(28)::int % 1024)" #! DB/shards.py BUCKET_SQL, character for character
+SERIAL_TABLES = ("users", "vaults", "vault_chunks")
+
+NOTIFY_FUNCTION = """
+CREATE OR REPLACE FUNCTION notify_vault_change() RETURNS trigger AS $$
+BEGIN
+    {skip}IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('vault_changes', OLD.user_id || ':' || OLD.id || ':0');
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify('vault_changes', NEW.user_id || ':' || NEW.id || ':' || NEW.version);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+#? scripts.rebalance copies and deletes rows with occultus.rebalancing set. Devices must not hear of those, a delete on
+#? the source shard would tell them their vault is gone
+SKIP_REBALANCING = """IF current_setting('occultus.rebalancing', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    """
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('shard_buckets',
+    sa.Column('bucket', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.Column('moving_to', sa.Integer(), nullable=True),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('bucket')
+    )
+    #? scripts.rebalance selects a bucket's users by this expression
+    op.execute(f"CREATE INDEX ix_users_bucket ON users ({BUCKET_SQL})")
+    op.execute(NOTIFY_FUNCTION.format(skip=SKIP_REBALANCING))
+
+    #? Shard n hands out ids n, n + 64, n + 128... above everything it already has, so ids never collide across shards
+    #? and a moved row keeps its id. Run by alembic/env.py once per shard
+    shard = context.config.attributes.get("shard", 0)
+    for table in SERIAL_TABLES:
+        op.execute(f"""
+        DO $$
+        DECLARE
+            seq text := pg_get_serial_sequence('{table}', 'id');
+            top bigint;
+        BEGIN
+            EXECUTE format('SELECT greatest(coalesce(max(id), 0), (SELECT last_value FROM %s)) FROM {table}', seq) INTO top;
+            EXECUTE format('ALTER SEQUENCE %s INCREMENT BY {ID_STRIDE} RESTART WITH %s', seq, top - top % {ID_STRIDE} + {ID_STRIDE} + {shard});
+        END $$;
+        """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in SERIAL_TABLES:
+        op.execute(f"""
+        DO $$
+        BEGIN
+            EXECUTE format('ALTER SEQUENCE %s INCREMENT BY 1', pg_get_serial_sequence('{table}', 'id'));
+        END $$;
+        """)
+    op.execute(NOTIFY_FUNCTION.format(skip=""))
+    op.execute("DROP INDEX IF EXISTS ix_users_bucket")
+    op.drop_table('shard_buckets')
@@ -1,17 +1,85 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Response
+from fastapi.responses import JSONResponse
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
 from contextlib import asynccontextmanager
-from DB.sessions import get_db
-from sqlalchemy.orm import Session
-from Routes import users, auth, vaults
-import redis.asyncio as redis
+from DB.sessions import get_db, pool_status, engine_pool_status, shards
+from DB.shards import shard_router
+from DB.cache import get_redis
+from DB.notify import vault_events
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from Routes import users, auth, vaults, chunks, admin
 from fastapi_limiter import FastAPILimiter
-import os
+import os, time, asyncio
 from fastapi.middleware.cors import CORSMiddleware
+from utils.metrics import MetricsMiddleware, render_metrics, process_age, observe_startup
+from utils.shedding import LoadShedder
+from utils.serialization import JSONResponseClass
+from utils.hashing import key_hasher
+from utils.tokens import refresh_families
+from utils.logger import logger, AccessLogMiddleware
+from config.configs import settings
 
 cors_origins_str = os.getenv("CORS_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173")
 origins = [origin.strip() for origin in cors_origins_str.split(",")]
 
-app = FastAPI()
+
+async def warm_pool(eng, n: int):
+    async def connect():
+        async with eng.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    #? Concurrent, so n connections are really open at once and go back to the pool together
+    await asyncio.gather(*(connect() for _ in range(n)))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start = time.perf_counter()
+    imported = process_age() #? Interpreter start and the import graph, before any IO
+
+    r = get_redis()
+    if r is None:
+        logger.warning("REDIS_URL is not set, sessions and rate limits are kept in this process only")
+    else:
+        try:
+            await r.ping()
+            await FastAPILimiter.init(r)
+        except Exception as err:
+            logger.warning("Redis is unreachable, rate limits use in-process buckets until it is back, %s", err)
+
+    for eng in [eng for shard in shards for eng in shard.engines]:
+        try:
+            await warm_pool(eng, min(settings.pool_warm_connections, settings.db_pool_size))
+        except Exception as err:
+            logger.warning("Could not warm the pool for %s, %s", eng.url.host, err) #? /ready reports it, starting anyway
+
+    await shard_router.start(settings.shard_map_sync_seconds)
+    await key_hasher.warm_up()
+    refresh_families.start(settings.revocation_sync_seconds)
+    logger.info("Startup took %.0fms", (time.perf_counter() - start) * 1000)
+
+    ready = process_age()
+    if imported is not None and ready is not None:
+        #? Cold start per worker, recycled ones included, this is what scaling out has to wait for
+        observe_startup("import", imported)
+        observe_startup("ready", ready)
+        logger.info("Worker %s ready %.2fs after process start, imports took %.2fs", os.getpid(), ready, imported)
+
+    yield
+
+    await vault_events.stop()
+    await refresh_families.stop()
+    await shard_router.stop()
+    key_hasher.shutdown()
+    for eng in [eng for shard in shards for eng in shard.engines]:
+        await eng.dispose()
+    if r is not None:
+        await r.aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponseClass)
+#? Last added runs first: metrics see every response, CORS headers go on shed 503s too
+app.add_middleware(LoadShedder)
 app.add_middleware(
     CORSMiddleware, 
     allow_origins=origins, 
@@ -20,15 +88,38 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"]
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(AccessLogMiddleware) #? Outermost, every record and response of a request carries its id
 
 @app.get('/')
-def start_function():
+async def start_function():
     return {"message": "success"}
 
-@app.get('/database')
-def check_db(db: Session = Depends(get_db)):
-    return {"success": "Connected successfully"}
+@app.get('/ready') #? Readiness probe, fails when a shard's database is unreachable or its pool is close to exhausted
+async def check_ready(db: AsyncSession = Depends(get_db)):
+    try:
+        await db.execute(text("SELECT 1"))
+        for shard in shards[1:]:
+            async with shard.session() as shard_db:
+                await shard_db.execute(text("SELECT 1"))
+    except Exception as err:
+        logger.error("Readiness check failed, %s", err)
+        return JSONResponse(status_code=HTTP_503_SERVICE_UNAVAILABLE, content={"ready": False, "reason": "database unreachable"})
+
+    pools = [pool_status(), *(engine_pool_status(shard.engine) for shard in shards[1:])]
+    ready = all(pool["saturation"] < settings.ready_max_pool_saturation for pool in pools)
+    content = {"ready": ready, "pool": pools[0]}
+    if len(pools) > 1:
+        content["shards"] = pools[1:]
+    return JSONResponse(status_code=200 if ready else HTTP_503_SERVICE_UNAVAILABLE, content=content)
+
+@app.get('/metrics')
+async def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 app.include_router(users.router)
 app.include_router(auth.router)
-app.include_router(vaults.router)
\ No newline at end of file
+app.include_router(vaults.router)
+app.include_router(chunks.router)
+app.include_router(admin.router)
\ No newline at end of file
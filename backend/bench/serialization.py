@@ -0,0 +1,124 @@
+"""Serialization benchmark for the JSON response paths, no server or database needed.
+
+    cd backend && python bench/serialization.py --sizes 1024,10240,102400,1048576,10485760
+
+For each vault size it times building the GET /vaults JSON body three ways:
+
+    response_model  validate into VaultClient, dump to JSON types, json.dumps (the stock FastAPI path)
+    orjson          dict straight from the row, FastJSONResponse (FAST_JSON=true)
+    streamed        iter_vault_json joined, the bytes GET /vaults serves today
+
+plus a 1000 row GET /users page through UserResponse and through orjson. Prints the
+median per body and the throughput in MB of ciphertext per second, --out writes JSON.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from pydantic import TypeAdapter
+from schemas.schemas import VaultClient, UserResponse
+
+try:
+    import orjson
+except ImportError:
+    sys.exit("orjson is needed for the comparison, pip install orjson")
+
+
+def stock_render(content) -> bytes:
+    #? What starlette's JSONResponse.render does
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def iter_vault_json(vault_id: int, data: bytes, nonce_b64: str, version: int, chunk: int = 48 * 1024):
+    #? Same as Routes/vaults.py, copied so the benchmark doesn't need the app's settings or a database
+    yield f'{{"id":{vault_id},"encrypted_data":"'.encode("utf-8")
+    view = memoryview(data)
+    for i in range(0, len(view), chunk):
+        yield base64.b64encode(view[i:i + chunk])
+    yield f'","nonce_b64":{json.dumps(nonce_b64)},"version":{version}}}'.encode("utf-8")
+
+
+VAULT = TypeAdapter(VaultClient)
+USERS = TypeAdapter(list[UserResponse])
+
+def vault_paths(blob: bytes) -> dict:
+    def response_model():
+        row = {"id": 1, "encrypted_data": base64.b64encode(blob).decode("utf-8"), "nonce_b64": "bm9uY2U=", "version": 7}
+        return stock_render(VAULT.dump_python(VAULT.validate_python(row), mode="json"))
+
+    def fast():
+        return orjson.dumps({"id": 1, "encrypted_data": base64.b64encode(blob).decode("utf-8"), "nonce_b64": "bm9uY2U=", "version": 7})
+
+    def streamed():
+        return b"".join(iter_vault_json(1, blob, "bm9uY2U=", 7))
+
+    return {"response_model": response_model, "orjson": fast, "streamed": streamed}
+
+def user_paths(n: int) -> dict:
+    now = datetime.now(timezone.utc)
+    rows = [{"username": f"user{i}@example.com", "id": i, "created_at": now} for i in range(n)]
+
+    def response_model():
+        return stock_render(USERS.dump_python(USERS.validate_python(rows), mode="json"))
+
+    def fast():
+        return orjson.dumps(rows, option=orjson.OPT_UTC_Z)
+
+    return {"response_model": response_model, "orjson": fast}
+
+
+def measure(fn, rounds: int, min_seconds: float) -> float:
+    """Median seconds per call. Repeats until min_seconds passed so small bodies get enough samples"""
+    fn()
+    samples = []
+    deadline = time.perf_counter() + min_seconds
+    while len(samples) < rounds or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1024,10240,102400,1048576,10485760", help="Vault sizes in bytes, comma separated")
+    parser.add_argument("--rounds", type=int, default=20, help="Minimum samples per path")
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="Minimum time per path")
+    parser.add_argument("--users", type=int, default=1000, help="Rows in the GET /users page")
+    parser.add_argument("--out", help="Write the results as JSON")
+    args = parser.parse_args()
+
+    results = {"python": platform.python_version(), "orjson": orjson.__version__, "vaults": [], "users": {}}
+
+    print(f"{'vault bytes':>12}{'path':>16}{'median ms':>12}{'MB/s':>10}{'vs stock':>10}")
+    for size in [int(x) for x in args.sizes.split(",")]:
+        blob = os.urandom(size)
+        stock = None
+        for name, fn in vault_paths(blob).items():
+            took = measure(fn, args.rounds, args.min_seconds)
+            stock = stock or took
+            results["vaults"].append({"bytes": size, "path": name, "median_ms": round(took * 1000, 4)})
+            print(f"{size:>12}{name:>16}{took * 1000:>12.3f}{size / took / 1e6:>10.0f}{stock / took:>9.1f}x")
+
+    print(f"\n{'users':>12}{'path':>16}{'median ms':>12}")
+    for name, fn in user_paths(args.users).items():
+        took = measure(fn, args.rounds, args.min_seconds)
+        results["users"][name] = round(took * 1000, 4)
+        print(f"{args.users:>12}{name:>16}{took * 1000:>12.3f}")
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent=2))
+        print(f"\nSaved {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,81 @@ class Settings(BaseSettings):
     database_url: str
     cors_origins: str
 
+    db_pool_size: int = 20
+    db_max_overflow: int = 30
+    db_pool_timeout: int = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    db_echo: bool = False #? SQL statements go through the log queue at INFO, sample them with LOG_SAMPLE_RATES=sqlalchemy.engine=0.01
+    max_vault_bytes: int = 16 * 1024 * 1024 #? Largest ciphertext accepted on POST /vaults, bigger uploads get 413
+    max_chunk_bytes: int = 1024 * 1024 #? Largest single chunk of a chunked vault
+    max_chunk_upload_bytes: int = 16 * 1024 * 1024 #? Chunk bytes per POST /vaults/chunks request, bigger uploads get 413
+    blob_backend: str = "database" #? database keeps ciphertext in vaults.encrypted_data, file or s3 moves it to DB/blobstore.py
+    blob_dir: str = "/var/lib/occultus/blobs"
+    s3_bucket: str = "occultus-vaults"
+    s3_endpoint_url: str | None = None
+    s3_access_key: str | None = None
+    s3_secret_key: str | None = None
+    s3_region: str | None = None
+    fast_json: bool = False #? orjson responses without response_model validation on the hot routes, needs orjson installed
+    vault_cache_ttl: float = 5 #? Seconds an encoded vault body is served from memory after a read
+    vault_cache_bytes: int = 64 * 1024 * 1024
+    vault_cache_entries: int = 256
+    replica_urls: str = "" #? Comma separated postgresql:// urls of read replicas
+    shard_urls: str = "" #? Comma separated shards after the first, each "primary_url|replica_url|...". Shard 0 is DATABASE_URL with REPLICA_URLS
+    shard_map_sync_seconds: float = 5 #! Same value for every worker and for scripts.rebalance, which waits on it before moving data
+    read_your_writes_ttl: int = 300 #? Seconds the last vault version written for a user is remembered (in redis), replica reads older than that go to the primary
+    ready_max_pool_saturation: float = 0.9 #? /ready fails above this share of checked out connections
+
+    redis_url: str | None = None #! Required for more than one worker (server.py), sessions and rate limits are shared through it
+    user_cache_ttl: int = 60
+    user_cache_size: int = 10000
+
+    rate_limit_login: str = "10/60" #? requests/seconds per client ip, shared through redis when it is up
+    rate_limit_salt: str = "30/60"
+    rate_limit_register: str = "5/60"
+    rate_limit_vaults: str = "120/60"
+    shed_target_p99: float = 0.5 #? Seconds to first byte, above it low priority requests start getting 503
+    shed_min_concurrency: int = 8
+    shed_max_concurrency: int = 512 #! Hard cap, authenticated vault sync is only shed above this
+    pool_warm_connections: int = 5 #? Opened per engine at startup so the first requests don't pay for the connects
+
+    refresh_token_minutes: int = 60 * 24 * 7
+    refresh_reuse_grace: int = 10 #? Seconds the previous refresh token still gets a soft 401 instead of revoking its family
+    token_cache_size: int = 50000
+    revocation_bloom_capacity: int = 100000
+    revocation_sync_seconds: float = 5
+
+    idempotency_ttl: int = 3600 #? How long a completed response is replayed for its Idempotency-Key
+    idempotency_pending_ttl: int = 60 #! Must outlast the slowest write, a crashed worker's marker frees the key after this
+    idempotency_cache_size: int = 10000
+
+    admin_token: str | None = None #? Enables the /admin routes, sent as X-Admin-Token. Unset means they answer 404
+    export_batch: int = 500
+    import_batch: int = 5000 #? Rows per COPY and merge transaction
+
+    log_level: str = "INFO"
+    log_format: str = "json" #? json or text
+    log_queue_size: int = 10000 #? Records waiting for the writer thread, more are dropped and counted
+    log_sample_rates: str = "" #? "DEBUG=0.01,sqlalchemy.engine=0.1", by level name or logger name
+    log_access_sample: float = 1.0 #? Share of fast successful requests that get an access record
+    log_slow_ms: float = 1000
+
+    web_host: str = "0.0.0.0"
+    web_port: int = 8000
+    web_workers: int = 0 #? 0 means one per available core (cgroup quota or CPU affinity)
+    web_backlog: int = 2048
+    web_keep_alive: int = 75 #! Keep above the load balancer's idle timeout or it reuses sockets the server already closed
+    web_max_requests: int = 20000 #? A worker exits gracefully after this many requests and a fresh one takes over, 0 disables
+    web_max_requests_jitter: int = 2000 #? So the workers don't all recycle at the same moment
+    web_graceful_timeout: int = 30
+
+    argon2_time_cost: int = 3
+    argon2_memory_cost: int = 65536 #? KiB
+    argon2_parallelism: int = 1
+    hash_workers: int = 0 #? 0 means one per core
+    hash_max_pending: int = 64
+
     model_config = SettingsConfigDict(env_file=str(ENV_PATH), case_sensitive=False, env_file_encoding="utf-8")
 
 settings = Settings()
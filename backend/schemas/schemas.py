@@ -1,4 +1,5 @@
 from pydantic import BaseModel, ConfigDict, EmailStr, Field
+from typing import List
 from datetime import datetime as dt
 
 class UserBase(BaseModel):
@@ -17,6 +18,10 @@ class UserLogin(BaseModel):
     hashed_key_a: str
     
 
+class CurrentUser(BaseModel): #? What the routes need from the authenticated user, small enough to cache
+    id: int
+    username: str
+
 class UserResponse(UserBase):
     id: int
     created_at: dt
@@ -27,7 +32,7 @@ class VaultCreate(BaseModel):
     nonce_b64: str
 
 class VaultSync(VaultCreate):
-    version: int
+    version: int | None = None #? Optional when the client sends If-Match instead
 
 class VaultResponse(BaseModel):
     id: int
@@ -43,6 +48,31 @@ class VaultClient(BaseModel):
     version: int
     model_config = ConfigDict(from_attributes=True)
 
+class VaultAck(BaseModel): #? Returned after a write, the client already holds the blob it just sent
+    id: int
+    nonce_b64: str
+    version: int
+
+class ChunkHashes(BaseModel):
+    hashes: List[str] = Field(max_length=10000)
+
+class ChunkUpload(BaseModel):
+    hash: str = Field(min_length=64, max_length=64)
+    encrypted_data: str
+    nonce_b64: str
+
+class ChunkClient(ChunkUpload):
+    pass
+
+class ManifestSync(BaseModel):
+    chunks: List[str] = Field(max_length=10000)
+    version: int | None = None
+
+class ManifestClient(BaseModel):
+    id: int
+    chunks: List[str]
+    version: int
+
 class Token(BaseModel):
     access_token: str
     refresh_token: str
@@ -0,0 +1,63 @@
+"""Bulk imports accounts and their vaults from a file.
+
+    cd backend && python -m scripts.bulk_import users.ndjson[.gz] [--format ndjson|binary] [--hashing hash|defer] [--report rows.ndjson]
+
+Input is one record per user (see DB/bulk_import.py), a file written by
+scripts.export works as it is. Every row that is not inserted is written to the
+report with its row number and why (exists, duplicate, invalid, or unavailable
+while the user's bucket is being moved between shards). The counts
+and the rate go to stderr.
+
+--hashing hash runs argon2 on each raw key_a in a local process pool, which
+bounds the rate at a few hashes per core per second. --hashing defer skips that
+and stores the raw key_a. The first login then replaces it with the hash.
+"""
+import argparse
+import asyncio
+import json
+import sys
+from DB.bulk_import import import_records, ImportStats, READERS, HASHING_MODES, gunzip
+from config.configs import settings
+from utils.hashing import key_hasher
+
+READ_SIZE = 1024 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+async def read_file(path: str):
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_SIZE):
+            yield chunk
+
+
+async def bulk_import(path: str, fmt: str, hashing: str, batch: int, report_path: str | None):
+    with open(path, "rb") as f:
+        compressed = f.read(2) == GZIP_MAGIC
+
+    chunks = gunzip(read_file(path)) if compressed else read_file(path)
+    stats = ImportStats()
+    report = open(report_path, "w") if report_path else None
+    try:
+        async for entry in import_records(READERS[fmt](chunks), hashing, batch, stats):
+            if report:
+                report.write(json.dumps(entry) + "\n")
+            elif entry["status"] in ("invalid", "unavailable"):
+                print(f"row {entry['row']}: {entry['detail']}", file=sys.stderr)
+    finally:
+        if report:
+            report.close()
+        key_hasher.shutdown()
+
+    print(json.dumps(stats.report()), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=list(READERS), default="ndjson")
+    parser.add_argument("--hashing", choices=HASHING_MODES, default="hash")
+    parser.add_argument("--batch", type=int, default=settings.import_batch)
+    parser.add_argument("--report", help="NDJSON file for the rows that were not inserted")
+    args = parser.parse_args()
+
+    asyncio.run(bulk_import(args.path, args.format, args.hashing, args.batch, args.report))
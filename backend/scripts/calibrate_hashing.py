@@ -0,0 +1,47 @@
+"""Finds argon2 parameters that take about --target-ms per hash on this host.
+
+    python scripts/calibrate_hashing.py --target-ms 250 --memory-mib 64
+
+Prints the ARGON2_* settings to put in .env. Users hashed with older parameters
+are rehashed on their next login.
+"""
+import argparse
+import statistics
+import time
+from argon2 import PasswordHasher
+
+
+def measure(time_cost: int, memory_cost: int, parallelism: int, rounds: int) -> float:
+    ph = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        ph.hash("calibration-secret")
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def calibrate(target_ms: float, memory_cost: int, parallelism: int, rounds: int, max_time_cost: int = 50) -> tuple[int, float]:
+    """Raises time_cost until a hash reaches the target, memory is fixed since it bounds how many logins fit in RAM"""
+    time_cost, took = 1, measure(1, memory_cost, parallelism, rounds)
+    while took < target_ms and time_cost < max_time_cost:
+        time_cost += 1
+        took = measure(time_cost, memory_cost, parallelism, rounds)
+    return time_cost, took
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target-ms", type=float, default=250)
+    parser.add_argument("--memory-mib", type=int, default=64)
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    memory_cost = args.memory_mib * 1024
+    time_cost, took = calibrate(args.target_ms, memory_cost, args.parallelism, args.rounds)
+
+    print(f"# median {took:.1f} ms per hash, target {args.target_ms:.0f} ms")
+    print(f"ARGON2_TIME_COST={time_cost}")
+    print(f"ARGON2_MEMORY_COST={memory_cost}")
+    print(f"ARGON2_PARALLELISM={args.parallelism}")
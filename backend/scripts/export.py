@@ -0,0 +1,76 @@
+"""Exports every user and their vault to a file, for backups and moving tenants.
+
+    cd backend && python -m scripts.export backup.ndjson.gz [--format ndjson|binary] [--gzip] [--resume]
+
+Records come in user id order through a server side cursor (see DB/export.py for
+the formats). After every batch the file is flushed and <out>.checkpoint records
+the last user id and the file size. --resume cuts the file back to that size and
+continues after that user, so an interrupted export never starts over and never
+writes a record twice. With --gzip every batch is a complete gzip member, and the
+concatenation is a normal .gz file.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from DB.export import export_stream, Throughput
+from config.configs import settings
+
+
+def read_checkpoint(path: str) -> dict | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path: str, checkpoint: dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, path) #? Atomic, a crash leaves the previous checkpoint and never half of one
+
+
+async def export(out: str, fmt: str, gzip: bool, resume: bool, batch: int, report_every: float):
+    checkpoint_path = f"{out}.checkpoint"
+    checkpoint = read_checkpoint(checkpoint_path) if resume else None
+    if checkpoint and (checkpoint["format"], checkpoint["gzip"]) != (fmt, gzip):
+        sys.exit(f"{out} was started as format={checkpoint['format']} gzip={checkpoint['gzip']}, resume it with the same options")
+    after = checkpoint["after"] if checkpoint else None
+
+    progress = Throughput()
+    next_report = time.monotonic() + report_every
+
+    with open(out, "r+b" if checkpoint else "wb") as f:
+        if checkpoint:
+            f.truncate(checkpoint["offset"]) #! Drops whatever was written after the checkpoint, it is exported again
+            f.seek(checkpoint["offset"])
+            print(f"Resuming after user {after} at byte {checkpoint['offset']}", file=sys.stderr)
+
+        async for last_id, data in export_stream(fmt, after, batch, gzip, progress):
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            write_checkpoint(checkpoint_path, {"after": last_id, "offset": f.tell(), "format": fmt, "gzip": gzip})
+
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + report_every
+                print(f"at user {last_id}: {progress.report()}", file=sys.stderr)
+
+    print(progress.report(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out")
+    parser.add_argument("--format", choices=["ndjson", "binary"], default="ndjson")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--resume", action="store_true", help="continue from <out>.checkpoint")
+    parser.add_argument("--batch", type=int, default=settings.export_batch)
+    parser.add_argument("--report-every", type=float, default=10, help="seconds between progress lines")
+    args = parser.parse_args()
+
+    asyncio.run(export(args.out, args.format, args.gzip, args.resume, args.batch, args.report_every))
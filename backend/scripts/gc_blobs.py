@@ -0,0 +1,57 @@
+"""Deletes blobs that no vault references any more.
+
+    cd backend && python -m scripts.gc_blobs --grace-hours 24 [--dry-run]
+
+Every vault write stores a new blob and only then swaps the row over, so the old
+blob (and any upload that lost its compare-and-swap) is left behind. Blobs newer
+than the grace period are kept: their row may not be committed yet. References are
+read from every shard, the blob store is shared by all of them.
+"""
+import argparse
+import time
+from sqlalchemy import create_engine, Select
+from DB.sessions import SHARD_URLS
+from DB.blobstore import blob_store
+from Models.models import Vault
+
+
+def referenced_hashes(engines) -> set[str]:
+    live = set()
+    stmt = Select(Vault.blob_hash).where(Vault.blob_hash.is_not(None)).distinct()
+    for engine in engines:
+        with engine.connect() as conn:
+            live.update(conn.execute(stmt).scalars())
+    return live
+
+
+def collect(engines, grace_seconds: float, dry_run: bool) -> tuple[int, int]:
+    cutoff = time.time() - grace_seconds
+    #? Listing first and reading references second: a blob written after the listing is never a candidate
+    candidates = [h for h, mtime in blob_store.iter_hashes() if mtime < cutoff]
+    live = referenced_hashes(engines)
+
+    deleted = 0
+    for blob_hash in candidates:
+        if blob_hash in live:
+            continue
+        modified = blob_store.modified(blob_hash)
+        if modified is None or modified >= cutoff:
+            continue #? Uploaded again since the listing (put touches it), a row may be about to point at it
+        if not dry_run:
+            blob_store.delete_blob(blob_hash)
+        deleted += 1
+    return len(candidates), deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grace-hours", type=float, default=24)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    if blob_store is None:
+        raise SystemExit("BLOB_BACKEND is database, nothing to collect")
+
+    engines = [create_engine(url) for url, _ in SHARD_URLS]
+    checked, deleted = collect(engines, args.grace_hours * 3600, args.dry_run)
+    print(f"{'would delete' if args.dry_run else 'deleted'} {deleted} of {checked} blobs older than {args.grace_hours}h")
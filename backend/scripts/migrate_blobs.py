@@ -0,0 +1,90 @@
+"""Moves inline vault ciphertexts into the blob store, or back into vaults.encrypted_data.
+
+    cd backend && python -m scripts.migrate_blobs [--batch 500]
+    cd backend && python -m scripts.migrate_blobs --to-database
+
+Run it after `alembic upgrade head` with BLOB_BACKEND set, while the app keeps
+serving: vaults are read from either place. Blobs are stored before each batch's
+transaction opens, and every batch commits on its own, so no lock is held across
+blob writes. A vault written since its batch was read is left alone, that write
+already went where BLOB_BACKEND says. Runs on every shard.
+
+--to-database is needed before downgrading past 6ae6433d12d9. Switch the app to
+BLOB_BACKEND=database first, or it keeps writing new vaults to the blob store.
+"""
+import argparse
+from sqlalchemy import create_engine, Select, func, text, update
+from DB.sessions import SHARD_URLS
+from DB.blobstore import blob_store
+from Models.models import Vault
+
+
+def quiet(conn):
+    #? Same vault version, the devices have nothing to fetch. The trigger skips this setting (migration 9f3b2d7c41e8)
+    conn.execute(text("SET LOCAL occultus.rebalancing = 'on'"))
+
+
+def to_blob_store(engine, batch: int) -> int:
+    moved = 0
+    last_id = 0
+    while True:
+        stmt = (
+            Select(Vault.id, Vault.version, Vault.encrypted_data)
+            .where(Vault.id > last_id, Vault.encrypted_data.is_not(None), func.length(Vault.encrypted_data) > 0)
+            .order_by(Vault.id)
+            .limit(batch)
+        )
+        with engine.connect() as conn:
+            rows = conn.execute(stmt).all()
+        if not rows:
+            return moved
+
+        blobs = {r.id: blob_store.put_bytes(bytes(r.encrypted_data)) for r in rows}
+        with engine.begin() as conn:
+            quiet(conn)
+            for r in rows:
+                res = conn.execute(
+                    update(Vault)
+                    .where(Vault.id == r.id, Vault.version == r.version, Vault.encrypted_data.is_not(None))
+                    .values(encrypted_data=None, blob_hash=blobs[r.id].hash, blob_size=blobs[r.id].size)
+                )
+                moved += res.rowcount
+        last_id = rows[-1].id
+
+
+def to_database(engine, batch: int) -> int:
+    moved = 0
+    last_id = 0
+    while True:
+        stmt = Select(Vault.id, Vault.version, Vault.blob_hash).where(Vault.id > last_id, Vault.blob_hash.is_not(None)).order_by(Vault.id).limit(batch)
+        with engine.connect() as conn:
+            rows = conn.execute(stmt).all()
+        if not rows:
+            return moved
+
+        data = {r.id: blob_store.read_bytes(r.blob_hash) for r in rows}
+        with engine.begin() as conn:
+            quiet(conn)
+            for r in rows:
+                res = conn.execute(
+                    update(Vault)
+                    .where(Vault.id == r.id, Vault.version == r.version, Vault.blob_hash == r.blob_hash)
+                    .values(encrypted_data=data[r.id], blob_hash=None, blob_size=None)
+                )
+                moved += res.rowcount
+        last_id = rows[-1].id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=500, help="Vaults per transaction")
+    parser.add_argument("--to-database", action="store_true", help="Move ciphertexts from the blob store back into Postgres")
+    args = parser.parse_args()
+
+    if blob_store is None:
+        raise SystemExit("BLOB_BACKEND is database, set it to the store the blobs go to or come from")
+
+    move = to_database if args.to_database else to_blob_store
+    for shard, (url, _) in enumerate(SHARD_URLS):
+        moved = move(create_engine(url), args.batch)
+        print(f"shard {shard}: moved {moved} vaults {'into the database' if args.to_database else 'into the blob store'}")
@@ -0,0 +1,309 @@
+"""Moves users between shards a bucket at a time, while the app keeps serving them.
+
+    cd backend && python -m scripts.rebalance status
+    cd backend && python -m scripts.rebalance balance [--limit 32] [--dry-run]
+    cd backend && python -m scripts.rebalance move 17 42 --to 2
+    cd backend && python -m scripts.rebalance prune [--dry-run]
+
+Users are placed by bucket (see DB/shards.py). A bucket that was never moved lives
+on shard 0, so adding a shard to SHARD_URLS moves nothing by itself: migrate the
+new database (alembic -x shard=N upgrade head), restart the app with the new
+SHARD_URLS, then run balance. It moves the buckets with the fewest users off the
+shards with the most buckets until every shard holds the same number, so new
+users spread evenly as well.
+
+A move copies the bucket's users, vaults and chunks to the target while writes go
+on, then marks the bucket as moving. Workers refuse its writes with 503 and
+Retry-After from then on, and once every worker has seen that (the map lease plus
+WRITE_GRACE) the rest is copied and the map points the bucket at the target.
+After one more lease the rows are deleted from the source. Writes to the bucket
+pause for about that long, reads never do. Running an interrupted move again
+picks it up where it stopped, and prune deletes rows an interrupted move left on
+a shard that no longer holds their bucket.
+
+To try it locally with three Postgres instances:
+
+    docker compose -f docker-compose.yml -f docker-compose.shards.yml up
+"""
+import argparse
+import asyncio
+import sys
+from sqlalchemy import Select, Delete, func, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from DB.sessions import shards, async_session, Shard
+from DB.shards import shard_router, bucket_column, BUCKETS
+from Models.models import User, Vault, VaultChunk, ShardBucket
+
+COPY_BATCH = 500 #? Users per statement, vault and chunk rows are fetched for that many users at a time
+WRITE_GRACE = 5 #? Seconds for a write that passed the lease check just before it ran out to finish
+
+USER_COLUMNS = ("id", "username", "salt_b64", "hashed_key_a", "created_at")
+VAULT_COLUMNS = ("id", "user_id", "encrypted_data", "blob_hash", "blob_size", "nonce_b64", "version", "manifest")
+CHUNK_COLUMNS = ("id", "user_id", "chunk_hash", "encrypted_data", "nonce_b64")
+
+
+def log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+def batches(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def quiet(db: AsyncSession):
+    #? The vault trigger stays silent in this transaction, see the 9f3b2d7c41e8 migration
+    await db.execute(text("SET LOCAL occultus.rebalancing = 'on'"))
+
+
+async def load_map() -> dict:
+    async with async_session() as db:
+        return {r.bucket: r for r in await db.execute(Select(ShardBucket.bucket, ShardBucket.shard, ShardBucket.moving_to))}
+
+
+async def set_bucket(bucket: int, shard: int, moving_to: int | None):
+    async with async_session() as db:
+        stmt = insert(ShardBucket).values(bucket=bucket, shard=shard, moving_to=moving_to)
+        stmt = stmt.on_conflict_do_update(index_elements=[ShardBucket.bucket], set_={"shard": shard, "moving_to": moving_to, "updated_at": func.now()})
+        await db.execute(stmt)
+        await db.commit()
+
+
+async def bucket_sizes(shard: Shard) -> dict[int, int]:
+    """Users per bucket on one shard"""
+    async with shard.session() as db:
+        stmt = Select(bucket_column, func.count()).select_from(User).group_by(bucket_column)
+        return dict((await db.execute(stmt)).tuples().all())
+
+
+async def copy_bucket(bucket: int, src: Shard, dst: Shard) -> dict:
+    """Makes dst hold exactly what src holds of the bucket, in one transaction on dst. Only rows that differ are written,
+    so the copy after writes were paused is small"""
+
+    counts = {"users": 0, "vaults": 0, "chunks": 0, "removed": 0}
+    async with src.session() as s, dst.session() as d:
+        await quiet(d)
+        users = (await s.execute(Select(*(getattr(User, c) for c in USER_COLUMNS)).where(bucket_column == bucket))).all()
+        ids = [u.id for u in users]
+
+        #! Users dst has that src no longer has (deleted since an earlier copy) go first, a new account with the same
+        #! username would conflict with them
+        stale = set((await d.execute(Select(User.id).where(bucket_column == bucket))).scalars()) - set(ids)
+        for part in batches(list(stale), COPY_BATCH):
+            await d.execute(Delete(User).where(User.id.in_(part)))
+        counts["removed"] += len(stale)
+
+        for part in batches(users, COPY_BATCH):
+            stmt = insert(User).values([u._asdict() for u in part])
+            stmt = stmt.on_conflict_do_update(index_elements=[User.id], set_={c: stmt.excluded[c] for c in USER_COLUMNS[1:]})
+            await d.execute(stmt)
+        counts["users"] = len(users)
+
+        for part in batches(ids, COPY_BATCH):
+            #? (id, version) names a vault's content, an equal pair needs no copy
+            versions = Select(Vault.user_id, Vault.id, Vault.version).where(Vault.user_id.in_(part))
+            want = {r.user_id: (r.id, r.version) for r in await s.execute(versions)}
+            have = {r.user_id: (r.id, r.version) for r in await d.execute(versions)}
+
+            gone = list(have.keys() - want.keys())
+            if gone:
+                await d.execute(Delete(Vault).where(Vault.user_id.in_(gone)))
+            changed = [user_id for user_id, v in want.items() if have.get(user_id) != v]
+            for few in batches(changed, COPY_BATCH // 10): #? Inline ciphertexts, a few MB each at most
+                rows = (await s.execute(Select(*(getattr(Vault, c) for c in VAULT_COLUMNS)).where(Vault.user_id.in_(few)))).all()
+                stmt = insert(Vault).values([r._asdict() for r in rows])
+                stmt = stmt.on_conflict_do_update(index_elements=[Vault.user_id], set_={c: stmt.excluded[c] for c in VAULT_COLUMNS if c != "user_id"})
+                await d.execute(stmt)
+                counts["vaults"] += len(rows)
+
+            #? Chunks never change, they are only added and dropped
+            keys = Select(VaultChunk.user_id, VaultChunk.chunk_hash).where(VaultChunk.user_id.in_(part))
+            want = set((await s.execute(keys)).tuples())
+            have = set((await d.execute(keys)).tuples())
+            extra = list(have - want)
+            for few in batches(extra, COPY_BATCH):
+                await d.execute(Delete(VaultChunk).where(tuple_(VaultChunk.user_id, VaultChunk.chunk_hash).in_(few)))
+            missing = list(want - have)
+            for few in batches(missing, COPY_BATCH // 10):
+                stmt = Select(*(getattr(VaultChunk, c) for c in CHUNK_COLUMNS)).where(tuple_(VaultChunk.user_id, VaultChunk.chunk_hash).in_(few))
+                rows = (await s.execute(stmt)).all()
+                await d.execute(insert(VaultChunk).values([r._asdict() for r in rows]).on_conflict_do_nothing())
+                counts["chunks"] += len(rows)
+            counts["removed"] += len(gone) + len(extra)
+
+        await d.commit()
+    return counts
+
+
+async def bucket_rows(bucket: int, shard: Shard) -> set:
+    """What a later change to the bucket would show up in: users, their key hashes and vault versions"""
+    async with shard.session() as db:
+        stmt = (
+            Select(User.id, User.hashed_key_a, Vault.id, Vault.version)
+            .outerjoin(Vault, Vault.user_id == User.id)
+            .where(bucket_column == bucket)
+        )
+        return set((await db.execute(stmt)).tuples())
+
+
+async def delete_bucket(bucket: int, shard: Shard) -> int:
+    """Deletes the bucket's users from a shard, their vaults and chunks go with them (ON DELETE CASCADE)"""
+
+    deleted = 0
+    while True:
+        async with shard.session() as db:
+            await quiet(db)
+            ids = Select(User.id).where(bucket_column == bucket).limit(COPY_BATCH).scalar_subquery()
+            res = await db.execute(Delete(User).where(User.id.in_(ids)))
+            await db.commit()
+        if res.rowcount == 0:
+            return deleted
+        deleted += res.rowcount
+
+
+async def move_bucket(bucket: int, target: int):
+    row = (await load_map()).get(bucket)
+    source = row.shard if row else 0
+    moving_to = row.moving_to if row else None
+
+    if moving_to is not None and moving_to != target:
+        raise SystemExit(f"Bucket {bucket} is being moved to shard {moving_to}, run that move again to finish it first")
+    if source == target:
+        log(f"bucket {bucket} is already on shard {target}")
+        return
+
+    src, dst = shards[source], shards[target]
+    wait = shard_router.lease + WRITE_GRACE
+
+    if moving_to is None:
+        counts = await copy_bucket(bucket, src, dst)
+        log(f"bucket {bucket}: copied {counts} to shard {target}, pausing its writes")
+        await set_bucket(bucket, source, target)
+    else:
+        log(f"bucket {bucket}: resuming the move to shard {target}")
+
+    #! Every worker refuses the bucket's writes after this, by the new map or because its old one ran out
+    await asyncio.sleep(wait)
+    counts = await copy_bucket(bucket, src, dst)
+    copied = await bucket_rows(bucket, src)
+    await set_bucket(bucket, target, None)
+    log(f"bucket {bucket}: copied {counts} while paused, shard {target} holds it now")
+
+    #? Workers still on the old map read from the source until their next sync, its rows stay until then
+    await asyncio.sleep(wait)
+    if await bucket_rows(bucket, src) != copied:
+        raise SystemExit(f"Bucket {bucket} changed on shard {source} after the final copy, its rows are kept there. Compare them with shard {target}")
+    log(f"bucket {bucket}: deleted {await delete_bucket(bucket, src)} users from shard {source}")
+
+
+def plan_moves(assigned: dict[int, int], sizes: dict[int, dict[int, int]], n: int) -> list[tuple[int, int, int]]:
+    """(bucket, source, target) moves that leave every shard with BUCKETS / n buckets, the ones with fewest users moved"""
+
+    owned = {i: [] for i in range(n)}
+    for bucket in range(BUCKETS):
+        owned[assigned.get(bucket, 0)].append(bucket)
+    goal = {i: BUCKETS // n + (1 if i < BUCKETS % n else 0) for i in range(n)}
+
+    spare = []
+    for i in range(n):
+        owned[i].sort(key=lambda b: sizes[i].get(b, 0))
+        spare += [(b, i) for b in owned[i][:max(0, len(owned[i]) - goal[i])]]
+
+    moves = []
+    for target in range(n):
+        for _ in range(max(0, goal[target] - len(owned[target]))):
+            bucket, source = spare.pop(0)
+            moves.append((bucket, source, target))
+    return moves
+
+
+async def status():
+    bucket_map = await load_map()
+    sizes = [await bucket_sizes(shard) for shard in shards]
+    assigned = {b: r.shard for b, r in bucket_map.items()}
+
+    print(f"{'shard':>5} {'buckets':>8} {'users':>10}")
+    for shard in shards:
+        owned = [b for b in range(BUCKETS) if assigned.get(b, 0) == shard.index]
+        print(f"{shard.index:>5} {len(owned):>8} {sum(sizes[shard.index].get(b, 0) for b in owned):>10}")
+
+    for bucket, r in sorted(bucket_map.items()):
+        if r.moving_to is not None:
+            print(f"bucket {bucket} is moving from shard {r.shard} to shard {r.moving_to}")
+    for shard in shards:
+        stray = {b: c for b, c in sizes[shard.index].items() if assigned.get(b, 0) != shard.index}
+        if stray:
+            print(f"shard {shard.index} has {sum(stray.values())} users in {len(stray)} buckets it doesn't hold, see prune")
+
+
+async def balance(limit: int | None, dry_run: bool):
+    bucket_map = await load_map()
+    if any(r.moving_to is not None for r in bucket_map.values()):
+        raise SystemExit("A move was interrupted, see status and run it again with move")
+
+    sizes = {shard.index: await bucket_sizes(shard) for shard in shards}
+    moves = plan_moves({b: r.shard for b, r in bucket_map.items()}, sizes, len(shards))[:limit]
+    for bucket, source, target in moves:
+        log(f"bucket {bucket}: {sizes[source].get(bucket, 0)} users, shard {source} -> {target}")
+        if not dry_run:
+            await move_bucket(bucket, target)
+    log(f"{len(moves)} buckets {'to move' if dry_run else 'moved'}")
+
+
+async def prune(dry_run: bool):
+    """Deletes users from a shard that doesn't hold their bucket, when the shard that does has every one of them"""
+
+    bucket_map = await load_map()
+    for shard in shards:
+        for bucket, count in sorted((await bucket_sizes(shard)).items()):
+            r = bucket_map.get(bucket)
+            owner = r.shard if r else 0
+            if owner == shard.index or (r and r.moving_to is not None):
+                continue
+
+            strays = {row[0] for row in await bucket_rows(bucket, shard)}
+            kept = {row[0] for row in await bucket_rows(bucket, shards[owner])}
+            if not strays <= kept:
+                log(f"bucket {bucket}: shard {shard.index} has {len(strays - kept)} users shard {owner} lacks, left alone")
+                continue
+            if not dry_run:
+                await delete_bucket(bucket, shard)
+            log(f"bucket {bucket}: {'would delete' if dry_run else 'deleted'} {count} users from shard {shard.index}")
+
+
+async def main(args):
+    if not shard_router.sharded:
+        raise SystemExit("Only one shard, set SHARD_URLS")
+    try:
+        if args.command == "status":
+            await status()
+        elif args.command == "balance":
+            await balance(args.limit, args.dry_run)
+        elif args.command == "move":
+            if not 0 <= args.to < len(shards):
+                raise SystemExit(f"No shard {args.to}, SHARD_URLS has {len(shards)}")
+            for bucket in args.buckets:
+                await move_bucket(bucket, args.to)
+        elif args.command == "prune":
+            await prune(args.dry_run)
+    finally:
+        for shard in shards:
+            await shard.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="Buckets and users per shard, unfinished moves")
+    p = commands.add_parser("balance", help="Move buckets until every shard holds the same number")
+    p.add_argument("--limit", type=int, help="Move at most this many buckets")
+    p.add_argument("--dry-run", action="store_true")
+    p = commands.add_parser("move", help="Move buckets to a shard")
+    p.add_argument("buckets", type=int, nargs="+", choices=range(BUCKETS), metavar="BUCKET")
+    p.add_argument("--to", type=int, required=True)
+    p = commands.add_parser("prune", help="Delete rows left on a shard by an interrupted move")
+    p.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
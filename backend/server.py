@@ -0,0 +1,119 @@
+"""Production entrypoint, uvicorn with one worker per available core.
+
+    cd backend && python server.py [--workers 4] [--port 8000]
+
+Every worker is its own process and runs the app's lifespan, so each one opens
+and warms its own DB pool and hashing pool before it takes traffic. Workers
+exit gracefully after WEB_MAX_REQUESTS requests (plus jitter) and the
+supervisor starts a fresh one, which bounds slow leaks and fragmentation.
+Development keeps using `uvicorn app:app --reload`.
+
+More than one worker needs REDIS_URL. Refresh token families, revocations,
+idempotency records, rate limits and the read-your-writes floor are shared
+between workers through redis, without it each worker would keep its own.
+Without REDIS_URL the server starts a single worker and logs an error.
+"""
+import argparse
+import glob
+import importlib.util
+import math
+import os
+import tempfile
+import uvicorn
+from config.configs import settings
+from utils.logger import logger
+
+
+def available_cpus() -> int:
+    """Cores this process may really use: the cgroup CPU quota in containers, else the CPU affinity mask"""
+
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f: #? cgroup v2, "max 100000" when unlimited
+            limit, period = f.read().split()
+            if limit != "max":
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as g:
+                limit, period = int(f.read()), int(g.read())
+                if limit > 0:
+                    quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def fastest(module: str, fallback: str) -> str:
+    """uvloop and httptools come with uvicorn[standard], the pure Python defaults stay usable without them"""
+    if importlib.util.find_spec(module) is None:
+        logger.warning("%s is not installed, using %s", module, fallback)
+        return fallback
+    return module
+
+
+def prepare_workers(workers: int, cpus: int):
+    """Environment the worker processes inherit, set before they are spawned"""
+
+    if workers <= 1:
+        return
+
+    #? Each worker has its own argon2 pool, split the cores between them instead of every worker taking all of them
+    if settings.hash_workers == 0:
+        os.environ["HASH_WORKERS"] = str(max(1, cpus // workers))
+
+    #? Histograms from all workers are merged at scrape time, see render_metrics
+    metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="occultus-metrics-"))
+    for stale in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(stale) #! Left over from a previous run, they would be added to this run's counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=settings.web_host)
+    parser.add_argument("--port", type=int, default=settings.web_port)
+    parser.add_argument("--workers", type=int, default=settings.web_workers, help="0 means one per available core")
+    args = parser.parse_args()
+
+    cpus = available_cpus()
+    workers = args.workers or cpus
+    if workers > 1 and not settings.redis_url:
+        #! A refresh on another worker than the login would fail, a logout would only reach one worker and every rate
+        #! limit would be multiplied by the worker count
+        logger.error("REDIS_URL is not set, starting 1 worker instead of %s. Workers share sessions, revocations, idempotency records and rate limits through redis", workers)
+        workers = 1
+    prepare_workers(workers, cpus)
+
+    options = {}
+    if settings.web_max_requests and workers > 1: #! A single worker runs without a supervisor, recycling it would stop the server
+        options["limit_max_requests"] = settings.web_max_requests
+        if "limit_max_requests_jitter" in uvicorn.Config.__init__.__code__.co_varnames:
+            options["limit_max_requests_jitter"] = settings.web_max_requests_jitter
+        else:
+            logger.warning("This uvicorn has no limit_max_requests_jitter, workers may recycle together")
+
+    logger.info("Starting %s workers on %s available cores", workers, cpus)
+    uvicorn.run(
+        "app:app",
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop=fastest("uvloop", "asyncio"),
+        http=fastest("httptools", "h11"),
+        backlog=settings.web_backlog,
+        timeout_keep_alive=settings.web_keep_alive,
+        timeout_graceful_shutdown=settings.web_graceful_timeout,
+        proxy_headers=True,
+        log_config=None, #? uvicorn's loggers propagate into the queue (utils/logger.py) instead of writing on their own
+        access_log=False, #? AccessLogMiddleware writes the access records, with the request id and route
+        **options,
+    )
+
+
+if __name__ == "__main__":
+    main()
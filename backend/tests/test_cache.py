@@ -0,0 +1,129 @@
+import asyncio
+import pytest
+import utils.cache as cache
+from utils.cache import TTLCache, SizedTTLCache, SingleFlight
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_ttl_cache_expires(clock):
+    c = TTLCache(maxsize=10, ttl=5)
+    c.set("a", 1)
+    c.set("b", 2, ttl=30)
+
+    clock[0] += 6
+    assert c.get("a") is None
+    assert c.get("b") == 2
+    assert len(c) == 1
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")
+    c.set("c", 3)
+
+    assert c.get("b") is None
+    assert (c.get("a"), c.get("c")) == (1, 3)
+
+
+def test_ttl_cache_pop(clock):
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.pop("a")
+    c.pop("missing")
+    assert c.get("a") is None and len(c) == 0
+
+
+def test_sized_cache_bounded_by_bytes(clock):
+    c = SizedTTLCache(maxsize=10, ttl=60, maxbytes=10)
+    c.set("a", b"1234")
+    c.set("b", b"5678")
+    c.set("c", b"90ab")
+
+    assert c.get("a") is None
+    assert c.bytes == 8
+
+
+def test_sized_cache_skips_values_over_the_limit(clock):
+    c = SizedTTLCache(maxsize=10, ttl=60, maxbytes=4)
+    c.set("a", b"12")
+    c.set("big", b"12345")
+
+    assert c.get("big") is None
+    assert c.get("a") == b"12"
+
+
+def test_sized_cache_accounts_replaced_and_expired_values(clock):
+    c = SizedTTLCache(maxsize=10, ttl=5, maxbytes=100)
+    c.set("a", b"1234")
+    c.set("a", b"12")
+    assert c.bytes == 2
+
+    clock[0] += 6
+    assert c.get("a") is None
+    assert c.bytes == 0
+
+
+async def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    started = 0
+    release = asyncio.Event()
+
+    async def load():
+        nonlocal started
+        started += 1
+        await release.wait()
+        return "value"
+
+    waiters = [asyncio.create_task(flight.do("k", load)) for _ in range(5)]
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await asyncio.gather(*waiters) == ["value"] * 5
+    assert started == 1
+    assert flight.counters == {"calls": 1, "shared": 4}
+    assert len(flight) == 0
+
+
+async def test_single_flight_error_reaches_every_caller_and_frees_the_key():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(flight.do("k", fail), flight.do("k", fail), return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in results)
+
+    async def ok():
+        return 1
+
+    assert await flight.do("k", ok) == 1
+
+
+async def test_single_flight_cancelled_caller_does_not_cancel_the_others():
+    flight = SingleFlight()
+    release = asyncio.Event()
+
+    async def load():
+        await release.wait()
+        return "value"
+
+    first = asyncio.create_task(flight.do("k", load))
+    second = asyncio.create_task(flight.do("k", load))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+
+    assert await second == "value"
+    with pytest.raises(asyncio.CancelledError):
+        await first
@@ -0,0 +1,42 @@
+import pytest
+from fastapi import HTTPException
+from Routes.vaults import make_etag, parse_etags, etag_matches, if_match_version
+
+
+def test_make_etag():
+    assert make_etag(7, 3) == '"7-3"'
+
+
+def test_parse_etags_strips_quotes_and_weak_prefix():
+    assert parse_etags('"7-3", W/"7-4" ,8-1') == ["7-3", "7-4", "8-1"]
+
+
+@pytest.mark.parametrize("value, matches", [
+    ('"7-3"', True),
+    ('W/"7-3"', True),
+    ('"1-1", "7-3"', True),
+    ("*", True),
+    ('"7-2"', False),
+    ('"8-3"', False), #? Same version of another vault, a deleted and recreated one starts over
+])
+def test_etag_matches(value, matches):
+    assert etag_matches(value, 7, 3) is matches
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ('"7-3"', (7, 3)),
+    ('W/"7-3"', (7, 3)),
+    ("3", (None, 3)), #? A bare version number has no vault id
+    ('"3"', (None, 3)),
+])
+def test_if_match_version(make_request, value, expected):
+    headers = {"If-Match": value} if value is not None else {}
+    assert if_match_version(make_request(headers)) == expected
+
+
+@pytest.mark.parametrize("value", ['"7-x"', '"x-3"', '"7-3", "7-4"', "*", "", '"-3"'])
+def test_if_match_version_rejects(make_request, value):
+    with pytest.raises(HTTPException) as err:
+        if_match_version(make_request({"If-Match": value}))
+    assert err.value.status_code == 400
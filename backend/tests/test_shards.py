@@ -0,0 +1,46 @@
+import hashlib
+import os
+import re
+import pytest
+from DB.shards import bucket_of, BUCKET_SQL, BUCKETS
+
+USERNAMES = ["a@example.com", "B@Example.com", "user+tag@example.org", "ünïcode@example.com", ""] + [f"user{i}@example.com" for i in range(500)]
+
+
+def bucket_sql_in_python(username: str) -> int:
+    """BUCKET_SQL evaluated step by step: substr(md5(username), 1, n) as hex, cast through bit(width) to int, modulo"""
+
+    m = re.fullmatch(r"\(\('x' \|\| substr\(md5\(username\), 1, (\d+)\)\)::bit\((\d+)\)::int % (\d+)\)", BUCKET_SQL)
+    assert m, f"BUCKET_SQL changed shape, update this test with it: {BUCKET_SQL}"
+    digits, width, modulo = map(int, m.groups())
+
+    assert width == digits * 4 #? Any other width pads or truncates the hex digits
+    assert width < 32 #? ::int of a 32 bit value can go negative, % would then disagree with Python
+    return int(hashlib.md5(username.encode("utf-8")).hexdigest()[:digits], 16) % modulo
+
+
+def test_bucket_sql_uses_the_bucket_count():
+    assert BUCKET_SQL.endswith(f"% {BUCKETS})")
+
+
+@pytest.mark.parametrize("username", USERNAMES)
+def test_bucket_of_matches_bucket_sql(username):
+    assert bucket_of(username) == bucket_sql_in_python(username)
+    assert 0 <= bucket_of(username) < BUCKETS
+
+
+def test_bucket_of_is_stable():
+    #! Pinned values: a changed hash would put existing users in other buckets than the shard map says
+    assert bucket_of("a@example.com") == 883
+    assert bucket_of("user0@example.com") == 226
+    assert bucket_of("ünïcode@example.com") == 143
+
+
+@pytest.mark.skipif(not os.environ.get("TEST_POSTGRES_URL"), reason="TEST_POSTGRES_URL is not set")
+def test_bucket_sql_on_postgres():
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(os.environ["TEST_POSTGRES_URL"])
+    with engine.connect() as conn:
+        for username in USERNAMES:
+            assert conn.execute(text(f"SELECT {BUCKET_SQL} FROM (SELECT :u AS username) AS t"), {"u": username}).scalar_one() == bucket_of(username)
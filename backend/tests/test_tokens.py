@@ -0,0 +1,75 @@
+import pytest
+import fakeredis
+import utils.tokens as tokens
+from utils.tokens import RefreshFamilies
+
+pytestmark = pytest.mark.anyio
+
+GRACE = 10
+
+
+@pytest.fixture(params=["redis", "local"])
+def families(request, monkeypatch):
+    """The same rotation rules through ROTATE_LUA in (fake) redis and through the in-process store used without REDIS_URL"""
+
+    r = fakeredis.aioredis.FakeRedis() if request.param == "redis" else None
+    monkeypatch.setattr(tokens, "get_redis", lambda: r)
+    return RefreshFamilies(ttl=3600, grace=GRACE, capacity=1000)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(tokens.time, "time", lambda: now[0])
+    return now
+
+
+async def test_rotate_ok(families, clock):
+    await families.start_family("fam", "jti-1")
+
+    assert await families.rotate("fam", "jti-1", "jti-2") == "ok"
+    assert await families.rotate("fam", "jti-2", "jti-3") == "ok"
+    assert families.counters["rotations"] == 2
+
+
+async def test_rotate_unknown_family(families, clock):
+    assert await families.rotate("nope", "jti-1", "jti-2") == "unknown"
+
+
+async def test_previous_token_within_grace_is_raced(families, clock):
+    await families.start_family("fam", "jti-1")
+    await families.rotate("fam", "jti-1", "jti-2")
+
+    clock[0] += GRACE
+    assert await families.rotate("fam", "jti-1", "jti-x") == "raced"
+    assert not await families.is_revoked("fam")
+    assert await families.rotate("fam", "jti-2", "jti-3") == "ok" #? The race didn't move the family on
+
+
+async def test_previous_token_after_grace_is_reuse_and_revokes(families, clock):
+    await families.start_family("fam", "jti-1")
+    await families.rotate("fam", "jti-1", "jti-2")
+
+    clock[0] += GRACE + 1
+    assert await families.rotate("fam", "jti-1", "jti-x") == "reused"
+    assert await families.is_revoked("fam")
+    assert await families.rotate("fam", "jti-2", "jti-3") == "unknown" #? Even the newest token of the family is dead
+    assert families.counters["reuse_detected"] == 1
+
+
+async def test_older_token_is_reuse(families, clock):
+    await families.start_family("fam", "jti-1")
+    await families.rotate("fam", "jti-1", "jti-2")
+    await families.rotate("fam", "jti-2", "jti-3")
+
+    assert await families.rotate("fam", "jti-1", "jti-x") == "reused"
+
+
+async def test_revoke(families, clock):
+    await families.start_family("fam", "jti-1")
+    await families.start_family("other", "jti-1")
+    await families.revoke("fam")
+
+    assert await families.is_revoked("fam")
+    assert not await families.is_revoked("other")
+    assert await families.rotate("fam", "jti-1", "jti-2") == "unknown"
@@ -0,0 +1,145 @@
+import json
+from types import SimpleNamespace
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.dialects import postgresql
+import Routes.vaults as vaults
+from schemas.schemas import CurrentUser
+
+pytestmark = pytest.mark.anyio
+
+USER = CurrentUser(id=42, username="a@example.com")
+
+
+class FakeResult:
+
+    def __init__(self, row):
+        self.row = row
+
+    def one_or_none(self):
+        return self.row
+
+
+class FakeSession:
+    """Records the statements, and answers the compare-and-swap with row (None is a version that didn't match)"""
+
+    def __init__(self, row):
+        self.row = row
+        self.statements = []
+        self.committed = False
+        self.rolled_back = False
+
+    async def execute(self, stmt, *args, **kwargs):
+        self.statements.append(stmt)
+        return FakeResult(self.row)
+
+    async def commit(self):
+        self.committed = True
+
+    async def rollback(self):
+        self.rolled_back = True
+
+
+@pytest.fixture(autouse=True)
+def no_shards(monkeypatch):
+    #? commit_user_write checks the shard map, which is not what these tests are about
+    async def commit(db, username):
+        await db.commit()
+    monkeypatch.setattr(vaults, "commit_user_write", commit)
+
+
+def compiled(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.dialect()))
+
+
+def where(stmt) -> str:
+    return str(stmt.whereclause.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+def json_body(version=None, data="YWJj"):
+    body = {"encrypted_data": data, "nonce_b64": "n"}
+    if version is not None:
+        body["version"] = version
+    return json.dumps(body).encode("utf-8")
+
+
+async def write(make_request, db, headers=None, body=None):
+    request = make_request({"content-type": "application/json", **(headers or {})}, body)
+    return await vaults.write_vault(request, db, USER, body)
+
+
+async def test_swap_compares_the_version(make_request):
+    db = FakeSession(SimpleNamespace(id=7, version=4))
+    response = await write(make_request, db, body=json_body(version=3))
+
+    assert compiled(db.statements[0]).startswith("UPDATE vaults")
+    assert where(db.statements[0]) == "vaults.user_id = 42 AND vaults.version = 3"
+    assert db.committed and not db.rolled_back
+    assert response.headers["ETag"] == '"7-4"'
+    assert json.loads(response.body) == {"id": 7, "nonce_b64": "n", "version": 4}
+
+
+async def test_version_mismatch_is_409_and_rolls_back(make_request):
+    db = FakeSession(None)
+    with pytest.raises(HTTPException) as err:
+        await write(make_request, db, body=json_body(version=3))
+
+    assert err.value.status_code == 409
+    assert db.rolled_back and not db.committed
+
+
+async def test_first_write_inserts_version_1(make_request):
+    db = FakeSession(SimpleNamespace(id=7, version=1))
+    await write(make_request, db, body=json_body(version=1))
+
+    sql = compiled(db.statements[0])
+    assert sql.startswith("INSERT INTO vaults")
+    assert "ON CONFLICT (user_id) DO UPDATE" in sql and "WHERE vaults.version = " in sql
+
+
+async def test_if_match_wins_over_the_body_version(make_request):
+    db = FakeSession(SimpleNamespace(id=7, version=6))
+    await write(make_request, db, headers={"If-Match": '"7-5"'}, body=json_body(version=3))
+
+    assert where(db.statements[0]) == "vaults.user_id = 42 AND vaults.version = 5 AND vaults.id = 7"
+
+
+async def test_if_match_vault_id_mismatch_is_409(make_request):
+    #? The row of another vault id doesn't match the swap, as Postgres would answer for "8-5" against vault 7
+    db = FakeSession(None)
+    with pytest.raises(HTTPException) as err:
+        await write(make_request, db, headers={"If-Match": '"8-5"'}, body=json_body())
+
+    assert where(db.statements[0]) == "vaults.user_id = 42 AND vaults.version = 5 AND vaults.id = 8"
+    assert err.value.status_code == 409 and db.rolled_back
+
+
+async def test_if_match_at_version_1_never_inserts(make_request):
+    db = FakeSession(SimpleNamespace(id=7, version=2))
+    await write(make_request, db, headers={"If-Match": '"7-1"'}, body=json_body())
+
+    assert compiled(db.statements[0]).startswith("UPDATE vaults")
+    assert where(db.statements[0]) == "vaults.user_id = 42 AND vaults.version = 1 AND vaults.id = 7"
+
+
+async def test_bare_if_match_version_has_no_id(make_request):
+    db = FakeSession(SimpleNamespace(id=7, version=3))
+    await write(make_request, db, headers={"If-Match": "2"}, body=json_body())
+
+    assert where(db.statements[0]) == "vaults.user_id = 42 AND vaults.version = 2"
+
+
+async def test_missing_version_is_428(make_request):
+    db = FakeSession(None)
+    with pytest.raises(HTTPException) as err:
+        await write(make_request, db, body=json_body())
+    assert err.value.status_code == 428
+    assert not db.statements
+
+
+async def test_whole_blob_write_drops_the_chunks(make_request):
+    db = FakeSession(SimpleNamespace(id=7, version=4))
+    await write(make_request, db, body=json_body(version=3))
+
+    assert compiled(db.statements[1]).startswith("DELETE FROM vault_chunks")
+    assert where(db.statements[1]) == "vault_chunks.user_id = 42"
@@ -0,0 +1,206 @@
+import asyncio
+import time
+import json
+from collections import OrderedDict
+from DB.cache import get_redis
+from config.configs import settings
+from utils.logger import logger
+from utils.metrics import register_gauges
+
+
+class TTLCache:
+    """In-process LRU where every entry also expires after ttl seconds"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SizedTTLCache(TTLCache):
+    """TTLCache that is also bounded by the summed sizeof() of its values, for caching response bodies"""
+
+    def __init__(self, maxsize: int, ttl: float, maxbytes: int, sizeof=len):
+        super().__init__(maxsize, ttl)
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is not None and item[1] < time.monotonic():
+            self.pop(key)
+            return None
+        return super().get(key)
+
+    def set(self, key, value, ttl: float | None = None):
+        size = self.sizeof(value)
+        if size > self.maxbytes:
+            return #? Would evict everything else and still not fit
+
+        self.pop(key)
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.bytes += size
+
+        while len(self._data) > self.maxsize or self.bytes > self.maxbytes:
+            _, (old, _) = self._data.popitem(last=False)
+            self.bytes -= self.sizeof(old)
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.bytes -= self.sizeof(item[0])
+
+
+class SingleFlight:
+    """Concurrent calls for the same key share one running coroutine and its result"""
+
+    def __init__(self):
+        self._calls = {}
+        self.counters = {"calls": 0, "shared": 0}
+
+    async def do(self, key, fn):
+        fut = self._calls.get(key)
+        if fut is None:
+            self.counters["calls"] += 1
+            fut = asyncio.ensure_future(fn())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.counters["shared"] += 1
+
+        #! Shielded, a caller that disconnects must not cancel the call for everybody else waiting on it
+        return await asyncio.shield(fut)
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class UserCache:
+    """Authenticated user lookups by token subject. Local TTL/LRU first, then redis if it is configured"""
+
+    def __init__(self, maxsize: int, ttl: int, prefix: str = "user:"):
+        self.local = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.counters = {"local_hits": 0, "redis_hits": 0, "misses": 0, "redis_errors": 0}
+
+    async def get(self, username: str) -> dict | None:
+        user = self.local.get(username)
+        if user is not None:
+            self.counters["local_hits"] += 1
+            return user
+
+        r = get_redis()
+        if r is not None:
+            try:
+                raw = await r.get(self.prefix + username)
+                if raw is not None:
+                    user = json.loads(raw)
+                    self.local.set(username, user)
+                    self.counters["redis_hits"] += 1
+                    return user
+            except Exception as err:
+                self.counters["redis_errors"] += 1
+                logger.warning("User cache redis read failed, %s", err)
+
+        self.counters["misses"] += 1
+        return None
+
+    async def set(self, username: str, user: dict):
+        self.local.set(username, user)
+
+        r = get_redis()
+        if r is not None:
+            try:
+                await r.set(self.prefix + username, json.dumps(user), ex=self.ttl)
+            except Exception as err:
+                self.counters["redis_errors"] += 1
+                logger.warning("User cache redis write failed, %s", err)
+
+    async def invalidate(self, username: str):
+        #! Other workers keep their local copy until it expires, so the local ttl is the staleness bound
+        self.local.pop(username)
+
+        r = get_redis()
+        if r is not None:
+            try:
+                await r.delete(self.prefix + username)
+            except Exception as err:
+                self.counters["redis_errors"] += 1
+                logger.warning("User cache redis delete failed, %s", err)
+
+    def stats(self) -> dict:
+        lookups = self.counters["local_hits"] + self.counters["redis_hits"] + self.counters["misses"]
+        hits = lookups - self.counters["misses"]
+        return {**self.counters, "size": len(self.local), "hit_ratio": round(hits / lookups, 4) if lookups else 0.0}
+
+
+class VersionFloors:
+    """The last vault version written for each user, shared by every worker through redis. Without REDIS_URL only
+    this worker's own writes are known. When redis can't be read the floor is unknown, and get returns the fallback
+    the caller passes"""
+
+    def __init__(self, maxsize: int, ttl: int, prefix: str = "floor:"):
+        self.local = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.counters = {"redis_reads": 0, "redis_errors": 0}
+
+    async def get(self, user_id: int, unknown: int) -> int:
+        r = get_redis()
+        if r is None:
+            return self.local.get(user_id) or 0
+        try:
+            self.counters["redis_reads"] += 1
+            raw = await r.get(f"{self.prefix}{user_id}")
+        except Exception as err:
+            self.counters["redis_errors"] += 1
+            logger.warning("Version floor redis read failed, %s", err)
+            return unknown
+        return int(raw) if raw is not None else 0
+
+    async def set(self, user_id: int, version: int):
+        #? Not a max: after a delete the floor drops back to the recreated vault's version
+        self.local.set(user_id, version)
+
+        r = get_redis()
+        if r is not None:
+            try:
+                await r.set(f"{self.prefix}{user_id}", version, ex=self.ttl)
+            except Exception as err:
+                self.counters["redis_errors"] += 1
+                logger.warning("Version floor redis write failed, %s", err)
+
+    def stats(self) -> dict:
+        return {**self.counters, "size": len(self.local)}
+
+
+user_cache = UserCache(maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl)
+register_gauges("occultus_user_cache", "Authenticated user cache", user_cache.stats)
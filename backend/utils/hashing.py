@@ -0,0 +1,111 @@
+import asyncio
+import multiprocessing
+import os
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from config.configs import settings
+
+#? key_a arrives already stretched by the client, it is hashed again here so the users table never stores a password equivalent.
+#? argon2 is CPU and memory heavy, so it runs in a process pool and never on the event loop.
+
+HASH_PREFIX = "$argon2"
+
+_hashers = {}
+
+def _hasher(params: tuple) -> PasswordHasher:
+    #? One PasswordHasher per parameter set per worker process
+    if params not in _hashers:
+        time_cost, memory_cost, parallelism = params
+        _hashers[params] = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    return _hashers[params]
+
+def _hash(secret: str, params: tuple) -> str:
+    return _hasher(params).hash(secret)
+
+def _verify(stored: str, secret: str, params: tuple) -> tuple[bool, str | None]:
+    """Runs in the pool. Returns (matched, new hash when the stored one used older parameters)"""
+    ph = _hasher(params)
+    try:
+        ph.verify(stored, secret)
+    except (VerificationError, InvalidHashError):
+        return False, None
+
+    return True, ph.hash(secret) if ph.check_needs_rehash(stored) else None
+
+
+class HashingBusy(Exception):
+    """Too many hashes queued, the caller should answer 503 instead of waiting"""
+
+
+class KeyHasher:
+
+    def __init__(self, workers: int, max_pending: int, params: tuple):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.params = params
+        self.pending = 0
+        self.executor = None
+        self.dummy = None
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            #! spawn, forking a process that already runs an event loop and db connections is not safe
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            raise HashingBusy()
+
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool(), fn, *args)
+        except BrokenProcessPool:
+            self.executor = None #? A worker died (OOM kill), start a fresh pool on the next call
+            raise
+        finally:
+            self.pending -= 1
+
+    async def hash(self, secret: str) -> str:
+        return await self.run(_hash, secret, self.params)
+
+    async def burn(self, secret: str):
+        """A full argon2 verify against a dummy hash, for failed logins that had nothing to verify"""
+
+        if self.dummy is None:
+            self.dummy = await self.hash(secrets.token_urlsafe(16))
+        await self.run(_verify, self.dummy, secret, self.params)
+
+    async def verify(self, stored: str | None, secret: str) -> tuple[bool, str | None]:
+        """(matched, replacement hash or None). stored=None burns the same time so unknown users can't be told apart"""
+
+        if stored is None:
+            await self.burn(secret)
+            return False, None
+
+        if not stored.startswith(HASH_PREFIX):
+            #? Rows from before server side hashing hold the raw key_a, upgrade them on their first good login
+            if not secrets.compare_digest(stored, secret):
+                await self.burn(secret) #! Costs what an argon2 row costs, or the timing tells which rows are unmigrated
+                return False, None
+            return True, await self.hash(secret)
+
+        return await self.run(_verify, stored, secret, self.params)
+
+    async def warm_up(self):
+        await asyncio.gather(*(self.hash("warm-up") for _ in range(self.workers)))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+key_hasher = KeyHasher(
+    workers=settings.hash_workers,
+    max_pending=settings.hash_max_pending,
+    params=(settings.argon2_time_cost, settings.argon2_memory_cost, settings.argon2_parallelism),
+)
@@ -0,0 +1,125 @@
+import base64
+import hashlib
+import json
+from fastapi import HTTPException, Request, Response
+from starlette.status import HTTP_409_CONFLICT
+from DB.cache import get_redis
+from config.configs import settings
+from utils.cache import TTLCache
+from utils.logger import logger
+
+#? Idempotency-Key on non idempotent POSTs. The first request with a key leaves a pending marker, runs, and stores its
+#? response under the key. A retry with the same key gets that response back without running the handler again, so a
+#? client whose connection dropped after the commit doesn't see its own write as a 409.
+#? Records live in redis when REDIS_URL is set (shared by every worker), otherwise in a per-process TTL cache.
+#! A response carrying credentials is never stored: its route passes on_replay, the record only says the request
+#! succeeded and a retry gets a freshly built response.
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAY_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(*parts) -> str:
+    """Hash of what makes two requests the same one, a key reused for a different request is rejected"""
+    return hashlib.sha256(json.dumps(parts, default=str).encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+
+    def __init__(self, maxsize: int, ttl: int, pending_ttl: int, prefix: str = "idem:"):
+        self.local = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.prefix = prefix
+
+    async def reserve(self, key: str, fp: str) -> dict | None:
+        """Claims the key. Returns None when this request should run, otherwise the record somebody else left"""
+
+        marker = {"state": "pending", "fp": fp}
+        r = get_redis()
+        if r is not None:
+            try:
+                if await r.set(self.prefix + key, json.dumps(marker), ex=self.pending_ttl, nx=True):
+                    return None
+                raw = await r.get(self.prefix + key)
+                return json.loads(raw) if raw is not None else None #? Expired in between, run it
+            except Exception as err:
+                logger.warning("Idempotency redis reserve failed, %s", err)
+
+        #? No await between the check and the set, so this is atomic within the process
+        existing = self.local.get(key)
+        if existing is not None:
+            return existing
+        self.local.set(key, marker, ttl=self.pending_ttl)
+        return None
+
+    async def save(self, key: str, fp: str, response: Response, keep_body: bool = True):
+        record = {"state": "done", "fp": fp, "status": response.status_code}
+        if keep_body:
+            record["headers"] = {k: v for k, v in response.headers.items() if k.lower() != "content-length"}
+            record["body"] = base64.b64encode(response.body).decode("utf-8")
+        self.local.set(key, record)
+
+        r = get_redis()
+        if r is not None:
+            try:
+                await r.set(self.prefix + key, json.dumps(record), ex=self.ttl)
+            except Exception as err:
+                logger.warning("Idempotency redis save failed, %s", err)
+
+    async def release(self, key: str):
+        """Drops the pending marker of a request that failed, a retry runs it again"""
+
+        self.local.pop(key)
+        r = get_redis()
+        if r is not None:
+            try:
+                await r.delete(self.prefix + key)
+            except Exception as err:
+                logger.warning("Idempotency redis release failed, %s", err)
+
+
+idempotency_store = IdempotencyStore(settings.idempotency_cache_size, settings.idempotency_ttl, settings.idempotency_pending_ttl)
+
+
+def replay(record: dict) -> Response:
+    headers = {**record["headers"], REPLAY_HEADER: "true"}
+    return Response(content=base64.b64decode(record["body"]), status_code=record["status"], headers=headers)
+
+
+async def run_idempotent(request: Request, scope: str, fp: str, handler, on_replay=None) -> Response:
+    """Runs handler() once per Idempotency-Key within scope. Only 2xx responses are kept, errors leave the key free to retry.
+    With on_replay the response body isn't kept, a retry after success answers with await on_replay() instead"""
+
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return await handler()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=422, detail=f"{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+
+    key = f"{scope}:{key}"
+    record = await idempotency_store.reserve(key, fp)
+    if record is not None:
+        if record["fp"] != fp:
+            raise HTTPException(status_code=422, detail=f"{IDEMPOTENCY_HEADER} was already used for a different request")
+        if record["state"] == "pending":
+            raise HTTPException(status_code=HTTP_409_CONFLICT, detail="A request with this Idempotency-Key is still in progress", headers={"Retry-After": "1"})
+        if "body" in record:
+            return replay(record)
+
+        response = await on_replay()
+        response.headers[REPLAY_HEADER] = "true"
+        return response
+
+    try:
+        response = await handler()
+    except BaseException:
+        await idempotency_store.release(key)
+        raise
+
+    if 200 <= response.status_code < 300:
+        await idempotency_store.save(key, fp, response, keep_body=on_replay is None)
+    else:
+        await idempotency_store.release(key)
+    return response
@@ -1,4 +1,182 @@
+import atexit
+import json
 import logging
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from config.configs import settings
+from utils.metrics import register_gauges
 
-logging.basicConfig(level=logging.INFO)
+#? Logging never blocks a request. Records go onto a bounded queue and one background thread formats and writes them,
+#? so a slow stdout (a pipe, a container log driver under pressure) costs the event loop nothing. When the queue is full
+#? the record is dropped and counted instead of waiting. Records are JSON lines carrying the request id and route of the
+#? request that logged them. LOG_FORMAT=text gives plain lines for local development.
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+#? The ASGI scope of the request being served. The router adds the matched route to that same dict, so records logged
+#? inside an endpoint can name the route template
+request_scope: ContextVar[dict | None] = ContextVar("request_scope", default=None)
+
+
+def parse_sample_rates(value: str) -> dict[str, float]:
+    """"DEBUG=0.01,sqlalchemy.engine=0.1" keeps 1% of debug records and 10% of the SQL echo, everything else is kept"""
+    rates = {}
+    for part in value.split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Runs in the thread that logs: samples, and copies the request context onto the record before it is queued"""
+
+    def __init__(self, sample_rates: dict[str, float]):
+        super().__init__()
+        self.logger_rates = sorted(((name, rate) for name, rate in sample_rates.items() if name not in logging.getLevelNamesMapping()), key=lambda item: -len(item[0]))
+        self.level_rates = {logging.getLevelNamesMapping()[name]: rate for name, rate in sample_rates.items() if name in logging.getLevelNamesMapping()}
+        self.sampled_out = 0
+
+    def sample_rate(self, record: logging.LogRecord) -> float:
+        if hasattr(record, "sample_rate"):
+            return record.sample_rate #? Per call, logger.info(..., extra={"sample_rate": 0.01})
+        for name, rate in self.logger_rates:
+            if record.name == name or record.name.startswith(name + "."):
+                return rate
+        return self.level_rates.get(record.levelno, 1.0)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.sample_rate(record)
+        if rate < 1.0 and random.random() >= rate:
+            self.sampled_out += 1
+            return False
+
+        scope = request_scope.get()
+        if scope is not None:
+            record.request_id = scope.get("request_id")
+            record.route = getattr(scope.get("route"), "path", None)
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler on a bounded queue that drops instead of blocking when the writer falls behind"""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        #? Only what can't wait is done here: the message is resolved (its args may change later) and so is a traceback.
+        #? Everything else, the JSON and the write, happens on the listener thread
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+
+    FIELDS = ("request_id", "route", "method", "status", "latency_ms")
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        request_id = getattr(record, "request_id", None)
+        return f"{line} [{request_id}]" if request_id else line
+
+
+def setup_logging():
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JSONFormatter() if settings.log_format == "json" else TextFormatter())
+
+    handler = DroppingQueueHandler(queue.Queue(maxsize=settings.log_queue_size))
+    context = ContextFilter(parse_sample_rates(settings.log_sample_rates))
+    handler.addFilter(context)
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(settings.log_level.upper())
+
+    listener = QueueListener(handler.queue, stream, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop) #? Writes out whatever is still queued when the process exits
+    return handler, context, listener
+
+
+log_handler, log_context, log_listener = setup_logging()
 logger = logging.getLogger("OccultusBackend")
+access_logger = logging.getLogger("OccultusBackend.access")
+
+
+def logging_stats() -> dict:
+    return {"queued": log_handler.queue.qsize(), "dropped": log_handler.dropped, "sampled_out": log_context.sampled_out}
+
+register_gauges("occultus_logging", "Log pipeline", logging_stats)
+
+
+class AccessLogMiddleware:
+    """Plain ASGI middleware: gives every request an id (the caller's X-Request-ID or a new one), returns it in the
+    response headers, and writes one access record per request with route, status and latency"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = next((value.decode("latin-1") for name, value in scope["headers"] if name == REQUEST_ID_HEADER.lower().encode()), None)
+        scope["request_id"] = request_id[:64] if request_id else uuid.uuid4().hex
+        token = request_scope.set(scope)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", scope["request_id"].encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            latency_ms = round((time.perf_counter() - start) * 1000, 2)
+            #? Errors and slow requests are always kept, the rest at LOG_ACCESS_SAMPLE
+            sample_rate = 1.0 if status >= 500 or latency_ms >= settings.log_slow_ms else settings.log_access_sample
+            access_logger.info("%s %s %s", scope["method"], scope["path"], status, extra={"method": scope["method"], "status": status, "latency_ms": latency_ms, "sample_rate": sample_rate})
+            request_scope.reset(token)
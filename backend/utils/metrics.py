@@ -0,0 +1,147 @@
+import os
+import time
+from contextvars import ContextVar
+from prometheus_client import Histogram, Counter, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+
+#? Per request counters live in a contextvar. SQLAlchemy runs its sync code in a greenlet that shares the request's
+#? context, so the cursor hooks below can add to the same object the middleware created.
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "pool_wait", "vault_bytes")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.pool_wait = 0.0
+        self.vault_bytes = 0
+
+request_stats: ContextVar[RequestStats | None] = ContextVar("request_stats", default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUEST_LATENCY = Histogram("occultus_request_duration_seconds", "Request latency", ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+REQUEST_QUERIES = Histogram("occultus_request_db_queries", "SQL statements per request", ["route"], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34))
+REQUEST_DB_TIME = Histogram("occultus_request_db_seconds", "Time spent in SQL per request", ["route"], buckets=LATENCY_BUCKETS)
+REQUEST_POOL_WAIT = Histogram("occultus_request_pool_wait_seconds", "Time waiting for a pooled connection per request", ["route"], buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+REPLICA_FALLBACKS = Counter("occultus_replica_fallbacks_total", "Reads sent again to the primary because the replica was missing the row or behind", ["reason"])
+VAULT_PAYLOAD = Histogram("occultus_vault_payload_bytes", "Vault ciphertext bytes moved per request", ["route"], buckets=tuple(2 ** x for x in range(10, 27, 2)))
+WORKER_STARTUP = Histogram("occultus_worker_startup_seconds", "Seconds from process start until the worker is importing (import) or serving (ready)", ["phase"], buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60))
+
+
+def install_sql_hooks(sync_engine):
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _end(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+def observe_pool_wait(seconds: float):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.pool_wait += seconds
+
+def observe_replica_fallback(reason: str):
+    REPLICA_FALLBACKS.labels(reason=reason).inc()
+
+def process_age() -> float | None:
+    """Seconds since this process was started by the OS, None off Linux"""
+    try:
+        with open("/proc/self/stat") as f:
+            #? Field 22 is the start time in clock ticks after boot, the name in field 2 may contain spaces
+            started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0]) - started
+    except (OSError, ValueError, IndexError):
+        return None
+
+def observe_startup(phase: str, seconds: float):
+    WORKER_STARTUP.labels(phase=phase).observe(seconds)
+
+def observe_vault_bytes(n: int):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.vault_bytes += n
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware, times every http request and files its SQL counters under the matched route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched") #! Template, not the raw path, keeps label cardinality fixed
+
+            REQUEST_LATENCY.labels(scope["method"], path, str(status)).observe(elapsed)
+            REQUEST_QUERIES.labels(path).observe(stats.queries)
+            if stats.queries:
+                REQUEST_DB_TIME.labels(path).observe(stats.db_seconds)
+                REQUEST_POOL_WAIT.labels(path).observe(stats.pool_wait)
+            if stats.vault_bytes:
+                VAULT_PAYLOAD.labels(path).observe(stats.vault_bytes)
+
+            request_stats.reset(token)
+
+
+class GaugeCollector:
+    """Turns a dict returning function into gauges at scrape time, used for the pool and cache counters"""
+
+    def __init__(self, prefix: str, doc: str, fn):
+        self.prefix = prefix
+        self.doc = doc
+        self.fn = fn
+
+    def collect(self):
+        #? With several workers each one only knows its own pools and caches, the pid label tells the series apart
+        labels = {"pid": str(os.getpid())} if "PROMETHEUS_MULTIPROC_DIR" in os.environ else {}
+        for key, value in self.fn().items():
+            if isinstance(value, (int, float)):
+                gauge = GaugeMetricFamily(f"{self.prefix}_{key}", f"{self.doc} {key}", labels=list(labels))
+                gauge.add_metric(list(labels.values()), value)
+                yield gauge
+
+GAUGES: list[GaugeCollector] = []
+
+def register_gauges(prefix: str, doc: str, fn):
+    collector = GaugeCollector(prefix, doc, fn)
+    GAUGES.append(collector)
+    REGISTRY.register(collector)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        #? Several workers: histograms and counters merged over all of them from the files they write, plus the scrape
+        #? time gauges of the worker answering
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in GAUGES:
+            registry.register(collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
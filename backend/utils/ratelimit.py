@@ -0,0 +1,81 @@
+import time
+from math import ceil
+from fastapi import HTTPException, Request, Response
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS
+from fastapi_limiter import FastAPILimiter, default_identifier
+from fastapi_limiter.depends import RateLimiter
+from utils.cache import TTLCache
+from utils.logger import logger
+from utils.metrics import register_gauges
+
+#? Per route request limits. Redis (fastapi-limiter) holds the counters when it was initialised in the lifespan, so every
+#? worker shares one budget. Without redis, or while it is failing, each worker falls back to its own token buckets.
+
+REDIS_RETRY_AFTER = 5 #? Seconds to stay on the local buckets after a redis error, so a dead redis costs one timeout
+
+def parse_rate(rate: str) -> tuple[int, int]:
+    """"10/60" is 10 requests per 60 seconds"""
+    times, _, seconds = rate.partition("/")
+    return int(times), int(seconds or 1)
+
+
+class TokenBuckets:
+    """In-process token bucket per key, refilled continuously at capacity/period"""
+
+    def __init__(self, maxsize: int = 100000):
+        self.buckets = TTLCache(maxsize, ttl=60)
+
+    def take(self, key: str, capacity: int, period: int) -> float:
+        """0 when a token was taken, otherwise the seconds until the next one"""
+
+        now = time.monotonic()
+        rate = capacity / period
+        tokens, last = self.buckets.get(key) or (capacity, now)
+        tokens = min(capacity, tokens + (now - last) * rate)
+
+        #? A bucket untouched for a whole period is full again, so dropping it then loses nothing
+        if tokens >= 1:
+            self.buckets.set(key, (tokens - 1, now), ttl=period)
+            return 0
+        self.buckets.set(key, (tokens, now), ttl=period)
+        return (1 - tokens) / rate
+
+
+local_buckets = TokenBuckets()
+limiter_counters = {"redis_checks": 0, "local_checks": 0, "redis_errors": 0, "limited": 0}
+redis_down_until = 0.0
+
+
+class RouteLimit:
+    """Dependency for a route: RouteLimit("10/60")"""
+
+    def __init__(self, rate: str):
+        self.times, self.seconds = parse_rate(rate)
+        self.redis_limiter = RateLimiter(times=self.times, seconds=self.seconds, callback=self.too_many)
+
+    async def too_many(self, request: Request, response: Response, pexpire: int):
+        limiter_counters["limited"] += 1
+        raise HTTPException(status_code=HTTP_429_TOO_MANY_REQUESTS, detail="Too Many Requests", headers={"Retry-After": str(max(1, ceil(pexpire / 1000)))})
+
+    async def __call__(self, request: Request, response: Response):
+        global redis_down_until
+
+        if FastAPILimiter.redis is not None and time.monotonic() >= redis_down_until:
+            try:
+                limiter_counters["redis_checks"] += 1
+                return await self.redis_limiter(request, response)
+            except HTTPException:
+                raise
+            except Exception as err:
+                limiter_counters["redis_errors"] += 1
+                redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+                logger.warning("Rate limiter redis failed, using in-process buckets for %ss, %s", REDIS_RETRY_AFTER, err)
+
+        limiter_counters["local_checks"] += 1
+        key = f"{await default_identifier(request)}:{request.method}"
+        wait = local_buckets.take(key, self.times, self.seconds)
+        if wait:
+            await self.too_many(request, response, int(wait * 1000))
+
+
+register_gauges("occultus_rate_limit", "Route rate limiter", lambda: {**limiter_counters, "local_buckets": len(local_buckets.buckets)})
@@ -0,0 +1,25 @@
+from fastapi.responses import JSONResponse
+from config.configs import settings
+
+#? FAST_JSON=true renders every JSON response with orjson, and the hot routes hand it plain dicts built from row tuples
+#? so response_model validation is skipped for them. Off by default: the stock path checks each response against its
+#? schema, which is worth having while the schemas still change.
+
+try:
+    import orjson #? Optional dependency, only needed with FAST_JSON=true
+except ImportError:
+    orjson = None
+
+
+class FastJSONResponse(JSONResponse):
+    """orjson renders str, int, list, dict and datetime natively, several times faster than json.dumps on big strings"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_UTC_Z)
+
+
+if settings.fast_json and orjson is None:
+    raise RuntimeError("FAST_JSON needs orjson, pip install orjson")
+
+FAST_JSON = settings.fast_json
+JSONResponseClass = FastJSONResponse if FAST_JSON else JSONResponse
@@ -0,0 +1,118 @@
+import json
+import time
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
+from utils.logger import logger
+from utils.metrics import register_gauges
+from config.configs import settings
+
+#? Adaptive concurrency limit. Every interval the p99 of time to first byte is compared to the target: over it, the
+#? limit drops to 90% of the concurrency that produced it, under it the limit grows back by a tenth. Low priority
+#? requests are turned away with 503 above the adaptive limit, authenticated vault sync only at the hard maximum.
+
+EXEMPT_PATHS = {"/", "/ready", "/metrics", "/vaults/events", "/admin/export", "/admin/import"} #? Probes, scrapes, the long lived SSE stream and bulk jobs
+MIN_SAMPLES = 10
+
+def is_priority(scope) -> bool:
+    if not scope["path"].startswith("/vaults"):
+        return False
+    return any(name == b"authorization" for name, _ in scope["headers"])
+
+
+class AdaptiveLimit:
+    """The limit itself, shared by the middleware and the gauges"""
+
+    def __init__(self, target_p99: float, min_limit: int, max_limit: int, interval: float = 1.0, window: int = 2000):
+        self.target_p99 = target_p99
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.interval = interval
+        self.window = window
+
+        self.limit = max_limit
+        self.in_flight = 0
+        self.peak = 0
+        self.samples = []
+        self.p99 = 0.0
+        self.next_adjust = time.monotonic() + interval
+        self.counters = {"shed_low": 0, "shed_high": 0}
+
+    def admit(self, priority: bool) -> bool:
+        if self.in_flight >= (self.max_limit if priority else self.limit):
+            self.counters["shed_high" if priority else "shed_low"] += 1
+            return False
+
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        return True
+
+    def release(self, seconds: float):
+        self.in_flight -= 1
+        if len(self.samples) < self.window:
+            self.samples.append(seconds)
+
+        now = time.monotonic()
+        if now < self.next_adjust or len(self.samples) < MIN_SAMPLES:
+            return
+        self.next_adjust = now + self.interval
+
+        ordered = sorted(self.samples)
+        self.p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+        if self.p99 > self.target_p99:
+            limit = max(self.min_limit, int(min(self.limit, self.peak) * 0.9))
+            if limit < self.limit:
+                logger.warning("p99 %.0fms over target, concurrency limit %s -> %s", self.p99 * 1000, self.limit, limit)
+            self.limit = limit
+        else:
+            self.limit = min(self.max_limit, self.limit + max(1, self.limit // 10))
+
+        #? Fresh window every interval, samples from before a change must not trigger another one
+        self.samples = []
+        self.peak = self.in_flight
+
+    def stats(self) -> dict:
+        return {**self.counters, "limit": self.limit, "in_flight": self.in_flight, "p99_seconds": self.p99}
+
+
+adaptive_limit = AdaptiveLimit(settings.shed_target_p99, settings.shed_min_concurrency, settings.shed_max_concurrency)
+register_gauges("occultus_load_shedding", "Adaptive concurrency limit", adaptive_limit.stats)
+
+
+class LoadShedder:
+    """Plain ASGI middleware, sits inside CORS so a 503 still carries the CORS headers"""
+
+    def __init__(self, app, limit: AdaptiveLimit = adaptive_limit):
+        self.app = app
+        self.limit = limit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        if not self.limit.admit(is_priority(scope)):
+            await self.reject(send)
+            return
+
+        start = time.perf_counter()
+        first_byte = None
+
+        async def send_wrapper(message):
+            nonlocal first_byte
+            if message["type"] == "http.response.start":
+                first_byte = time.perf_counter() #? Slow clients reading a big body don't count as server latency
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.limit.release((first_byte or time.perf_counter()) - start)
+
+    async def reject(self, send):
+        body = json.dumps({"detail": "Server is busy, try again shortly"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": HTTP_503_SERVICE_UNAVAILABLE,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"retry-after", str(max(1, round(self.limit.interval))).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import math
+import time
+from DB.cache import get_redis
+from config.configs import settings
+from utils.cache import TTLCache
+from utils.logger import logger
+from utils.metrics import register_gauges
+
+
+class VerifiedTokens:
+    """Payloads of JWTs whose signature already checked out, keyed by the token's sha256. An entry lives until the token's exp"""
+
+    def __init__(self, maxsize: int):
+        self.local = TTLCache(maxsize, ttl=0)
+        self.counters = {"hits": 0, "misses": 0}
+
+    def get(self, token: str) -> dict | None:
+        payload = self.local.get(hashlib.sha256(token.encode("utf-8")).digest())
+        self.counters["hits" if payload is not None else "misses"] += 1
+        return payload
+
+    def set(self, token: str, payload: dict):
+        ttl = payload.get("exp", 0) - time.time()
+        if ttl > 0:
+            self.local.set(hashlib.sha256(token.encode("utf-8")).digest(), payload, ttl=ttl)
+
+    def pop(self, token: str):
+        self.local.pop(hashlib.sha256(token.encode("utf-8")).digest())
+
+    def stats(self) -> dict:
+        return {**self.counters, "size": len(self.local)}
+
+
+class BloomFilter:
+    """Set membership in a fixed bit array: "no" is certain, "maybe" has error_rate false positives at capacity"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.m = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.k = max(1, round(self.m / capacity * math.log(2)))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+
+    def positions(self, item: str):
+        #? Double hashing, k positions out of one 128 bit digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def add(self, item: str):
+        for p in self.positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(item))
+
+
+SYNC_OVERLAP = 5
+LOCAL_FAMILIES = 1_000_000 #? Only used without redis, that is a single worker (server.py)
+
+
+class TokenStoreUnavailable(Exception):
+    pass
+
+
+#? KEYS[1] family hash, ARGV: presented jti, new jti, now, ttl, grace
+ROTATE_LUA = """
+local current = redis.call('HGET', KEYS[1], 'jti')
+if not current then return 'unknown' end
+if current == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'jti', ARGV[2], 'prev', ARGV[1], 'at', ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return 'ok'
+end
+if redis.call('HGET', KEYS[1], 'prev') == ARGV[1] and tonumber(ARGV[3]) - tonumber(redis.call('HGET', KEYS[1], 'at')) <= tonumber(ARGV[5]) then
+    return 'raced'
+end
+return 'reused'
+"""
+
+
+class RefreshFamilies:
+    """Refresh token rotation. Every login starts a family, and only the family's newest refresh token (its jti) is
+    accepted. Using it hands out the next one. A retired token coming back means it was copied, so the whole family
+    is revoked, which also locks out the access tokens carrying the family id.
+
+    Redis is the source of truth for families and revocations when REDIS_URL is set, an in-process store otherwise,
+    which is enough because server.py runs a single worker without it. With redis configured but unreachable the
+    calls fail closed with TokenStoreUnavailable. Requests check revocation against a local Bloom filter, only a
+    "maybe" goes to redis. Other workers' revocations reach the filter through sync(), so they apply everywhere
+    within revocation_sync_seconds."""
+
+    def __init__(self, ttl: int, grace: int, capacity: int, prefix: str = "rt:"):
+        self.ttl = ttl
+        self.grace = grace
+        self.capacity = capacity
+        self.prefix = prefix
+        self.bloom = BloomFilter(capacity)
+        self.families = TTLCache(LOCAL_FAMILIES, ttl)
+        self.revoked = TTLCache(LOCAL_FAMILIES, ttl)
+        self.last_sync = 0.0
+        self.task = None
+        self.counters = {"rotations": 0, "reuse_detected": 0, "revocations": 0, "bloom_maybe": 0, "redis_errors": 0}
+
+    def family_key(self, family: str) -> str:
+        return f"{self.prefix}fam:{family}"
+
+    @property
+    def revoked_key(self) -> str:
+        return f"{self.prefix}revoked"
+
+    async def check(self):
+        """Raises TokenStoreUnavailable when redis is configured but doesn't answer, before anything is written that needs a session"""
+
+        r = get_redis()
+        if r is None:
+            return
+        try:
+            await r.ping()
+        except Exception as err:
+            self.counters["redis_errors"] += 1
+            raise TokenStoreUnavailable() from err
+
+    async def start_family(self, family: str, jti: str):
+        r = get_redis()
+        if r is None:
+            self.families.set(family, {"jti": jti, "prev": None, "at": 0.0})
+            return
+        try:
+            await r.hset(self.family_key(family), mapping={"jti": jti, "at": time.time()})
+            await r.expire(self.family_key(family), self.ttl)
+        except Exception as err:
+            self.counters["redis_errors"] += 1
+            raise TokenStoreUnavailable() from err
+
+    async def rotate(self, family: str, jti: str, new_jti: str) -> str:
+        """ok, raced (the previous token again within the grace period, two tabs refreshing at once), reused or unknown"""
+
+        now = time.time()
+        r = get_redis()
+        if r is None:
+            result = self.rotate_local(family, jti, new_jti, now)
+        else:
+            try:
+                result = await r.eval(ROTATE_LUA, 1, self.family_key(family), jti, new_jti, now, self.ttl, self.grace)
+                result = result.decode("utf-8") if isinstance(result, bytes) else result
+            except Exception as err:
+                self.counters["redis_errors"] += 1
+                raise TokenStoreUnavailable() from err
+
+        if result == "ok":
+            self.counters["rotations"] += 1
+        elif result == "reused":
+            self.counters["reuse_detected"] += 1
+            logger.warning("Refresh token reuse in family %s, revoking it", family[:8])
+            await self.revoke(family)
+        return result
+
+    def rotate_local(self, family: str, jti: str, new_jti: str, now: float) -> str:
+        """ROTATE_LUA on the in-process store"""
+
+        state = self.families.get(family)
+        if state is None:
+            return "unknown"
+        if state["jti"] == jti:
+            self.families.set(family, {"jti": new_jti, "prev": jti, "at": now})
+            return "ok"
+        if state["prev"] == jti and now - state["at"] <= self.grace:
+            return "raced"
+        return "reused"
+
+    async def revoke(self, family: str):
+        r = get_redis()
+        if r is None:
+            self.revoked.set(family, True)
+            self.families.pop(family)
+        else:
+            try:
+                await r.zadd(self.revoked_key, {family: time.time()})
+                await r.delete(self.family_key(family))
+            except Exception as err:
+                self.counters["redis_errors"] += 1
+                raise TokenStoreUnavailable() from err
+
+        self.bloom.add(family)
+        self.counters["revocations"] += 1
+
+    async def is_revoked(self, family: str) -> bool:
+        if family not in self.bloom:
+            return False #? Certain, and the common case: no IO at all
+
+        self.counters["bloom_maybe"] += 1
+        r = get_redis()
+        if r is None:
+            return self.revoked.get(family) is not None
+        try:
+            return await r.zscore(self.revoked_key, family) is not None
+        except Exception as err:
+            self.counters["redis_errors"] += 1
+            logger.warning("Revocation check failed, rejecting the token, %s", err)
+            return True #! Fails closed, it only happens for the few tokens the filter already flagged
+
+    async def sync(self):
+        """Adds revocations made since the last sync (by any worker) to the filter and drops the expired ones"""
+
+        r = get_redis()
+        if r is None:
+            return
+
+        now = time.time()
+        if self.bloom.count > self.capacity:
+            self.bloom = BloomFilter(self.capacity) #? Over capacity the false positives climb, rebuild from the live set
+            self.last_sync = 0.0
+
+        await r.zremrangebyscore(self.revoked_key, "-inf", now - self.ttl)
+        #? Scores are the revoking worker's clock, the overlap covers some skew between hosts
+        entries = await r.zrangebyscore(self.revoked_key, self.last_sync - SYNC_OVERLAP, "+inf", withscores=True)
+        for family, revoked_at in entries:
+            family = family.decode("utf-8") if isinstance(family, bytes) else family
+            if family not in self.bloom:
+                self.bloom.add(family)
+            self.last_sync = max(self.last_sync, revoked_at)
+
+    async def run(self, interval: float):
+        while True:
+            try:
+                await self.sync()
+            except Exception as err:
+                self.counters["redis_errors"] += 1
+                logger.warning("Revocation sync failed, %s", err)
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float):
+        if self.task is None and get_redis() is not None:
+            self.task = asyncio.create_task(self.run(interval))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> dict:
+        return {**self.counters, "bloom_entries": self.bloom.count}
+
+
+verified_tokens = VerifiedTokens(settings.token_cache_size)
+refresh_families = RefreshFamilies(settings.refresh_token_minutes * 60, settings.refresh_reuse_grace, settings.revocation_bloom_capacity)
+
+register_gauges("occultus_token_cache", "Verified token cache", verified_tokens.stats)
+register_gauges("occultus_refresh_tokens", "Refresh token families", refresh_families.stats)
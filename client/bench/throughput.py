@@ -0,0 +1,156 @@
+"""Throughput of the Python client.
+
+Offline it measures the local costs: the argon2 key derivation done once per
+client, and vault encryption and decryption in MB/s for growing entry counts.
+With --base-url it also runs against a server, as one bench user:
+
+    fetch        GET /vaults downloading the whole ciphertext every time
+    revalidate   GET /vaults answered 304 from the local cache
+    unpooled     the same download on a new connection per request
+    edits        --edits single entry writes, one POST each
+    batched      the same --edits entries in one VaultEdit, one POST
+
+    cd client && python bench/throughput.py
+    cd client && python bench/throughput.py --base-url http://localhost:8000 --entries 500 --duration 10
+
+--out writes the results as JSON.
+"""
+import argparse
+import json
+import secrets
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from occultus_client.client import OccultusClient
+from occultus_client.crypto import derive_keys, new_salt, encrypt_vault, decrypt_vault
+
+
+def make_entries(count: int) -> list:
+    return [{"website": f"site-{i}.example.com", "username": f"user{i}@example.com", "password": secrets.token_urlsafe(18)} for i in range(count)]
+
+
+def timed(fn, duration: float) -> dict:
+    """Calls fn until duration is over, latencies in ms"""
+    samples = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "count": len(samples),
+        "per_sec": round(len(samples) / sum(samples), 1),
+        "p50_ms": round(statistics.median(samples) * 1000, 2),
+        "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 2),
+    }
+
+
+def offline(sizes: list[int], duration: float) -> dict:
+    start = time.perf_counter()
+    keys = derive_keys("bench password", new_salt())
+    result = {"derive_keys_ms": round((time.perf_counter() - start) * 1000, 1), "crypto": {}}
+
+    for size in sizes:
+        entries = make_entries(size)
+        ciphertext, nonce_b64 = encrypt_vault(entries, keys.key_b)
+        mb = len(ciphertext) / 1e6
+        encrypt = timed(lambda: encrypt_vault(entries, keys.key_b), duration)
+        decrypt = timed(lambda: decrypt_vault(ciphertext, nonce_b64, keys.key_b), duration)
+        result["crypto"][size] = {
+            "bytes": len(ciphertext),
+            "encrypt_mb_s": round(encrypt["per_sec"] * mb, 1),
+            "decrypt_mb_s": round(decrypt["per_sec"] * mb, 1),
+            "encrypt_p50_ms": encrypt["p50_ms"],
+            "decrypt_p50_ms": decrypt["p50_ms"],
+        }
+    return result
+
+
+def online(base_url: str, entries: int, edits: int, duration: float) -> dict:
+    username = f"bench-{secrets.token_hex(6)}@example.com"
+    cache_dir = tempfile.mkdtemp(prefix="occultus-bench-")
+    result = {}
+
+    with OccultusClient(base_url, username, "bench password", cache_dir=cache_dir) as client:
+        client.register()
+        with client.edit() as vault:
+            vault.update(lambda current: make_entries(entries))
+        result["vault_bytes"] = len(client.vault.ciphertext)
+
+        def cold():
+            client.remember(None) #? Forget the cached copy, the server has to send the body
+            client.fetch()
+
+        result["fetch"] = timed(cold, duration)
+        client.fetch()
+        result["revalidate"] = timed(client.fetch, duration)
+
+        pooled = client.http
+        client.http = httpx.Client(base_url=client.base_url, limits=httpx.Limits(max_keepalive_connections=0))
+        try:
+            result["unpooled"] = timed(cold, duration)
+        finally:
+            client.http.close()
+            client.http = pooled
+
+        start = time.perf_counter()
+        for i in range(edits):
+            client.edit().upsert(f"single-{i}.example.com", "bench", secrets.token_urlsafe(18)).commit()
+        result["edits"] = {"count": edits, "seconds": round(time.perf_counter() - start, 3)}
+
+        start = time.perf_counter()
+        with client.edit() as vault:
+            for i in range(edits):
+                vault.upsert(f"batched-{i}.example.com", "bench", secrets.token_urlsafe(18))
+        result["batched"] = {"count": edits, "seconds": round(time.perf_counter() - start, 3)}
+
+        result["counters"] = client.counters
+    return result
+
+
+def print_report(result: dict):
+    print(f"derive_keys {result['derive_keys_ms']} ms")
+    print(f"\n{'entries':>8} {'bytes':>10} {'enc MB/s':>9} {'dec MB/s':>9} {'enc p50':>8} {'dec p50':>8}")
+    for size, row in result["crypto"].items():
+        print(f"{size:>8} {row['bytes']:>10} {row['encrypt_mb_s']:>9} {row['decrypt_mb_s']:>9} {row['encrypt_p50_ms']:>8} {row['decrypt_p50_ms']:>8}")
+
+    server = result.get("server")
+    if server:
+        print(f"\nvault {server['vault_bytes']} bytes")
+        print(f"{'':<12} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        for label in ("fetch", "revalidate", "unpooled"):
+            row = server[label]
+            print(f"{label:<12} {row['per_sec']:>8} {row['p50_ms']:>8} {row['p99_ms']:>8}")
+        for label in ("edits", "batched"):
+            row = server[label]
+            print(f"{label:<12} {row['count']} entries in {row['seconds']} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="Entry counts for the offline crypto runs")
+    parser.add_argument("--base-url", help="Server to run the online benchmarks against")
+    parser.add_argument("--entries", type=int, default=200, help="Entries in the bench user's vault")
+    parser.add_argument("--edits", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=3.0, help="Seconds per measurement")
+    parser.add_argument("--out", help="JSON file for the results")
+    args = parser.parse_args()
+
+    result = offline([int(s) for s in args.sizes.split(",")], args.duration)
+    if args.base_url:
+        result["server"] = online(args.base_url, args.entries, args.edits, args.duration)
+
+    print_report(result)
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import NamedTuple
+
+#? The cache holds exactly what the server holds: ciphertext, nonce, vault id and version. Nothing is decrypted on
+#? disk, a stolen cache is as useless as a stolen database row. The version is the key, a cached copy is only used
+#? after the server confirmed with a 304 that it is still current (or when the caller allows offline reads).
+
+
+class CachedVault(NamedTuple):
+    id: int
+    version: int
+    nonce_b64: str
+    ciphertext: bytes
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.id}-{self.version}"'
+
+
+class VaultCache:
+    """One file per (server, user) under root, written atomically and readable only by the owner"""
+
+    def __init__(self, root: str | os.PathLike):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True, mode=0o700)
+
+    def path(self, base_url: str, username: str) -> Path:
+        key = hashlib.sha256(f"{base_url.rstrip('/')}\n{username}".encode("utf-8")).hexdigest()
+        return self.root / f"{key}.vault"
+
+    def load(self, base_url: str, username: str) -> CachedVault | None:
+        try:
+            data = self.path(base_url, username).read_bytes()
+        except FileNotFoundError:
+            return None
+
+        #? First line is the JSON header, the rest is the ciphertext as is
+        header, _, ciphertext = data.partition(b"\n")
+        try:
+            meta = json.loads(header)
+        except ValueError:
+            return None
+        if len(ciphertext) != meta.get("size"):
+            return None #! Torn or foreign file, treat as a miss
+        return CachedVault(meta["id"], meta["version"], meta["nonce_b64"], ciphertext)
+
+    def save(self, base_url: str, username: str, vault: CachedVault):
+        header = json.dumps({"id": vault.id, "version": vault.version, "nonce_b64": vault.nonce_b64, "size": len(vault.ciphertext)}).encode("utf-8")
+        path = self.path(base_url, username)
+
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".tmp-") #? mkstemp creates the file 0600
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header + b"\n" + vault.ciphertext)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def drop(self, base_url: str, username: str):
+        self.path(base_url, username).unlink(missing_ok=True)
@@ -0,0 +1,258 @@
+import random
+import threading
+import time
+import uuid
+import httpx
+from occultus_client.cache import CachedVault, VaultCache
+from occultus_client.crypto import derive_keys, new_salt, encrypt_vault, decrypt_vault
+
+#? Python client for the vault API, for automation (CI secret injection, rotation scripts). One pooled keep-alive
+#? connection set per client, tokens refreshed on 401, the vault revalidated with If-None-Match instead of downloaded,
+#? and edits batched into one write that is rebased and retried when another device wrote first.
+
+OCTET_STREAM = "application/octet-stream"
+
+
+class OccultusError(Exception):
+
+    def __init__(self, response: httpx.Response):
+        try:
+            detail = response.json().get("detail")
+        except ValueError:
+            detail = response.text
+        super().__init__(f"{response.request.method} {response.request.url.path} answered {response.status_code}: {detail}")
+        self.status_code = response.status_code
+        self.detail = detail
+
+
+class VaultConflict(Exception):
+    """Every attempt lost the race against other writers"""
+
+
+class OccultusClient:
+
+    def __init__(self, base_url: str, username: str, password: str, cache_dir: str | None = None, timeout: float = 10.0,
+                 max_connections: int = 10, conflict_retries: int = 5, busy_retries: int = 3):
+        self.base_url = base_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.conflict_retries = conflict_retries
+        self.busy_retries = busy_retries
+
+        #? Keep-alive pool, every request after the first skips the TCP and TLS handshakes
+        self.http = httpx.Client(
+            base_url=self.base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60),
+        )
+        self.cache = VaultCache(cache_dir) if cache_dir else None
+        self.vault: CachedVault | None = None
+
+        self.keys = None
+        self.access_token = None
+        self.refresh_token = None
+        self.auth_lock = threading.Lock()
+        self.counters = {"requests": 0, "logins": 0, "refreshes": 0, "not_modified": 0, "downloads": 0, "writes": 0, "conflicts": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.http.close()
+
+    def store_tokens(self, response: httpx.Response):
+        tokens = response.json()
+        self.access_token = tokens["access_token"]
+        self.refresh_token = tokens["refresh_token"] #! Refresh tokens rotate, the old one is dead after a refresh
+
+    def login(self):
+        r = self.http.post("/auth/salt", json={"username": self.username})
+        if r.status_code != 200:
+            raise OccultusError(r)
+        if self.keys is None:
+            self.keys = derive_keys(self.password, r.json()["salt"]) #? argon2 with 64 MB, done once per client
+
+        r = self.http.post("/login", json={"username": self.username, "hashed_key_a": self.keys.key_a})
+        if r.status_code != 200:
+            raise OccultusError(r)
+        self.store_tokens(r)
+        self.counters["logins"] += 1
+
+    def register(self):
+        salt_b64 = new_salt()
+        self.keys = derive_keys(self.password, salt_b64)
+        r = self.http.post("/auth/register", json={"username": self.username, "salt_b64": salt_b64, "hashed_key_a": self.keys.key_a})
+        if r.status_code != 201:
+            raise OccultusError(r)
+        self.store_tokens(r)
+
+    def reauthenticate(self, stale_token: str | None):
+        """New tokens after a 401: refresh first, log in again when the session is gone. Threads that hit the same 401
+        wait here and reuse the tokens the first one got"""
+
+        with self.auth_lock:
+            if self.access_token != stale_token:
+                return
+            if self.refresh_token is not None:
+                r = self.http.post("/refresh", params={"refresh_token": self.refresh_token})
+                if r.status_code == 200:
+                    self.store_tokens(r)
+                    self.counters["refreshes"] += 1
+                    return
+            self.login()
+
+    def request(self, method: str, url: str, headers: dict | None = None, **kwargs) -> httpx.Response:
+        """Authenticated request. Retries once with new tokens on 401, and waits out 429 and 503 up to busy_retries times"""
+
+        if self.access_token is None:
+            self.reauthenticate(None)
+
+        reauthenticated = False
+        busy = 0
+        while True:
+            token = self.access_token
+            r = self.http.request(method, url, headers={**(headers or {}), "Authorization": f"Bearer {token}"}, **kwargs)
+            self.counters["requests"] += 1
+
+            if r.status_code == 401 and not reauthenticated:
+                self.reauthenticate(token)
+                reauthenticated = True
+                continue
+            if r.status_code in (429, 503) and busy < self.busy_retries:
+                busy += 1
+                retry_after = r.headers.get("retry-after", "")
+                time.sleep(min(float(retry_after), 30) if retry_after.isdigit() else 2 ** busy)
+                continue
+            return r
+
+    def known_vault(self) -> CachedVault | None:
+        if self.vault is None and self.cache is not None:
+            self.vault = self.cache.load(self.base_url, self.username)
+        return self.vault
+
+    def remember(self, vault: CachedVault | None):
+        self.vault = vault
+        if self.cache is not None:
+            if vault is None:
+                self.cache.drop(self.base_url, self.username)
+            else:
+                self.cache.save(self.base_url, self.username, vault)
+
+    def fetch(self) -> CachedVault | None:
+        """Current vault ciphertext, None when the user has none. A cached copy costs one 304 round trip and no body"""
+
+        known = self.known_vault()
+        headers = {"Accept": OCTET_STREAM}
+        if known is not None:
+            #? The min version keeps a lagging replica from answering with something older than what we hold
+            headers.update({"If-None-Match": known.etag, "X-Vault-Min-Version": str(known.version)})
+
+        r = self.request("GET", "/vaults", headers=headers)
+        if r.status_code == 304:
+            self.counters["not_modified"] += 1
+            return known
+        if r.status_code == 404:
+            self.remember(None)
+            return None
+        if r.status_code != 200:
+            raise OccultusError(r)
+
+        self.counters["downloads"] += 1
+        vault = CachedVault(int(r.headers["X-Vault-Id"]), int(r.headers["X-Vault-Version"]), r.headers["X-Vault-Nonce"], r.content)
+        self.remember(vault)
+        return vault
+
+    def entries(self) -> list:
+        vault = self.fetch()
+        return self.decrypt(vault) if vault is not None else []
+
+    def decrypt(self, vault: CachedVault) -> list:
+        if self.keys is None:
+            self.login() #? The keys come out of the login, a client that only read the cache hasn't logged in yet
+        return decrypt_vault(vault.ciphertext, vault.nonce_b64, self.keys.key_b)
+
+    def edit(self) -> "VaultEdit":
+        """with client.edit() as vault: vault.upsert(...); vault.remove(...), all of it lands in one write"""
+        return VaultEdit(self)
+
+    def apply(self, ops: list) -> CachedVault:
+        """Applies the edit functions to the current entries and writes the result once. On 409 another device wrote
+        first: the new vault is fetched and the same edits are applied to it again"""
+
+        for attempt in range(self.conflict_retries + 1):
+            vault = self.fetch()
+            entries = self.decrypt(vault) if vault is not None else []
+            for op in ops:
+                entries = op(entries)
+
+            ciphertext, nonce_b64 = encrypt_vault(entries, self.keys.key_b)
+            headers = {
+                "Content-Type": OCTET_STREAM,
+                "Accept": OCTET_STREAM,
+                "X-Vault-Nonce": nonce_b64,
+                "If-Match": str(vault.version) if vault is not None else "1", #? 1 creates the vault
+                "Idempotency-Key": uuid.uuid4().hex,
+            }
+            r = self.post_vault(ciphertext, headers)
+
+            if r.status_code == 409:
+                self.counters["conflicts"] += 1
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt)) #? Jitter, so racing writers don't collide again
+                continue
+            if r.status_code not in (200, 204):
+                raise OccultusError(r)
+
+            self.counters["writes"] += 1
+            written = CachedVault(int(r.headers["X-Vault-Id"]), int(r.headers["X-Vault-Version"]), nonce_b64, ciphertext)
+            self.remember(written)
+            return written
+
+        raise VaultConflict(f"Vault write lost {self.conflict_retries + 1} races in a row")
+
+    def post_vault(self, ciphertext: bytes, headers: dict) -> httpx.Response:
+        try:
+            return self.request("POST", "/vaults", headers=headers, content=ciphertext)
+        except httpx.TransportError:
+            #? The write may have landed before the connection broke. Same Idempotency-Key, so the server replays its
+            #? answer instead of writing twice or answering 409 to our own write
+            return self.request("POST", "/vaults", headers=headers, content=ciphertext)
+
+
+class VaultEdit:
+    """Collects edits, commit() (or leaving the with block without an error) writes them as one new vault version"""
+
+    def __init__(self, client: OccultusClient):
+        self.client = client
+        self.ops = []
+        self.result: CachedVault | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and self.ops:
+            self.commit()
+
+    def update(self, fn):
+        """fn(entries) -> entries, called again on every retry so it must not depend on anything else"""
+        self.ops.append(fn)
+        return self
+
+    def upsert(self, website: str, username: str, password: str):
+        def op(entries):
+            kept = [e for e in entries if (e.get("website"), e.get("username")) != (website, username)]
+            return [*kept, {"website": website, "username": username, "password": password}]
+        return self.update(op)
+
+    def remove(self, website: str, username: str | None = None):
+        def op(entries):
+            return [e for e in entries if not (e.get("website") == website and username in (None, e.get("username")))]
+        return self.update(op)
+
+    def commit(self) -> CachedVault:
+        self.result = self.client.apply(self.ops)
+        self.ops = []
+        return self.result
@@ -0,0 +1,50 @@
+import base64
+import json
+import os
+from typing import NamedTuple
+from argon2.low_level import hash_secret_raw, Type
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+#! Must produce the same keys and ciphertext as frontend/src/crypto (kdf.ts and aes.ts), a vault written by the web
+#! app has to open here and the other way round.
+#? argon2id over the master password gives 64 bytes: the first half (key_a) authenticates the login, the second half
+#? (key_b) is the AES-256-GCM key of the vault and never leaves the client.
+
+ARGON2_TIME_COST = 3
+ARGON2_MEMORY_COST = 65536 #? KiB, 64 MB
+ARGON2_PARALLELISM = 1
+NONCE_BYTES = 12
+
+
+class Keys(NamedTuple):
+    key_a: str #? base64, sent as hashed_key_a
+    key_b: bytes
+
+
+def derive_keys(password: str, salt_b64: str) -> Keys:
+    raw = hash_secret_raw(
+        secret=password.encode("utf-8"),
+        salt=base64.b64decode(salt_b64),
+        time_cost=ARGON2_TIME_COST,
+        memory_cost=ARGON2_MEMORY_COST,
+        parallelism=ARGON2_PARALLELISM,
+        hash_len=64,
+        type=Type.ID,
+    )
+    return Keys(key_a=base64.b64encode(raw[:32]).decode("ascii"), key_b=raw[32:])
+
+
+def new_salt() -> str:
+    return base64.b64encode(os.urandom(16)).decode("ascii")
+
+
+def encrypt_vault(entries: list, key_b: bytes) -> tuple[bytes, str]:
+    """(ciphertext, nonce_b64) of the JSON entry list, a fresh nonce every time"""
+    nonce = os.urandom(NONCE_BYTES)
+    plaintext = json.dumps(entries, separators=(",", ":"), ensure_ascii=False).encode("utf-8") #? Same bytes as JSON.stringify
+    return AESGCM(key_b).encrypt(nonce, plaintext, None), base64.b64encode(nonce).decode("ascii")
+
+
+def decrypt_vault(ciphertext: bytes, nonce_b64: str, key_b: bytes) -> list:
+    """Raises cryptography.exceptions.InvalidTag for a wrong key or a tampered vault"""
+    return json.loads(AESGCM(key_b).decrypt(base64.b64decode(nonce_b64), ciphertext, None))
@@ -0,0 +1,8 @@
+#!/bin/sh
+# Runs once when the primary's data directory is created: a role the replica streams WAL with, and the pg_hba entry for it
+set -e
+
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" \
+    -c "CREATE ROLE replicator WITH REPLICATION LOGIN PASSWORD '${REPLICATION_PASSWORD:-replicator}';"
+
+echo "host replication replicator all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -14,6 +14,30 @@ interface CustomAxiosRequestConfig extends InternalAxiosRequestConfig {
     _retry?: boolean;
 }
 
+// One refresh at a time: the refresh token rotates, so concurrent 401s must share the new pair
+let refreshing: Promise<string> | null = null;
+
+async function refreshAccessToken(): Promise<string> {
+    const refreshToken = localStorage.getItem('refresh_token');
+    if (!refreshToken) throw new Error('No refresh token');
+
+    try {
+        const response = await axios.post(
+            `${apiClient.defaults.baseURL}/refresh`,
+            null,
+            { params: { refresh_token: refreshToken } }
+        );
+        // The old refresh token is dead now, keep the rotated one
+        localStorage.setItem('refresh_token', response.data.refresh_token);
+        return response.data.access_token;
+    } catch (err) {
+        // Another tab rotated the token first and stored the new one, try again with it
+        const stored = localStorage.getItem('refresh_token');
+        if (stored && stored !== refreshToken) return refreshAccessToken();
+        throw err;
+    }
+}
+
 // Response interceptor - handles 401 errors and token refresh
 apiClient.interceptors.response.use(
     (response) => response, // Success - pass through
@@ -29,23 +53,15 @@ apiClient.interceptors.response.use(
             originalRequest._retry = true;
 
             try {
-                const refreshToken = localStorage.getItem('refresh_token');
-
-                if (!refreshToken) {
+                if (!localStorage.getItem('refresh_token')) {
                     // No refresh token - trigger logout
                     const { logout } = getGlobalAuthActions();
                     if (logout) logout();
                     return Promise.reject(error);
                 }
 
-                // Call refresh endpoint
-                const response = await axios.post(
-                    `${apiClient.defaults.baseURL}/refresh`,
-                    null,
-                    { params: { refresh_token: refreshToken } }
-                );
-
-                const newAccessToken = response.data.access_token;
+                refreshing = refreshing ?? refreshAccessToken().finally(() => { refreshing = null; });
+                const newAccessToken = await refreshing;
 
                 // Update the access token in AuthContext
                 const { setAccessToken } = getGlobalAuthActions();
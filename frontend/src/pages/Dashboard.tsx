@@ -198,6 +198,10 @@ export const Dashboard = () => {
     };
 
     const handleLogout = () => {
+        // Ends the session server side too, the refresh token and its access tokens stop working
+        apiClient.post('/logout', null, {
+            headers: { Authorization: `Bearer ${accessToken}` }
+        }).catch(() => {});
         setKeyB(null);
         setAccessToken(null);
         localStorage.removeItem('refresh_token');